@@ -1,12 +1,32 @@
-from fastapi import FastAPI, UploadFile, File, Request
-from fastapi.responses import JSONResponse, FileResponse
+from fastapi import FastAPI, Request, Depends
+from fastapi.responses import JSONResponse, FileResponse, StreamingResponse, Response
 from fastapi.middleware.cors import CORSMiddleware
-import os, threading, time, requests
+from fastapi.concurrency import run_in_threadpool
+import os, threading, time, hashlib, tempfile, asyncio, random, json, secrets, sqlite3, heapq, zlib, re
+import copy, subprocess, uuid, gzip, logging, bisect, struct, shutil, hmac
+from collections import defaultdict, Counter, deque
+from collections import OrderedDict
+import httpx
 from urllib.parse import quote, unquote
+from email.utils import parsedate_to_datetime
 import base64
 from supabase import create_client, Client
+from supabase.lib.client_options import SyncClientOptions
+from postgrest.exceptions import APIError
 from Crypto.Cipher import AES
 from Crypto.Util.Padding import unpad
+from python_multipart.multipart import MultipartParser, parse_options_header
+from python_multipart.exceptions import FormParserError
+
+# אופציונלי: דחיסת brotli ו-msgpack לתשובות /status (בלעדיהם – gzip ו-JSON בלבד)
+try:
+    import brotli
+except ImportError:
+    brotli = None
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
 
 # ───────────────────────────────────────────────
 app = FastAPI()
@@ -29,27 +49,1228 @@ ENCRYPTION_KEY = os.getenv("ENCRYPTION_KEY")
 RUNPOD_API_KEY = os.getenv("RUNPOD_API_KEY")      
 FALLBACK_LIMIT_DEFAULT = float(os.getenv("FALLBACK_LIMIT_DEFAULT", "0.1"))
 RUNPOD_RATE_PER_SEC = float(os.getenv("RUNPOD_RATE_PER_SEC", "0.0002"))
+ACCOUNT_CACHE_TTL = float(os.getenv("ACCOUNT_CACHE_TTL", "60"))
+ACCOUNT_CACHE_SIZE = int(os.getenv("ACCOUNT_CACHE_SIZE", "1024"))
+BALANCE_CACHE_TTL = float(os.getenv("BALANCE_CACHE_TTL", "30"))            # אחרי זה – רענון ברקע
+BALANCE_STALE_SECONDS = float(os.getenv("BALANCE_STALE_SECONDS", "600"))   # אחרי זה – שליפה לפני תשובה
 
 UPLOAD_DIR = "uploads"
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_BYTES", str(2 * 1024 ** 3)))
+# מרווח ל-multipart מעבר לגודל הקובץ: שני boundary (עד 70 תווים כל אחד), Content-Disposition
+# עם שם הקובץ (גם שם ארוך ב-UTF-8 – פחות מ-1KB), Content-Type ושדות טופס קטנים. גוף גולמי – בלי מרווח.
+MULTIPART_OVERHEAD_BYTES = 4 * 1024
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+DRIVE_DOWNLOAD_PARTS = int(os.getenv("DRIVE_DOWNLOAD_PARTS", "4"))
+DRIVE_PARALLEL_MIN_BYTES = int(os.getenv("DRIVE_PARALLEL_MIN_BYTES", str(16 * 1024 * 1024)))
+DRIVE_STREAM_THROUGH = os.getenv("DRIVE_STREAM_THROUGH", "0") == "1"   # ברירת מחדל ל-stream=0/1 ב-/fetch-and-store-audio
+RESULT_CACHE_MAX_BYTES = int(os.getenv("RESULT_CACHE_MAX_BYTES", str(256 * 1024 * 1024)))
+SPLIT_SEGMENT_SECONDS = float(os.getenv("SPLIT_SEGMENT_SECONDS", "600"))
+SPLIT_OVERLAP_SECONDS = float(os.getenv("SPLIT_OVERLAP_SECONDS", "8"))
+SPLIT_MAX_RETRIES = int(os.getenv("SPLIT_MAX_RETRIES", "2"))
+SPLIT_SUBMIT_CONCURRENCY = int(os.getenv("SPLIT_SUBMIT_CONCURRENCY", "4"))
+SPLIT_SILENCE_NOISE = os.getenv("SPLIT_SILENCE_NOISE", "-35dB")
+SPLIT_SILENCE_MIN_SECONDS = float(os.getenv("SPLIT_SILENCE_MIN_SECONDS", "0.4"))
+FFMPEG_BIN = os.getenv("FFMPEG_BIN", "ffmpeg")
+NORMALIZE_AUDIO = os.getenv("NORMALIZE_AUDIO", "0") == "1"       # ברירת מחדל ל-/upload ולדרייב (normalize=0/1 לבקשה)
+NORMALIZE_FORMAT = os.getenv("NORMALIZE_FORMAT", "opus")          # opus | flac
+NORMALIZE_OPUS_BITRATE = os.getenv("NORMALIZE_OPUS_BITRATE", "32k")
+NORMALIZE_CONCURRENCY = int(os.getenv("NORMALIZE_CONCURRENCY", str(max(1, (os.cpu_count() or 2) // 2))))
+RUNPOD_PREWARM = os.getenv("RUNPOD_PREWARM", "0") == "1"
+PREWARM_MIN_BOOT_SECONDS = float(os.getenv("PREWARM_MIN_BOOT_SECONDS", "5"))   # חציון boot נמוך מזה → לא שווה
+PREWARM_MIN_SAMPLES = int(os.getenv("PREWARM_MIN_SAMPLES", "3"))
+PREWARM_SAMPLE_SIZE = int(os.getenv("PREWARM_SAMPLE_SIZE", "50"))
+PREWARM_COOLDOWN_SECONDS = float(os.getenv("PREWARM_COOLDOWN_SECONDS", "30"))
+PREWARM_WINDOW_SECONDS = float(os.getenv("PREWARM_WINDOW_SECONDS", "120"))      # job שנשלח עד כך אחרי prewarm נחשב "מחומם"
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", "200"))
+BATCH_SUBMIT_CONCURRENCY = int(os.getenv("BATCH_SUBMIT_CONCURRENCY", "4"))
+BATCH_STATUS_CONCURRENCY = int(os.getenv("BATCH_STATUS_CONCURRENCY", "8"))
+JOB_REGISTRY_TTL_SECONDS = float(os.getenv("JOB_REGISTRY_TTL_SECONDS", str(7 * 24 * 3600)))
+TRANSCRIPTION_WRITE_BEHIND = os.getenv("TRANSCRIPTION_WRITE_BEHIND", "0") == "1"
+WRITE_BEHIND_FLUSH_SECONDS = float(os.getenv("WRITE_BEHIND_FLUSH_SECONDS", "1"))
+WRITE_BEHIND_MAX_PENDING = int(os.getenv("WRITE_BEHIND_MAX_PENDING", "200"))   # יותר רשומות ממתינות → flush מיד
+UPLOAD_TTL_SECONDS = float(os.getenv("UPLOAD_TTL_SECONDS", "3600"))
+UPLOAD_DIR_QUOTA_BYTES = int(os.getenv("UPLOAD_DIR_QUOTA_BYTES", "0"))   # 0 = ללא מגבלה
 os.makedirs(UPLOAD_DIR, exist_ok=True)
-BASE_URL = "https://my-transcribe-proxy.onrender.com"
+DATA_DIR = os.getenv("DATA_DIR", "data")                 # מצב מקומי שנשמר בין הפעלות
+os.makedirs(DATA_DIR, exist_ok=True)
+STATE_DB_PATH = os.path.join(DATA_DIR, "state.db")
+BASE_URL = os.getenv("BASE_URL", "https://my-transcribe-proxy.onrender.com")
+
+# כתובות upstream (ניתנות להחלפה – למשל לשרתי דמה מקומיים)
+RUNPOD_ENDPOINT_URL = os.getenv("RUNPOD_ENDPOINT_URL", "https://api.runpod.ai/v2/lco4rijwxicjyi")
+RUNPOD_GRAPHQL_URL = os.getenv("RUNPOD_GRAPHQL_URL", "https://api.runpod.io/graphql")
+DRIVE_API_URL = os.getenv("DRIVE_API_URL", "https://www.googleapis.com/drive/v3")
+
+# HTTP יוצא – timeouts (שניות), ניסיונות חוזרים ומאגר חיבורים לכל upstream
+UPSTREAM_TIMEOUTS = {
+    "runpod": float(os.getenv("RUNPOD_TIMEOUT", "180")),
+    "graphql": float(os.getenv("RUNPOD_GRAPHQL_TIMEOUT", "10")),
+    "drive": float(os.getenv("DRIVE_TIMEOUT", "120")),
+}
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "10"))
+HTTP_RETRIES = int(os.getenv("HTTP_RETRIES", "2"))
+HTTP_BACKOFF_SECONDS = float(os.getenv("HTTP_BACKOFF_SECONDS", "0.5"))
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", "20"))
+
+# Webhook של RunPod – הסוד הוא חלק מה-URL. בלי RUNPOD_WEBHOOK_SECRET הוא נגזר מ-ENCRYPTION_KEY,
+# כך שהוא זהה בכל ה-workers ושורד restart (webhook של job שנשלח לפני כן לא נדחה);
+# בלי אף אחד מהם – webhooks כבויים ונשארים עם שאילתת RunPod
+RUNPOD_WEBHOOK_SECRET = os.getenv("RUNPOD_WEBHOOK_SECRET") or (
+    hmac.new(ENCRYPTION_KEY.encode("utf-8"), b"runpod-webhook", hashlib.sha256).hexdigest()[:32]
+    if ENCRYPTION_KEY else None
+)
+RUNPOD_WEBHOOKS = os.getenv("RUNPOD_WEBHOOKS", "1") == "1" and RUNPOD_WEBHOOK_SECRET is not None
+JOB_WAIT_MAX_SECONDS = float(os.getenv("JOB_WAIT_MAX_SECONDS", "55"))
+JOB_EVENTS_FALLBACK_POLL_SECONDS = float(os.getenv("JOB_EVENTS_FALLBACK_POLL_SECONDS", "60"))
+STATUS_CACHE_TTL = float(os.getenv("STATUS_CACHE_TTL", "5"))          # תשובות סופיות (COMPLETED/FAILED...)
+STATUS_CACHE_SIZE = int(os.getenv("STATUS_CACHE_SIZE", "256"))
+STATUS_BATCH_MAX = int(os.getenv("STATUS_BATCH_MAX", "100"))
+TRANSCRIPTIONS_PAGE_MAX = int(os.getenv("TRANSCRIPTIONS_PAGE_MAX", "500"))
+TRANSCRIPTIONS_BULK_MAX = int(os.getenv("TRANSCRIPTIONS_BULK_MAX", "200"))   # מזהים לבקשה (in.(...) ב-URL)
+STATUS_COMPRESS_MIN_BYTES = int(os.getenv("STATUS_COMPRESS_MIN_BYTES", "1024"))
+
+# בקרת קבלה ל-RunPod – קצב שליחה לכל טוקן (token bucket) ותור למשתמשי fallback
+RUNPOD_SUBMIT_RATE = float(os.getenv("RUNPOD_SUBMIT_RATE", "1"))     # jobs לשנייה לכל טוקן; 0 = ללא הגבלה
+RUNPOD_SUBMIT_BURST = float(os.getenv("RUNPOD_SUBMIT_BURST", "5"))
+QUEUE_MAX_PER_USER = int(os.getenv("QUEUE_MAX_PER_USER", "200"))
+
+# לוגים: LOG_LEVEL (DEBUG/INFO/WARNING/ERROR), LOG_FORMAT=text|json
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text")
+
+
+# ───────────────────────────────────────────────
+# 📝 לוגים – רמה נשלטת; ההודעה מורכבת (%s) רק אם הרמה פעילה
+class JsonLogFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": round(record.created, 3),
+            "level": record.levelname,
+            "msg": record.getMessage(),
+            "where": f"{record.funcName}:{record.lineno}",
+        }
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+
+log = logging.getLogger("transcribe-proxy")
+_log_handler = logging.StreamHandler()
+_log_handler.setFormatter(
+    JsonLogFormatter() if LOG_FORMAT == "json" else logging.Formatter("%(asctime)s %(levelname)s %(message)s")
+)
+log.addHandler(_log_handler)
+log.setLevel(LOG_LEVEL)
+log.propagate = False
+
+
+# ───────────────────────────────────────────────
+# 📈 מדדי Prometheus (פורמט הטקסט של /metrics) – בלי תלות חיצונית
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+_metrics: list = []
+
+
+def _label_value(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class _Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, help_text: str, labels: tuple = ()):
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        self._values: dict = {}
+        self._lock = threading.Lock()
+        _metrics.append(self)
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(str(labels[name]) for name in self.labels)
+
+    def _labels(self, key: tuple, extra: str = "") -> str:
+        pairs = [f'{n}="{_label_value(v)}"' for n, v in zip(self.labels, key)]
+        if extra:
+            pairs.append(extra)
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            items = list(self._values.items())
+        for key, value in items:
+            lines.append(f"{self.name}{self._labels(key)} {value}")
+        return lines
+
+
+class CounterMetric(_Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+
+class GaugeMetric(_Metric):
+    """gauge רגיל (inc/dec/set), או – עם fn – ערך שנקרא רק בזמן ה-scrape."""
+
+    kind = "gauge"
+
+    def __init__(self, name: str, help_text: str, labels: tuple = (), fn=None):
+        super().__init__(name, help_text, labels)
+        self.fn = fn
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def dec(self, amount: float = 1.0, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value: float, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def render(self) -> list[str]:
+        if self.fn is not None:
+            self.set(self.fn())
+        return super().render()
+
+
+class HistogramMetric(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][i] += 1
+            state[1] += value
+            state[2] += 1
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            items = [(key, list(state[0]), state[1], state[2]) for key, state in self._values.items()]
+        for key, counts, total, count in items:
+            cumulative = 0
+            for bound, n in zip(self.buckets, counts):
+                cumulative += n
+                le = self._labels(key, f'le="{bound}"')
+                lines.append(f"{self.name}_bucket{le} {cumulative}")
+            inf = self._labels(key, 'le="+Inf"')
+            lines.append(f"{self.name}_bucket{inf} {count}")
+            lines.append(f"{self.name}_sum{self._labels(key)} {total}")
+            lines.append(f"{self.name}_count{self._labels(key)} {count}")
+        return lines
+
+
+http_requests_total = CounterMetric(
+    "http_requests_total", "בקשות HTTP שטופלו", ("route", "method", "status")
+)
+http_request_seconds = HistogramMetric(
+    "http_request_duration_seconds", "זמן עד תחילת התשובה, לפי route", ("route", "method")
+)
+http_in_flight = GaugeMetric("http_requests_in_flight", "בקשות HTTP בטיפול כרגע")
+upstream_requests_total = CounterMetric(
+    "upstream_requests_total", "קריאות ל-upstream (supabase/runpod/graphql/drive)", ("upstream", "op", "status")
+)
+upstream_request_seconds = HistogramMetric(
+    "upstream_request_duration_seconds", "זמן קריאה ל-upstream (עד קבלת הכותרות)", ("upstream", "op")
+)
+upstream_in_flight = GaugeMetric("upstream_requests_in_flight", "קריאות upstream פתוחות", ("upstream",))
+job_processing_ratio = HistogramMetric(
+    "job_processing_ratio", "זמן עיבוד / אורך אודיו (processing_ratio)",
+    buckets=(0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2),
+)
+job_worker_boot_seconds = HistogramMetric(
+    "job_worker_boot_seconds", "זמן עליית worker ב-RunPod (worker_boot_time_seconds)",
+    buckets=(0.5, 1, 2, 5, 10, 20, 30, 60, 120, 300),
+)
+# נקראים רק ב-scrape (reaper, admission_queue, transcription_writes ו-_progressive מוגדרים בהמשך הקובץ)
+upload_dir_bytes = GaugeMetric(
+    "upload_dir_bytes", "בתים בתיקיית ההעלאות (במעקב ה-reaper)", fn=lambda: reaper.tracked_bytes
+)
+upload_dir_files = GaugeMetric("upload_dir_files", "קבצים בתיקיית ההעלאות", fn=lambda: reaper.tracked_files)
+transcription_writes_pending = GaugeMetric(
+    "transcription_writes_pending", "עדכוני transcriptions שממתינים ל-flush", fn=lambda: len(transcription_writes)
+)
+transcription_flushes_total = CounterMetric(
+    "transcription_write_flushes_total", "flush של עדכוני transcriptions (bulk/fallback/error)", ("result",)
+)
+balance_lookups_total = CounterMetric(
+    "balance_cache_lookups_total", "בדיקות יתרה של טוקן אישי (fresh/stale/miss)", ("result",)
+)
+drive_streams_active = GaugeMetric(
+    "drive_streams_active", "קבצי דרייב שמוגשים תוך כדי הורדה", fn=lambda: len(_progressive)
+)
+prewarm_total = CounterMetric(
+    "runpod_prewarm_total", "החלטות prewarm (sent/cooldown/fast_boot/warm/busy/error)", ("result",)
+)
+prewarm_saved_seconds = HistogramMetric(
+    "job_boot_saved_seconds", "זמן boot שנחסך ל-job שנשלח אחרי prewarm (מול החציון בלי prewarm)",
+    buckets=(0, 1, 2, 5, 10, 20, 30, 60, 120),
+)
+admission_queue_depth = GaugeMetric(
+    "admission_queue_depth", "jobs של fallback שממתינים בתור", fn=lambda: admission_queue.stats()["queued"]
+)
+
+
+def render_metrics() -> str:
+    lines = []
+    for metric in _metrics:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+def _upstream_op(upstream: str, url: httpx.URL) -> str:
+    """תווית פעולה קצרה ובעלת מעט ערכים (בלי מזהי jobs/קבצים)."""
+    segs = [s for s in url.path.split("/") if s]
+    if upstream == "runpod":
+        return segs[2] if len(segs) > 2 else "other"          # /v2/{endpoint}/run|status/...|health
+    if upstream == "drive":
+        return "download" if url.params.get("alt") == "media" else "metadata"
+    if upstream == "supabase":
+        if segs[:2] == ["rest", "v1"] and len(segs) > 2:
+            return "/".join(segs[2:4]) if segs[2] == "rpc" else segs[2]
+        return segs[0] if segs else "other"
+    return upstream
+
+
+class MeteredTransport(httpx.BaseTransport):
+    """transport סינכרוני (Supabase) שמודד כל קריאה."""
+
+    def __init__(self, upstream: str, transport: httpx.BaseTransport):
+        self.upstream = upstream
+        self.transport = transport
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        op = _upstream_op(self.upstream, request.url)
+        status = "error"
+        upstream_in_flight.inc(upstream=self.upstream)
+        start = time.perf_counter()
+        try:
+            response = self.transport.handle_request(request)
+            status = response.status_code
+            return response
+        finally:
+            upstream_in_flight.dec(upstream=self.upstream)
+            upstream_request_seconds.observe(time.perf_counter() - start, upstream=self.upstream, op=op)
+            upstream_requests_total.inc(upstream=self.upstream, op=op, status=status)
+
+    def close(self):
+        self.transport.close()
+
+
+class MeteredAsyncTransport(httpx.AsyncBaseTransport):
+    """כמו MeteredTransport, ללקוחות ה-async המשותפים (runpod/graphql/drive)."""
+
+    def __init__(self, upstream: str, transport: httpx.AsyncBaseTransport):
+        self.upstream = upstream
+        self.transport = transport
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        op = _upstream_op(self.upstream, request.url)
+        status = "error"
+        upstream_in_flight.inc(upstream=self.upstream)
+        start = time.perf_counter()
+        try:
+            response = await self.transport.handle_async_request(request)
+            status = response.status_code
+            return response
+        finally:
+            upstream_in_flight.dec(upstream=self.upstream)
+            upstream_request_seconds.observe(time.perf_counter() - start, upstream=self.upstream, op=op)
+            upstream_requests_total.inc(upstream=self.upstream, op=op, status=status)
+
+    async def aclose(self):
+        await self.transport.aclose()
+
+
+class MetricsMiddleware:
+    """ASGI middleware: מונה, זמן עד תחילת התשובה ובקשות פתוחות, לפי תבנית ה-route (לא ה-path עצמו)."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        start = time.perf_counter()
+        recorded = False
+
+        def record(status: int):
+            nonlocal recorded
+            recorded = True
+            route = scope.get("route")
+            path = getattr(route, "path", None) or "unmatched"
+            http_request_seconds.observe(time.perf_counter() - start, route=path, method=scope["method"])
+            http_requests_total.inc(route=path, method=scope["method"], status=status)
+
+        async def send_and_record(message):
+            if message["type"] == "http.response.start":
+                record(message["status"])
+            await send(message)
+
+        http_in_flight.inc()
+        try:
+            await self.app(scope, receive, send_and_record)
+        finally:
+            http_in_flight.dec()
+            if not recorded:
+                record(500)
+
+
+app.add_middleware(MetricsMiddleware)
+
+# חיבור ל-Supabase (דרך transport מדוד)
+supabase: Client = create_client(
+    SUPABASE_URL,
+    SUPABASE_KEY,
+    options=SyncClientOptions(
+        httpx_client=httpx.Client(transport=MeteredTransport("supabase", httpx.HTTPTransport()), timeout=120)
+    ),
+)
+
+# ───────────────────────────────────────────────
+# 🌐 שכבת HTTP יוצאת – לקוח async משותף עם keep-alive לכל upstream
+_http_clients: dict[str, tuple[asyncio.AbstractEventLoop, httpx.AsyncClient]] = {}
+RETRY_STATUS_CODES = {429, 502, 503, 504}
+
+
+def http_client(upstream: str) -> httpx.AsyncClient:
+    """
+    מחזיר את הלקוח המשותף של ה-upstream (runpod / graphql / drive), ויוצר אותו בפעם הראשונה
+    (או מחדש, אם הוא שייך ללולאת אירועים אחרת).
+    """
+    loop = asyncio.get_running_loop()
+    owner, client = _http_clients.get(upstream, (None, None))
+    if client is None or client.is_closed or owner is not loop:
+        client = httpx.AsyncClient(
+            timeout=httpx.Timeout(UPSTREAM_TIMEOUTS[upstream], connect=HTTP_CONNECT_TIMEOUT),
+            transport=MeteredAsyncTransport(
+                upstream,
+                httpx.AsyncHTTPTransport(
+                    limits=httpx.Limits(
+                        max_connections=HTTP_MAX_CONNECTIONS,
+                        max_keepalive_connections=HTTP_MAX_CONNECTIONS,
+                        keepalive_expiry=60,
+                    ),
+                ),
+            ),
+        )
+        _http_clients[upstream] = (loop, client)
+    return client
+
+
+def _retry_delay(attempt: int, response: httpx.Response | None = None) -> float:
+    retry_after = response.headers.get("retry-after") if response is not None else None
+    if retry_after and retry_after.isdigit():
+        return min(float(retry_after), 30.0)
+    return HTTP_BACKOFF_SECONDS * (2 ** attempt) * (1 + random.random() / 2)
+
+
+async def upstream_request(
+    upstream: str,
+    method: str,
+    url: str,
+    *,
+    idempotent: bool = True,
+    retries: int | None = None,
+    **kwargs,
+) -> httpx.Response:
+    """
+    בקשה ל-upstream דרך הלקוח המשותף, עם ניסיונות חוזרים ו-backoff אקספוננציאלי.
+
+    - בקשה idempotent נשלחת שוב על שגיאת רשת או על 429/502/503/504.
+    - בקשה לא idempotent (למשל /run, שיוצר job בתשלום) נשלחת שוב רק אם החיבור
+      עצמו נכשל – כלומר הבקשה בוודאות לא הגיעה ל-upstream.
+    """
+    attempts = 1 + (HTTP_RETRIES if retries is None else retries)
+    for attempt in range(attempts):
+        last = attempt == attempts - 1
+        try:
+            r = await http_client(upstream).request(method, url, **kwargs)
+        except httpx.TransportError as e:
+            not_sent = isinstance(e, (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout))
+            if last or not (idempotent or not_sent):
+                raise
+            log.warning("🔁 %s %s נכשל (%s), ניסיון חוזר %s", upstream, method, type(e).__name__, attempt + 1)
+            await asyncio.sleep(_retry_delay(attempt))
+            continue
+        if idempotent and not last and r.status_code in RETRY_STATUS_CODES:
+            log.warning("🔁 %s %s החזיר %s, ניסיון חוזר %s", upstream, method, r.status_code, attempt + 1)
+            await asyncio.sleep(_retry_delay(attempt, r))
+            continue
+        return r
+
+
+@app.on_event("shutdown")
+async def close_http_clients():
+    for _, client in _http_clients.values():
+        await client.aclose()
+    _http_clients.clear()
 
-# חיבור ל-Supabase
-supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
 
 # ───────────────────────────────────────────────
-def delete_later(path, delay=3600):
-    def _delete():
-        time.sleep(delay)
-        if os.path.exists(path):
+# 🧹 מחיקה אוטומטית – thread יחיד עם heap לפי זמן תפוגה,
+#    אינדקס תפוגות שנשמר ב-state.db ושורד restart, ומכסת דיסק עם פינוי הישן ביותר.
+#    כל schedule נוסף לאותו קובץ הוא הפניה (reference) נוספת: הקובץ נמחק רק
+#    כשפגה ההפניה האחרונה.
+class UploadReaper:
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._heap: list[tuple[float, str]] = []
+        # path → (expires_at, size, last_referenced_at, refs)
+        self._entries: dict[str, tuple[float, int, float, int]] = {}
+        self._thread: threading.Thread | None = None
+        self.stats = {"files_reclaimed": 0, "bytes_reclaimed": 0, "evicted_for_quota": 0}
+
+    # נקראים גם מ-/metrics ו-/storage/stats (threadpool) בזמן שה-reaper משנה את _entries
+    @property
+    def tracked_files(self) -> int:
+        with self._cond:
+            return len(self._entries)
+
+    @property
+    def tracked_bytes(self) -> int:
+        with self._cond:
+            return sum(entry[1] for entry in self._entries.values())
+
+    def start(self):
+        with self._cond:
+            if self._thread is not None:
+                return
+            self._load()
+            self._thread = threading.Thread(target=self._run, name="upload-reaper", daemon=True)
+            self._thread.start()
+
+    def _load(self):
+        """טוען את האינדקס השמור, ומתזמן גם קבצים יתומים שאינם בו (לפי mtime)."""
+        for row in state_db().execute("SELECT path, expires_at, size_bytes, created_at, refs FROM file_expiry"):
+            self._entries[row["path"]] = (row["expires_at"], row["size_bytes"], row["created_at"], row["refs"])
+            heapq.heappush(self._heap, (row["expires_at"], row["path"]))
+        orphans = 0
+        for name in os.listdir(UPLOAD_DIR):
+            path = os.path.join(UPLOAD_DIR, name)
+            if path not in self._entries and os.path.isfile(path):
+                st = os.stat(path)
+                self._track(path, st.st_mtime + UPLOAD_TTL_SECONDS, st.st_size, st.st_mtime, 1)
+                orphans += 1
+        if self._entries:
+            log.info("🧹 reaper: %s קבצים במעקב (%s יתומים תוזמנו)", len(self._entries), orphans)
+
+    def _track(self, path: str, expires_at: float, size: int, created_at: float, refs: int):
+        self._entries[path] = (expires_at, size, created_at, refs)
+        heapq.heappush(self._heap, (expires_at, path))
+        state_db().execute(
+            "INSERT OR REPLACE INTO file_expiry (path, expires_at, size_bytes, created_at, refs) "
+            "VALUES (?, ?, ?, ?, ?)",
+            (path, expires_at, size, created_at, refs),
+        )
+
+    def schedule(self, path: str, delay: float = UPLOAD_TTL_SECONDS):
+        """מוסיף הפניה לקובץ: הוא יישמר לפחות delay שניות מעכשיו."""
+        self.start()
+        now = time.time()
+        size = os.path.getsize(path) if os.path.exists(path) else 0
+        with self._cond:
+            prev = self._entries.get(path)
+            expires_at = max(now + delay, prev[0]) if prev else now + delay
+            self._track(path, expires_at, size, now, (prev[3] + 1) if prev else 1)
+            self._enforce_quota(keep=path)
+            self._cond.notify()
+
+    def refs(self, path: str) -> int:
+        entry = self._entries.get(path)
+        return entry[3] if entry else 0
+
+    def _enforce_quota(self, keep: str):
+        if UPLOAD_DIR_QUOTA_BYTES <= 0:
+            return
+        total = self.tracked_bytes
+        if total <= UPLOAD_DIR_QUOTA_BYTES:
+            return
+        for path, (_, size, _, _) in sorted(self._entries.items(), key=lambda kv: kv[1][2]):
+            if total <= UPLOAD_DIR_QUOTA_BYTES:
+                break
+            if path == keep:
+                continue
+            self._reclaim(path)
+            self.stats["evicted_for_quota"] += 1
+            total -= size
+
+    def _reclaim(self, path: str):
+        size = self._entries.pop(path)[1]
+        state_db().execute("DELETE FROM file_expiry WHERE path = ?", (path,))
+        try:
             os.remove(path)
-            print(f"[Auto Delete] נמחק הקובץ: {path}")
-    threading.Thread(target=_delete, daemon=True).start()
+        except FileNotFoundError:
+            return
+        self.stats["files_reclaimed"] += 1
+        self.stats["bytes_reclaimed"] += size
+        log.info("[Auto Delete] נמחק הקובץ: %s", path)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._heap:
+                    self._cond.wait()
+                expires_at, path = self._heap[0]
+                wait = expires_at - time.time()
+                if wait > 0:
+                    self._cond.wait(timeout=wait)
+                    continue
+                heapq.heappop(self._heap)
+                entry = self._entries.get(path)
+                # רשומת heap ישנה (הקובץ תוזמן מחדש או כבר פונה) – מדלגים
+                if entry is None or entry[0] != expires_at:
+                    continue
+                try:
+                    self._reclaim(path)
+                except Exception as e:
+                    log.warning("⚠️ reaper: כשל במחיקת %s: %s", path, e)
+
+
+reaper = UploadReaper()
+
+
+def delete_later(path, delay=UPLOAD_TTL_SECONDS):
+    reaper.schedule(path, delay)
+
+
+@app.on_event("startup")
+def start_reaper():
+    reaper.start()
+
+
+@app.get("/storage/stats")
+def storage_stats():
+    """מצב תיקיית ההעלאות: קבצים ובתים במעקב, ומה פונה עד כה."""
+    return JSONResponse({
+        "files_tracked": reaper.tracked_files,
+        "bytes_tracked": reaper.tracked_bytes,
+        "quota_bytes": UPLOAD_DIR_QUOTA_BYTES or None,
+        **reaper.stats,
+    })
+
+
+# ───────────────────────────────────────────────
+# 🧬 אחסון לפי תוכן – קובץ אחד לכל SHA-256, בשם {sha256}{ext}
+def file_url(filename: str) -> str:
+    return f"{BASE_URL}/files/{quote(filename)}"
+
+
+def safe_ext(name: str | None, default: str = ".bin") -> str:
+    ext = os.path.splitext(name or "")[1].lower()
+    return ext if 1 < len(ext) <= 8 and ext[1:].isalnum() else default
+
+
+def hash_file(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(UPLOAD_CHUNK_SIZE):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def find_blob(digest: str) -> dict | None:
+    row = state_db().execute("SELECT * FROM blobs WHERE sha256 = ?", (digest,)).fetchone()
+    if row and os.path.isfile(os.path.join(UPLOAD_DIR, row["filename"])):
+        return dict(row)
+    if row:
+        state_db().execute("DELETE FROM blobs WHERE sha256 = ?", (digest,))
+        state_db().execute("DELETE FROM media_info WHERE sha256 = ?", (digest,))
+    return None
+
+
+def store_blob(tmp_path: str, digest: str, size: int, ext: str) -> tuple[str, bool]:
+    """
+    מעביר קובץ זמני לאחסון לפי תוכן. אם התוכן כבר קיים – הקובץ הזמני נמחק
+    ורק נוספת הפניה לקובץ הקיים. מחזיר (שם הקובץ, האם היה כפול).
+    """
+    existing = find_blob(digest)
+    if existing:
+        os.remove(tmp_path)
+        filename, deduplicated = existing["filename"], True
+    else:
+        filename, deduplicated = f"{digest}{ext}", False
+        os.replace(tmp_path, os.path.join(UPLOAD_DIR, filename))
+        state_db().execute(
+            "INSERT OR REPLACE INTO blobs (sha256, filename, size_bytes, created_at) VALUES (?, ?, ?, ?)",
+            (digest, filename, size, time.time()),
+        )
+    delete_later(os.path.join(UPLOAD_DIR, filename))
+    return filename, deduplicated
+
+
+# ───────────────────────────────────────────────
+# 🎚 משך, קצב דגימה וערוצים – מכותרות הקובץ בלבד (בלי פענוח אודיו)
+PROBE_HEAD_BYTES = 64 * 1024
+
+_MP3_BITRATES = {
+    (1, 1): (32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448),
+    (1, 2): (32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384),
+    (1, 3): (32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320),
+    (2, 1): (32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256),
+    (2, 2): (8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+}
+_MP3_SAMPLE_RATES = {1: (44100, 48000, 32000), 2: (22050, 24000, 16000), 25: (11025, 12000, 8000)}
+
+
+def _id3v2_size(head: bytes) -> int:
+    """אורך תגית ID3v2 בתחילת הקובץ (0 אם אין) – אחריה מתחיל האודיו."""
+    if len(head) < 10 or head[:3] != b"ID3":
+        return 0
+    size = (head[6] << 21) | (head[7] << 14) | (head[8] << 7) | head[9]
+    return 10 + size + (10 if head[5] & 0x10 else 0)
+
+
+def _probe_wav(f, head: bytes, file_size: int) -> dict | None:
+    pos, fmt, data_size, ds64_size = 12, None, None, None
+    while pos + 8 <= file_size:
+        f.seek(pos)
+        chunk_id, size = struct.unpack("<4sI", f.read(8))
+        if chunk_id == b"ds64":
+            ds64_size = struct.unpack("<Q", f.read(16)[8:16])[0]   # RF64: גודל ה-data האמיתי
+        elif chunk_id == b"fmt ":
+            fmt = struct.unpack("<HHIIHH", f.read(16))
+        elif chunk_id == b"data":
+            data_size = ds64_size if size == 0xFFFFFFFF and ds64_size else size
+            # קובץ שנכתב בזרימה (גודל 0/לא ידוע) – עד סוף הקובץ
+            if not data_size or data_size > file_size - pos - 8:
+                data_size = file_size - pos - 8
+            break
+        pos += 8 + size + (size & 1)
+    if not fmt or data_size is None:
+        return None
+    _, channels, sample_rate, byte_rate, _, _ = fmt
+    if not byte_rate:
+        return None
+    return {"format": "wav", "duration": data_size / byte_rate, "sample_rate": sample_rate, "channels": channels}
+
+
+def _mp3_frame(header: bytes) -> dict | None:
+    if len(header) < 4 or header[0] != 0xFF or header[1] & 0xE0 != 0xE0:
+        return None
+    version = {3: 1, 2: 2, 0: 25}.get((header[1] >> 3) & 3)
+    layer = {3: 1, 2: 2, 1: 3}.get((header[1] >> 1) & 3)
+    bitrate_index, rate_index = header[2] >> 4, (header[2] >> 2) & 3
+    if not version or not layer or bitrate_index in (0, 15) or rate_index == 3:
+        return None
+    table = _MP3_BITRATES[(1, layer)] if version == 1 else _MP3_BITRATES[(2, 1 if layer == 1 else 2)]
+    bitrate = table[bitrate_index - 1] * 1000
+    sample_rate = _MP3_SAMPLE_RATES[version][rate_index]
+    padding = (header[2] >> 1) & 1
+    if layer == 1:
+        samples, length = 384, (12 * bitrate // sample_rate + padding) * 4
+    else:
+        samples = 576 if layer == 3 and version != 1 else 1152
+        length = samples // 8 * bitrate // sample_rate + padding
+    return {
+        "version": version, "bitrate": bitrate, "sample_rate": sample_rate, "samples": samples,
+        "length": length, "channels": 1 if header[3] >> 6 == 3 else 2,
+    }
+
+
+def _probe_mp3(f, head: bytes, file_size: int) -> dict | None:
+    start = _id3v2_size(head)
+    f.seek(start)
+    buf = f.read(PROBE_HEAD_BYTES)
+    for i in range(len(buf) - 4):
+        frame = _mp3_frame(buf[i:i + 4])
+        # sync אמיתי – גם הפריים הבא מתחיל בכותרת תקינה (או שהקובץ נגמר אחרי הפריים)
+        if frame:
+            following = buf[i + frame["length"]:i + frame["length"] + 4]
+            if _mp3_frame(following) or (not following and start + i + frame["length"] >= file_size):
+                break
+    else:
+        return None
+
+    # Xing/Info (VBR או CBR עם אינדקס) או VBRI – מספר הפריימים המדויק
+    side_info = (32 if frame["channels"] == 2 else 17) if frame["version"] == 1 else (17 if frame["channels"] == 2 else 9)
+    xing = buf[i + 4 + side_info:i + 4 + side_info + 12]
+    frames = None
+    if xing[:4] in (b"Xing", b"Info") and xing[7] & 1:
+        frames = struct.unpack(">I", xing[8:12])[0]
+    elif buf[i + 36:i + 40] == b"VBRI":
+        frames = struct.unpack(">I", buf[i + 50:i + 54])[0]
+    if frames:
+        duration = frames * frame["samples"] / frame["sample_rate"]
+    else:
+        f.seek(max(file_size - 128, 0))
+        audio_bytes = file_size - start - i - (128 if f.read(3) == b"TAG" else 0)
+        duration = audio_bytes * 8 / frame["bitrate"]
+    return {"format": "mp3", "duration": duration, "sample_rate": frame["sample_rate"], "channels": frame["channels"]}
+
+
+def _mp4_boxes(f, start: int, end: int):
+    """(סוג, תחילת התוכן, סוף) לכל box בטווח – קוראים רק כותרות, לא את התוכן."""
+    pos = start
+    while pos + 8 <= end:
+        f.seek(pos)
+        size, kind = struct.unpack(">I4s", f.read(8))
+        header = 8
+        if size == 1:
+            size, header = struct.unpack(">Q", f.read(8))[0], 16
+        elif size == 0:
+            size = end - pos
+        if size < header:
+            return
+        yield kind, pos + header, min(pos + size, end)
+        pos += size
+
+
+def _mp4_find(f, start: int, end: int, kind: bytes) -> tuple[int, int] | None:
+    return next(((s, e) for k, s, e in _mp4_boxes(f, start, end) if k == kind), None)
+
+
+def _probe_mp4(f, head: bytes, file_size: int) -> dict | None:
+    moov = _mp4_find(f, 0, file_size, b"moov")   # moov יכול להיות גם בסוף הקובץ
+    mvhd = moov and _mp4_find(f, *moov, b"mvhd")
+    if not mvhd:
+        return None
+    f.seek(mvhd[0])
+    version = f.read(4)[0]
+    timescale, duration = struct.unpack(">IQ", f.read(28)[16:28]) if version == 1 else struct.unpack(">II", f.read(16)[8:16])
+    if not timescale:
+        return None
+    info = {"format": "mp4", "duration": duration / timescale, "sample_rate": None, "channels": None}
+
+    # ערוץ האודיו הראשון: trak → mdia (hdlr=soun) → minf → stbl → stsd
+    for kind, s, e in _mp4_boxes(f, *moov):
+        mdia = _mp4_find(f, s, e, b"mdia") if kind == b"trak" else None
+        hdlr = mdia and _mp4_find(f, *mdia, b"hdlr")
+        if not hdlr:
+            continue
+        f.seek(hdlr[0] + 8)
+        if f.read(4) != b"soun":
+            continue
+        mdhd = _mp4_find(f, *mdia, b"mdhd")
+        minf = _mp4_find(f, *mdia, b"minf")
+        stbl = minf and _mp4_find(f, *minf, b"stbl")
+        stsd = stbl and _mp4_find(f, *stbl, b"stsd")
+        if stsd:
+            f.seek(stsd[0] + 8)   # version/flags + entry_count → רשומת הדגימה הראשונה
+            entry = f.read(36)
+            if len(entry) == 36:
+                info["channels"] = struct.unpack(">H", entry[24:26])[0]
+                info["sample_rate"] = struct.unpack(">I", entry[32:36])[0] >> 16
+        if not info["sample_rate"] and mdhd:
+            # קצב מעל 65535Hz לא נכנס ל-stsd (16.16) – ה-timescale של ערוץ אודיו הוא קצב הדגימה
+            f.seek(mdhd[0])
+            f.seek(mdhd[0] + (20 if f.read(1)[0] == 1 else 12))
+            info["sample_rate"] = struct.unpack(">I", f.read(4))[0]
+        break
+    return info
+
+
+def _probe_ogg(f, head: bytes, file_size: int) -> dict | None:
+    segments = head[26]
+    payload = head[27 + segments:27 + segments + 32]
+    serial = head[14:18]
+    if payload[:8] == b"OpusHead":
+        channels, pre_skip, sample_rate = payload[9], struct.unpack("<H", payload[10:12])[0], struct.unpack("<I", payload[12:16])[0]
+        granule_rate, codec = 48000, "opus"    # ב-Opus ה-granule תמיד ב-48kHz
+    elif payload[:7] == b"\x01vorbis":
+        channels, sample_rate = payload[11], struct.unpack("<I", payload[12:16])[0]
+        pre_skip, granule_rate, codec = 0, sample_rate, "vorbis"
+    else:
+        return None
+
+    # ה-granule של הדף האחרון (של אותו stream) = מספר הדגימות הכולל
+    f.seek(max(file_size - PROBE_HEAD_BYTES, 0))
+    tail = f.read()
+    granule, pos = -1, len(tail)
+    while granule < 0:
+        pos = tail.rfind(b"OggS", 0, pos)
+        if pos < 0 or not granule_rate:
+            return None
+        if tail[pos + 14:pos + 18] == serial and len(tail) >= pos + 14:
+            granule = struct.unpack("<q", tail[pos + 6:pos + 14])[0]   # -1 = דף בלי סוף packet
+    return {
+        "format": codec, "duration": max(granule - pre_skip, 0) / granule_rate,
+        "sample_rate": sample_rate, "channels": channels,
+    }
+
+
+def _probe_flac(f, head: bytes, file_size: int) -> dict | None:
+    start = _id3v2_size(head)
+    f.seek(start)
+    block = f.read(4 + 4 + 34)
+    if block[:4] != b"fLaC" or block[4] & 0x7F != 0:   # הבלוק הראשון חייב להיות STREAMINFO
+        return None
+    bits = int.from_bytes(block[18:26], "big")
+    sample_rate, channels, total = bits >> 44, ((bits >> 41) & 7) + 1, bits & ((1 << 36) - 1)
+    if not sample_rate:
+        return None
+    return {"format": "flac", "duration": total / sample_rate, "sample_rate": sample_rate, "channels": channels}
+
+
+def probe_audio(path: str) -> dict | None:
+    """
+    משך (שניות), קצב דגימה וערוצים מכותרות WAV / MP3 / MP4-M4A / Ogg (Opus, Vorbis) / FLAC.
+    קורא רק כותרות (ובקבצי Ogg/MP3 – את סוף הקובץ), לא מפענח אודיו. None לפורמט לא מוכר.
+    """
+    try:
+        file_size = os.path.getsize(path)
+        with open(path, "rb") as f:
+            head = f.read(PROBE_HEAD_BYTES)
+            if head[:4] in (b"RIFF", b"RF64") and head[8:12] == b"WAVE":
+                probe = _probe_wav
+            elif head[4:8] == b"ftyp":
+                probe = _probe_mp4
+            elif head[:4] == b"OggS" and len(head) > 27:
+                probe = _probe_ogg
+            elif head[_id3v2_size(head):][:4] == b"fLaC":
+                probe = _probe_flac
+            else:
+                probe = _probe_mp3
+            info = probe(f, head, file_size)
+    except (OSError, struct.error, IndexError, ValueError) as e:
+        log.debug("📏 probe_audio נכשל עבור %s: %s", path, e)
+        return None
+    if not info or not info["duration"] or info["duration"] <= 0:
+        return None
+    return {
+        "format": info["format"],
+        "audio_length_seconds": round(info["duration"], 3),
+        "sample_rate": info["sample_rate"],
+        "channels": info["channels"],
+    }
+
+
+_MEDIA_FIELDS = ("format", "audio_length_seconds", "sample_rate", "channels")
+
+
+def media_info(digest: str, path: str | None = None) -> dict | None:
+    """נתוני האודיו של blob – מהטבלה, ואם עוד לא נבדק (ויש path) – probe ושמירה."""
+    row = state_db().execute("SELECT * FROM media_info WHERE sha256 = ?", (digest,)).fetchone()
+    if row is None:
+        if not path:
+            return None
+        info = probe_audio(path)
+        # גם "לא זוהה" נשמר (format=NULL) – כדי לא לבדוק שוב את אותו קובץ
+        values = [info[k] for k in _MEDIA_FIELDS] if info else [None] * len(_MEDIA_FIELDS)
+        state_db().execute(
+            "INSERT OR REPLACE INTO media_info (sha256, format, audio_length_seconds, sample_rate, channels, probed_at) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (digest, *values, time.time()),
+        )
+        return info
+    if row["format"] is None:
+        return None
+    return {k: row[k] for k in _MEDIA_FIELDS}
+
+
+@app.api_route("/files/by-hash/{sha256}", methods=["GET", "HEAD"])
+def lookup_blob(sha256: str):
+    """
+    האם השרת כבר מחזיק קובץ עם ה-SHA-256 הזה? אם כן – מחזיר את ה-URL
+    ומאריך את חייו (הפניה נוספת), כך שאין צורך להעלות אותו שוב.
+    """
+    blob = find_blob(sha256.lower())
+    if not blob:
+        return JSONResponse({"exists": False}, status_code=404)
+    path = os.path.join(UPLOAD_DIR, blob["filename"])
+    delete_later(path)
+    return JSONResponse({
+        "exists": True,
+        "url": file_url(blob["filename"]),
+        "size_bytes": blob["size_bytes"],
+        "refs": reaper.refs(path),
+        "media": media_info(blob["sha256"], path),
+    })
+
+@app.get("/metrics")
+def metrics():
+    return Response(render_metrics(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
 
 @app.api_route("/ping", methods=["GET", "HEAD"])
 async def ping():
     return JSONResponse({"status": "ok"})
 
+# ───────────────────────────────────────────────
+# 🧠 מטמון בזיכרון (LRU חסום בגודל + TTL)
+class TTLCache:
+    """מטמון LRU חסום בגודל, עם תפוגה לכל ערך. בטוח לשימוש מכמה threads."""
+
+    _MISSING = object()
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key, self._MISSING)
+            if item is self._MISSING:
+                return default
+            expires_at, value = item
+            if expires_at < time.monotonic():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def __contains__(self, key) -> bool:
+        return self.get(key, self._MISSING) is not self._MISSING
+
+    def set(self, key, value, ttl: float | None = None):
+        with self._lock:
+            self._data[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            item = self._data.pop(key, None)
+            return item[1] if item else default
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+class KeyedLocks:
+    """asyncio.Lock לכל מפתח; מנעולים פנויים מנוקים כשהמפה גדלה."""
+
+    def __init__(self, max_idle: int = 1024):
+        self._locks: dict[str, asyncio.Lock] = {}
+        self.max_idle = max_idle
+
+    def __call__(self, key: str) -> asyncio.Lock:
+        if len(self._locks) > self.max_idle:
+            for k in [k for k, lock in self._locks.items() if not lock.locked()]:
+                del self._locks[k]
+        return self._locks.setdefault(key, asyncio.Lock())
+
+
+class SingleFlight:
+    """קריאות מקבילות עם אותו מפתח חולקות הרצה אחת של fn (ואת התוצאה או החריגה שלה)."""
+
+    def __init__(self):
+        self._flights: dict = {}
+
+    async def do(self, key, fn):
+        flight = self._flights.get(key)
+        if flight is None or flight.get_loop() is not asyncio.get_running_loop():
+            flight = asyncio.ensure_future(fn())
+            self._flights[key] = flight
+
+            def done(f, key=key):
+                if self._flights.get(key) is f:
+                    del self._flights[key]
+
+            flight.add_done_callback(done)
+        # shield: לקוח שהתנתק לא מבטל את הקריאה לשאר הממתינים
+        return await asyncio.shield(flight)
+
+
+# שורות accounts (כולל "אין רשומה") וטוקנים מפוענחים, לפי user_email
+_account_cache = TTLCache(ACCOUNT_CACHE_SIZE, ACCOUNT_CACHE_TTL)
+_token_cache = TTLCache(ACCOUNT_CACHE_SIZE, ACCOUNT_CACHE_TTL)
+
+
+def invalidate_account(user_email: str):
+    """לקרוא אחרי כל כתיבה לטבלת accounts של המשתמש."""
+    _account_cache.pop(user_email)
+    _token_cache.pop(user_email)
+
+
+# ───────────────────────────────────────────────
+# 💾 מצב מקומי (SQLite) – חיבור נפרד לכל thread
+STATE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS billed_jobs (
+    job_id TEXT PRIMARY KEY,
+    user_email TEXT NOT NULL,
+    amount_usd REAL NOT NULL,
+    used_credits REAL,
+    billed_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS file_expiry (
+    path TEXT PRIMARY KEY,
+    expires_at REAL NOT NULL,
+    size_bytes INTEGER NOT NULL DEFAULT 0,
+    created_at REAL NOT NULL,
+    refs INTEGER NOT NULL DEFAULT 1
+);
+CREATE TABLE IF NOT EXISTS blobs (
+    sha256 TEXT PRIMARY KEY,
+    filename TEXT NOT NULL,
+    size_bytes INTEGER NOT NULL,
+    created_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS result_cache (
+    key TEXT PRIMARY KEY,
+    output BLOB NOT NULL,
+    size_bytes INTEGER NOT NULL,
+    created_at REAL NOT NULL,
+    last_hit_at REAL NOT NULL,
+    hits INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS result_cache_last_hit ON result_cache (last_hit_at);
+CREATE TABLE IF NOT EXISTS job_registry (
+    job_id TEXT PRIMARY KEY,
+    user_email TEXT,
+    using_fallback INTEGER,
+    audio_id TEXT,
+    audio_length REAL,
+    cache_key TEXT,
+    status TEXT,
+    usage TEXT,
+    result BLOB,
+    created_at REAL NOT NULL,
+    completed_at REAL
+);
+CREATE INDEX IF NOT EXISTS job_registry_created ON job_registry (created_at);
+CREATE TABLE IF NOT EXISTS split_jobs (
+    id TEXT PRIMARY KEY,
+    user_email TEXT,
+    using_fallback INTEGER NOT NULL,
+    run_input TEXT NOT NULL,
+    segments TEXT NOT NULL,
+    status TEXT NOT NULL,
+    result BLOB,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS batches (
+    id TEXT PRIMARY KEY,
+    user_email TEXT NOT NULL,
+    using_fallback INTEGER NOT NULL,
+    items TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS queue_tickets (
+    id TEXT PRIMARY KEY,
+    user_email TEXT NOT NULL,
+    run_body TEXT NOT NULL,
+    job_id TEXT,
+    error TEXT,
+    created_at REAL NOT NULL,
+    dispatched_at REAL
+);
+CREATE TABLE IF NOT EXISTS media_info (
+    sha256 TEXT PRIMARY KEY,
+    format TEXT,
+    audio_length_seconds REAL,
+    sample_rate INTEGER,
+    channels INTEGER,
+    probed_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS normalized_audio (
+    source_sha256 TEXT NOT NULL,
+    format TEXT NOT NULL,
+    filename TEXT,
+    size_bytes INTEGER,
+    created_at REAL NOT NULL,
+    PRIMARY KEY (source_sha256, format)
+);
+CREATE TABLE IF NOT EXISTS prewarmed_jobs (
+    job_id TEXT PRIMARY KEY,
+    prewarmed_at REAL NOT NULL,
+    submitted_at REAL NOT NULL,
+    boot_seconds REAL,
+    baseline_boot_seconds REAL,
+    saved_seconds REAL
+);
+CREATE TABLE IF NOT EXISTS drive_cache (
+    file_id TEXT PRIMARY KEY,
+    version TEXT NOT NULL,
+    filename TEXT NOT NULL,
+    content_type TEXT,
+    stored_at REAL NOT NULL
+);
+"""
+_state_local = threading.local()
+
+
+def state_db() -> sqlite3.Connection:
+    conn = getattr(_state_local, "conn", None)
+    if conn is None:
+        conn = sqlite3.connect(STATE_DB_PATH, timeout=10, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.executescript(STATE_SCHEMA)
+        _state_local.conn = conn
+    return conn
+
+
+# ───────────────────────────────────────────────
+# 📒 רישום jobs מקומי: job_id → משתמש, audio_id, מצב טוקן ואורך אודיו.
+# נכתב בשליחה (וב-update-job); עיבוד הסיום רץ פעם אחת, ו-polls מאוחרים יותר מוגשים מכאן.
+def register_job(
+    job_id: str,
+    user_email: str | None = None,
+    using_fallback: bool | None = None,
+    audio_id: str | None = None,
+    audio_length: float | None = None,
+    cache_key: str | None = None,
+):
+    """יוצר או משלים רשומה – ערכים שלא נמסרו (None) לא דורסים ערכים קיימים."""
+    state_db().execute(
+        "INSERT INTO job_registry (job_id, user_email, using_fallback, audio_id, audio_length, cache_key, created_at) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?) "
+        "ON CONFLICT(job_id) DO UPDATE SET "
+        "user_email = COALESCE(excluded.user_email, user_email), "
+        "using_fallback = COALESCE(excluded.using_fallback, using_fallback), "
+        "audio_id = COALESCE(excluded.audio_id, audio_id), "
+        "audio_length = COALESCE(excluded.audio_length, audio_length), "
+        "cache_key = COALESCE(excluded.cache_key, cache_key)",
+        (job_id, user_email, None if using_fallback is None else int(using_fallback),
+         audio_id, audio_length, cache_key, time.time()),
+    )
+
+
+def rename_registered_job(old_id: str, new_id: str):
+    """כרטיס תור שנשלח: הרשומה עוברת ל-job_id האמיתי."""
+    state_db().execute("UPDATE OR REPLACE job_registry SET job_id = ? WHERE job_id = ?", (new_id, old_id))
+
+
+def registered_job(job_id: str) -> sqlite3.Row | None:
+    return state_db().execute("SELECT * FROM job_registry WHERE job_id = ?", (job_id,)).fetchone()
+
+
+def registered_result(job: sqlite3.Row | None) -> dict | None:
+    if job is None or job["result"] is None:
+        return None
+    return json.loads(zlib.decompress(job["result"]))
+
+
+def complete_registered_job(job_id: str, out: dict, keep_result: bool = True):
+    now = time.time()
+    usage = out.get("_usage")
+    result = zlib.compress(json.dumps(out, ensure_ascii=False).encode("utf-8"), 6) if keep_result else None
+    db = state_db()
+    db.execute(
+        "INSERT INTO job_registry (job_id, status, usage, result, created_at, completed_at) "
+        "VALUES (?, 'COMPLETED', ?, ?, ?, ?) "
+        "ON CONFLICT(job_id) DO UPDATE SET status = 'COMPLETED', usage = excluded.usage, "
+        "result = excluded.result, completed_at = excluded.completed_at",
+        (job_id, json.dumps(usage) if usage else None, result, now, now),
+    )
+    db.execute("DELETE FROM job_registry WHERE created_at < ?", (now - JOB_REGISTRY_TTL_SECONDS,))
+
+
 # 🧩 פענוח AES (לטוקן אישי בלבד)
 def decrypt_token(encrypted_token: str) -> str | None:
     try:
@@ -62,11 +1283,29 @@ def decrypt_token(encrypted_token: str) -> str | None:
         decrypted = unpad(cipher.decrypt(ciphertext), AES.block_size)
         return decrypted.decode("utf-8")
     except Exception as e:
-        print(f"❌ שגיאה בפענוח טוקן: {e}")
+        log.error("❌ שגיאה בפענוח טוקן: %s", e)
         return None
 
-# 🔎 שליפת חשבון
+# 🔐 פענוח עם מטמון – מפענח מחדש רק אם הטוקן המוצפן השתנה
+def decrypt_user_token(user_email: str, encrypted_token: str) -> str | None:
+    cached = _token_cache.get(user_email)
+    if cached and cached[0] == encrypted_token:
+        return cached[1]
+    token = decrypt_token(encrypted_token)
+    if token:
+        _token_cache.set(user_email, (encrypted_token, token))
+    return token
+
+# 🔎 שליפת חשבון (דרך המטמון)
 def get_account(user_email: str):
+    cached = _account_cache.get(user_email, TTLCache._MISSING)
+    if cached is not TTLCache._MISSING:
+        return cached
+    row = _fetch_account(user_email)
+    _account_cache.set(user_email, row)
+    return row
+
+def _fetch_account(user_email: str):
     res = (
         supabase.table("accounts")
         .select("user_email, runpod_token_encrypted, used_credits, limit_credits")
@@ -89,7 +1328,7 @@ def get_user_token(user_email: str | None) -> tuple[str | None, bool]:
 
         # טוקן אישי
         if enc:
-            token = decrypt_token(enc)
+            token = decrypt_user_token(user_email, enc)
             if token:
                 return token, False  
 
@@ -99,7 +1338,7 @@ def get_user_token(user_email: str | None) -> tuple[str | None, bool]:
 
         return None, True
     except Exception as e:
-        print(f"❌ שגיאה בשליפת טוקן: {e}")
+        log.error("❌ שגיאה בשליפת טוקן: %s", e)
         return (RUNPOD_API_KEY if RUNPOD_API_KEY else None), True
 
 # בדיקת מגבלת fallback
@@ -112,457 +1351,2913 @@ def check_fallback_allowance(user_email: str) -> tuple[bool, float, float]:
             "limit_credits": FALLBACK_LIMIT_DEFAULT,
         }
         supabase.table("accounts").insert(payload).execute()
+        invalidate_account(user_email)
         return True, 0.0, FALLBACK_LIMIT_DEFAULT
 
     used = float(row.get("used_credits") or 0.0)
     limit = float(row.get("limit_credits") or FALLBACK_LIMIT_DEFAULT)
     return (used < limit), used, limit
 
-# עדכון שימוש fallback
+# עדכון שימוש fallback (קריאה-שינוי-כתיבה, לא אטומי – משמש רק אם ה-RPC של ה-ledger חסר)
 def add_fallback_usage(user_email: str, amount_usd: float):
     row = get_account(user_email)
     used = float((row or {}).get("used_credits") or 0.0)
     new_used = round(used + amount_usd, 6)
     supabase.table("accounts").update({"used_credits": new_used}).eq("user_email", user_email).execute()
+    invalidate_account(user_email)
     return new_used
 
-# הערכת עלות מ-executionTime
-def estimate_cost_from_response(resp_json: dict) -> float:
+# 📒 ledger חיובים – חיוב אחד לכל job_id, כתוספת אטומית ב-DB
+def get_billed_job(job_id: str) -> sqlite3.Row | None:
+    """אינדקס מקומי של jobs שכבר חויבו – בלי פנייה ל-DB."""
+    return state_db().execute(
+        "SELECT * FROM billed_jobs WHERE job_id = ?", (job_id,)
+    ).fetchone()
+
+
+def charge_fallback_job(job_id: str, user_email: str, amount_usd: float) -> tuple[bool, float]:
+    """
+    מחייב את ה-job פעם אחת בלבד. מחזיר (האם חויב עכשיו, used_credits אחרי החיוב).
+
+    הפונקציה charge_fallback_job ב-DB (sql/credit_ledger.sql) רושמת את ה-job ב-credit_ledger
+    ומגדילה את used_credits באותה טרנזקציה – כך שגם polls מקבילים משרתים שונים
+    לא יחייבו פעמיים.
+
+    חיוב ישיר (בלי ledger) רק כשהפונקציה לא קיימת ב-DB. כל שגיאה אחרת (timeout, 5xx) נזרקת:
+    ייתכן שהטרנזקציה כבר עברה, וחיוב ישיר היה מחייב פעמיים. ה-job נשאר לא מחויב,
+    וה-poll הבא מנסה שוב (ה-ledger מונע כפל).
+    """
     try:
-        ms = 0
-        if "executionTime" in resp_json:
-            ms = resp_json.get("executionTime") or 0
-        if not ms and isinstance(resp_json.get("output"), dict):
-            ms = resp_json["output"].get("executionTime") or 0
-        if not ms and isinstance(resp_json.get("output"), list) and resp_json["output"]:
-            first = resp_json["output"][0]
-            ms = first.get("executionTime") or 0
+        res = supabase.rpc(
+            "charge_fallback_job",
+            {"p_job_id": job_id, "p_user_email": user_email, "p_amount": amount_usd},
+        ).execute()
+        data = res.data[0] if isinstance(res.data, list) and res.data else (res.data or {})
+        charged = bool(data.get("charged"))
+        new_used = float(data.get("total_used") or 0.0)
+    except APIError as e:
+        if str(e.code) not in ("PGRST202", "404"):
+            raise
+        log.warning("⚠️ הפונקציה charge_fallback_job לא קיימת ב-DB – חיוב ישיר עם הגנת אינדקס מקומי בלבד")
+        charged, new_used = True, add_fallback_usage(user_email, amount_usd)
+
+    state_db().execute(
+        "INSERT OR IGNORE INTO billed_jobs (job_id, user_email, amount_usd, used_credits, billed_at) "
+        "VALUES (?, ?, ?, ?, ?)",
+        (job_id, user_email, amount_usd, new_used, time.time()),
+    )
+    invalidate_account(user_email)
+    return charged, new_used
+
+
+# ───────────────────────────────────────────────
+# 🗄 write-behind לעדכוני transcriptions (TRANSCRIPTION_WRITE_BEHIND=1)
+class TranscriptionWriteBuffer:
+    """
+    עדכונים לטבלת transcriptions לפי id או audio_id.
+    כבוי – כל עדכון נשלח מיד, כמו קודם. מופעל – העדכונים מתמזגים בזיכרון לפי (עמודה, ערך),
+    ו-thread ברקע שולח אותם כל WRITE_BEHIND_FLUSH_SECONDS (או כשיש WRITE_BEHIND_MAX_PENDING רשומות)
+    בקריאה אחת ל-update_transcriptions (sql/transcriptions_bulk_update.sql).
+    עדכונים שעוד לא נכתבו מולבשים על תשובות /db/transcriptions/get (overlay).
+    עדכון שעוד בזיכרון אובד אם התהליך נופל לפני ה-flush (בכיבוי מסודר – נכתב).
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._pending: dict[tuple[str, str], dict] = {}
+        self._inflight: dict[tuple[str, str], dict] = {}
+        self._flush_lock = threading.Lock()   # flush אחד בכל רגע (thread הרקע או כיבוי)
+        self._thread: threading.Thread | None = None
+        self.stats = {"queued": 0, "merged": 0, "flushes": 0, "rows_written": 0, "errors": 0}
+
+    def __len__(self) -> int:
+        return len(self._pending) + len(self._inflight)
+
+    def start(self):
+        with self._cond:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="transcription-writes", daemon=True)
+                self._thread.start()
+
+    def update(self, column: str, value, updates: dict):
+        if not TRANSCRIPTION_WRITE_BEHIND:
+            supabase.table("transcriptions").update(updates).eq(column, value).execute()
+            return
+        self.start()
+        key = (column, str(value))
+        with self._cond:
+            if key in self._pending:
+                self._pending[key].update(updates)
+                self.stats["merged"] += 1
+            else:
+                self._pending[key] = dict(updates)
+                self.stats["queued"] += 1
+            if len(self._pending) >= WRITE_BEHIND_MAX_PENDING:
+                self._cond.notify()
+
+    def discard(self, column: str, value):
+        """לפני מחיקת רשומה – שעדכון ממתין לא ירוץ עליה."""
+        with self._cond:
+            self._pending.pop((column, str(value)), None)
+
+    def overlay(self, row: dict) -> dict:
+        """read-your-writes: הרשומה מה-DB + עדכונים שעוד לא נכתבו (של ה-audio_id ושל ה-id)."""
+        with self._cond:
+            for key in (("audio_id", str(row.get("audio_id"))), ("id", str(row.get("id")))):
+                for layer in (self._inflight, self._pending):
+                    if key in layer:
+                        row = {**row, **layer[key]}
+        return row
+
+    def flush(self):
+        with self._flush_lock:
+            self._flush()
+
+    def _flush(self):
+        with self._cond:
+            if not self._pending:
+                return
+            self._inflight, self._pending = self._pending, {}
+        batch = self._inflight
+        try:
+            res = supabase.rpc("update_transcriptions", {"p_updates": [
+                {"column": column, "value": value, "set": updates}
+                for (column, value), updates in batch.items()
+            ]}).execute()
+            self.stats["rows_written"] += int(res.data or 0)
+            transcription_flushes_total.inc(result="bulk")
+        except Exception as e:
+            # בלי הפונקציה ב-DB (או כשהקריאה נכשלה) – עדכון לכל מפתח; מפתח שנכשל לא חוסם את האחרים
+            log.warning("⚠️ update_transcriptions RPC נכשל (%s) – עדכון נפרד ל-%s רשומות", e, len(batch))
+            transcription_flushes_total.inc(result="fallback")
+            for (column, value), updates in batch.items():
+                try:
+                    res = supabase.table("transcriptions").update(updates).eq(column, value).execute()
+                    self.stats["rows_written"] += len(res.data or [])
+                except Exception as e:
+                    self.stats["errors"] += 1
+                    transcription_flushes_total.inc(result="error")
+                    log.error("❌ עדכון transcriptions (%s=%s) נכשל: %s", column, value, e)
+        finally:
+            with self._cond:
+                self._inflight = {}
+            self.stats["flushes"] += 1
+
+    def _run(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: len(self._pending) >= WRITE_BEHIND_MAX_PENDING, WRITE_BEHIND_FLUSH_SECONDS)
+            try:
+                self.flush()
+            except Exception as e:
+                log.error("❌ transcription write-behind: %s", e)
+
+
+transcription_writes = TranscriptionWriteBuffer()
+
+
+@app.on_event("startup")
+def start_transcription_writes():
+    if TRANSCRIPTION_WRITE_BEHIND:
+        transcription_writes.start()
+
+
+@app.on_event("shutdown")
+def flush_transcription_writes():
+    transcription_writes.flush()
+
+
+def token_key(token: str) -> str:
+    """מפתח למטמונים לפי טוקן – לא שומרים את הטוקן עצמו בזיכרון כמפתח."""
+    return hashlib.sha256(token.encode("utf-8")).hexdigest()[:16]
+
+# הערכת עלות מ-executionTime
+def estimate_cost_from_response(resp_json: dict) -> float:
+    try:
+        ms = 0
+        if "executionTime" in resp_json:
+            ms = resp_json.get("executionTime") or 0
+        if not ms and isinstance(resp_json.get("output"), dict):
+            ms = resp_json["output"].get("executionTime") or 0
+        if not ms and isinstance(resp_json.get("output"), list) and resp_json["output"]:
+            first = resp_json["output"][0]
+            ms = first.get("executionTime") or 0
+
+        seconds = float(ms) / 1000.0
+        cost = seconds * RUNPOD_RATE_PER_SEC
+
+        if cost > 0:
+            log.debug("⏱ זמן עיבוד כולל: %.2f שניות → עלות מוערכת: %.8f$", seconds, cost)
+        else:
+            log.warning("⚠️ זמן עיבוד לא זוהה בתגובה של RunPod: %s", resp_json.keys())
+
+        return round(cost, 8)
+    except Exception as e:
+        log.error("❌ שגיאה ב-estimate_cost_from_response: %s", e)
+        return 0.0
+
+# שליפת יתרה אמיתית מ-RunPod
+async def get_real_runpod_balance(token: str) -> tuple[float, bool]:
+    try:
+        payload = {
+            "query": "{ myself { clientBalance hostBalance } }"
+        }
+        r = await upstream_request(
+            "graphql",
+            "POST",
+            RUNPOD_GRAPHQL_URL,
+            headers={
+                "Authorization": f"Bearer {token}",
+                "Content-Type": "application/json",
+            },
+            json=payload,
+        )
+
+        if not r.is_success:
+            log.error("❌ GraphQL account fetch failed: status=%s, body=%s", r.status_code, r.text)
+            return 0.0, False
+
+        data = r.json() or {}
+        if "errors" in data:
+            log.error("❌ GraphQL errors: %s", data["errors"])
+            return 0.0, False
+
+        myself = (data.get("data") or {}).get("myself") or None
+        if not myself or "clientBalance" not in myself:
+            log.error("❌ GraphQL response missing clientBalance: %s", data)
+            return 0.0, False
+
+        bal = float(myself.get("clientBalance", 0.0))
+        return bal, True
+    except Exception as e:
+        log.error("❌ Error parsing GraphQL balance: %s", e)
+        return 0.0, False
+
+
+class BalanceCache:
+    """
+    יתרות RunPod לפי טוקן, ב-stale-while-revalidate:
+    - עד BALANCE_CACHE_TTL שניות מהשליפה – מוגש מהזיכרון.
+    - עד BALANCE_STALE_SECONDS – מוגש מהזיכרון, ורענון אחד (GraphQL) יוצא ברקע.
+    - מעבר לזה (או טוקן שלא נראה) – שליפה לפני התשובה; בקשות מקבילות חולקות אותה.
+    בין רענונים היתרה יורדת מקומית בעלות של jobs שהסתיימו (spend).
+    """
+
+    def __init__(self, ttl: float, max_stale: float, maxsize: int):
+        self.ttl = ttl
+        self.max_stale = max_stale
+        self.maxsize = maxsize
+        self._entries: OrderedDict[str, dict] = OrderedDict()
+        self._lock = threading.Lock()
+        self._flights = SingleFlight()
+        self._background: set[asyncio.Task] = set()
+
+    async def get(self, token: str) -> tuple[float, bool]:
+        """(יתרה משוערת, האם הטוקן תקין) – כמו get_real_runpod_balance."""
+        key = token_key(token)
+        with self._lock:
+            entry = self._entries.get(key)
+            age = time.monotonic() - entry["fetched_at"] if entry else None
+            estimate = entry["balance"] - entry["spent"] if entry else 0.0
+
+        if age is None or age > self.max_stale:
+            balance_lookups_total.inc(result="miss")
+            return await self._flights.do(key, lambda: self._refresh(key, token))
+        if age > self.ttl:
+            balance_lookups_total.inc(result="stale")
+            task = asyncio.ensure_future(self._flights.do(key, lambda: self._refresh(key, token)))
+            self._background.add(task)
+            task.add_done_callback(self._background.discard)
+        else:
+            balance_lookups_total.inc(result="fresh")
+        return round(estimate, 8), True
+
+    async def _refresh(self, key: str, token: str) -> tuple[float, bool]:
+        with self._lock:
+            entry = self._entries.get(key)
+            spent_before = entry["spent"] if entry else 0.0
+
+        balance, valid = await get_real_runpod_balance(token)
+
+        with self._lock:
+            if not valid:
+                # טוקן שנפסל – השליפה הבאה תגיע ל-RunPod ול-fallback של /effective-balance
+                self._entries.pop(key, None)
+                return 0.0, False
+            entry = self._entries.get(key)
+            # jobs שהסתיימו בזמן השליפה אולי עוד לא נכללים ביתרה של RunPod
+            spent = max(entry["spent"] - spent_before, 0.0) if entry else 0.0
+            self._set(key, balance, spent)
+        return round(balance - spent, 8), True
+
+    def _set(self, key: str, balance: float, spent: float = 0.0):
+        self._entries[key] = {"balance": balance, "spent": spent, "fetched_at": time.monotonic()}
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def put(self, token: str, balance: float):
+        """יתרה שכבר נשלפה (למשל באימות טוקן ב-/save-token)."""
+        with self._lock:
+            self._set(token_key(token), balance)
+
+    def spend(self, token: str, amount_usd: float):
+        """מוריד מקומית עלות של job שהסתיים; טוקן שאינו במטמון – יישלף מחדש ממילא."""
+        with self._lock:
+            entry = self._entries.get(token_key(token))
+            if entry is not None:
+                entry["spent"] += amount_usd
+
+
+balance_cache = BalanceCache(BALANCE_CACHE_TTL, BALANCE_STALE_SECONDS, ACCOUNT_CACHE_SIZE)
+# ───────────────────────────────────────────────
+class UploadTooLarge(Exception):
+    """גוף ההעלאה חרג מ-MAX_UPLOAD_BYTES."""
+
+
+class _UploadSink:
+    """
+    כותב קובץ נכנס לדיסק בחלקים (לקובץ זמני באותה תיקייה),
+    סופר בתים ומחשב SHA-256 תוך כדי – בלי להחזיק את הקובץ בזיכרון.
+    write() רק סופר ואוסף; הגיבוב והכתיבה לדיסק נעשים ב-flush(), ב-threadpool,
+    כל UPLOAD_CHUNK_SIZE – כמה העלאות גדולות במקביל לא חוסמות את ה-event loop.
+    """
+
+    def __init__(self, max_bytes: int | None = None):
+        fd, self.tmp_path = tempfile.mkstemp(prefix=".upload_", dir=UPLOAD_DIR)
+        self._f = os.fdopen(fd, "wb")
+        self._hash = hashlib.sha256()
+        self._buffer: list[bytes] = []
+        self._buffered = 0
+        self.max_bytes = max_bytes or MAX_UPLOAD_BYTES
+        self.size = 0
+
+    def write(self, data: bytes):
+        if not data:
+            return
+        self.size += len(data)
+        if self.size > self.max_bytes:
+            raise UploadTooLarge(f"הקובץ חורג מהגודל המרבי ({self.max_bytes} בתים)")
+        self._buffer.append(data)
+        self._buffered += len(data)
+
+    def _write_out(self, chunks: list[bytes]):
+        for chunk in chunks:
+            self._hash.update(chunk)
+            self._f.write(chunk)
+
+    async def flush(self, force: bool = False):
+        """כותב את מה שנאסף – כשהצטבר UPLOAD_CHUNK_SIZE, או הכול עם force (לפני close)."""
+        if self._buffered and (force or self._buffered >= UPLOAD_CHUNK_SIZE):
+            chunks, self._buffer, self._buffered = self._buffer, [], 0
+            await run_in_threadpool(self._write_out, chunks)
+
+    @property
+    def sha256(self) -> str:
+        return self._hash.hexdigest()
+
+    def close(self):
+        self._f.close()
+
+    def discard(self):
+        try:
+            self._f.close()
+        finally:
+            if os.path.exists(self.tmp_path):
+                os.remove(self.tmp_path)
+
+
+async def _stream_multipart_to_sink(request: Request, sink: _UploadSink) -> str | None:
+    """
+    מפענח multipart/form-data תוך כדי קבלה וכותב את חלק הקובץ (שדה file) ל-sink.
+    מחזיר את שם הקובץ המקורי, או None אם לא נמצא שדה קובץ.
+    """
+    _, params = parse_options_header(request.headers.get("content-type", ""))
+    boundary = params.get(b"boundary")
+    if not boundary:
+        return None
+
+    state = {"field": b"", "value": b"", "disposition": b"", "active": False, "filename": None}
+
+    def on_part_begin():
+        state["disposition"] = b""
+
+    def on_header_field(data, start, end):
+        state["field"] += data[start:end]
+
+    def on_header_value(data, start, end):
+        state["value"] += data[start:end]
+
+    def on_header_end():
+        if state["field"].lower() == b"content-disposition":
+            state["disposition"] = state["value"]
+        state["field"], state["value"] = b"", b""
+
+    def on_headers_finished():
+        _, opts = parse_options_header(state["disposition"])
+        is_file = opts.get(b"name") == b"file" and b"filename" in opts
+        state["active"] = is_file and state["filename"] is None
+        if state["active"]:
+            state["filename"] = opts[b"filename"].decode("utf-8", "replace")
+
+    def on_part_data(data, start, end):
+        if state["active"]:
+            sink.write(data[start:end])
+
+    def on_part_end():
+        state["active"] = False
+
+    parser = MultipartParser(boundary, {
+        "on_part_begin": on_part_begin,
+        "on_header_field": on_header_field,
+        "on_header_value": on_header_value,
+        "on_header_end": on_header_end,
+        "on_headers_finished": on_headers_finished,
+        "on_part_data": on_part_data,
+        "on_part_end": on_part_end,
+    })
+    async for chunk in request.stream():
+        parser.write(chunk)
+        await sink.flush()
+    parser.finalize()
+    return state["filename"]
+
+
+@app.post("/upload")
+async def upload_file(request: Request):
+    """
+    מקבל קובץ מהקליינט, שומר זמנית בשרת ומחזיר URL גישה.
+    הקובץ נשמר לפי ה-SHA-256 של תוכנו – העלאה חוזרת של אותו תוכן לא נשמרת פעמיים
+    (אפשר גם לבדוק מראש ב-/files/by-hash/{sha256}).
+
+    הגוף נכתב לדיסק בחלקים תוך כדי קבלה (multipart עם שדה file, או גוף בינארי גולמי),
+    כך שצריכת הזיכרון קבועה ללא תלות בגודל הקובץ.
+    גוף גדול מ-MAX_UPLOAD_BYTES נדחה עם 413 – מראש לפי Content-Length, או ברגע שחרג.
+    """
+    content_type = request.headers.get("content-type", "")
+    limit = MAX_UPLOAD_BYTES + (MULTIPART_OVERHEAD_BYTES if content_type.startswith("multipart/form-data") else 0)
+    declared = request.headers.get("content-length")
+    if declared and declared.isdigit() and int(declared) > limit:
+        return JSONResponse(
+            {"error": "הקובץ גדול מהמותר.", "max_bytes": MAX_UPLOAD_BYTES},
+            status_code=413,
+        )
+
+    prewarm = prewarmer.signal("upload")
+    sink = _UploadSink()
+    try:
+        if content_type.startswith("multipart/form-data"):
+            filename = await _stream_multipart_to_sink(request, sink)
+        else:
+            async for chunk in request.stream():
+                sink.write(chunk)
+                await sink.flush()
+            filename = f"upload_{int(time.time())}.bin"
+        await sink.flush(force=True)
+
+        if not sink.size:
+            sink.discard()
+            return JSONResponse({"error": "לא התקבל קובץ תקין."}, status_code=400)
+
+        filename = os.path.basename(filename or "") or f"upload_{int(time.time())}.bin"
+        sink.close()
+        stored_name, deduplicated = await run_in_threadpool(
+            store_blob, sink.tmp_path, sink.sha256, sink.size, safe_ext(filename)
+        )
+        media = await run_in_threadpool(media_info, sink.sha256, os.path.join(UPLOAD_DIR, stored_name))
+        normalized = None
+        if normalize_requested(request):
+            normalized = await normalize_stored(sink.sha256, os.path.join(UPLOAD_DIR, stored_name))
+        url = file_url(normalized["filename"] if normalized else stored_name)
+        prewarmer.bind(prewarm, url, file_url(stored_name))
+        return JSONResponse({
+            "url": url,
+            "original_url": file_url(stored_name),
+            "normalized": normalized_view(normalized),
+            "filename": filename,
+            "size_bytes": sink.size,
+            "sha256": sink.sha256,
+            "deduplicated": deduplicated,
+            "media": media,
+            "message": "הקובץ הועלה בהצלחה ויימחק תוך שעה.",
+        })
+    except UploadTooLarge as e:
+        sink.discard()
+        return JSONResponse({"error": str(e), "max_bytes": MAX_UPLOAD_BYTES}, status_code=413)
+    except FormParserError as e:
+        # גוף multipart פגום או חורג ממגבלות ה-parser (למשל כותרת חלק ארוכה מדי) – שגיאת לקוח
+        sink.discard()
+        return JSONResponse({"error": f"גוף multipart לא תקין: {str(e)}"}, status_code=400)
+    except Exception as e:
+        sink.discard()
+        return JSONResponse({"error": f"שגיאה בעת העלאת הקובץ: {str(e)}"}, status_code=500)
+
+
+class MediaFileResponse(FileResponse):
+    """
+    FileResponse עם חלקים גדולים לקבצי מדיה.
+    Range (כולל multi-range → 206), HEAD, ETag ו-Last-Modified מגיעים מ-Starlette;
+    בבקשה מלאה נשלח http.response.pathsend (zero-copy/sendfile) כששרת ה-ASGI תומך בו.
+    """
+
+    chunk_size = 1024 * 1024
+
+
+def _not_modified(request: Request, etag: str, last_modified: str) -> bool:
+    """בדיקת GET מותנה: If-None-Match (השוואה חלשה), ואם אין – If-Modified-Since."""
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match:
+        tags = [t.strip().removeprefix("W/") for t in if_none_match.split(",")]
+        return "*" in tags or etag.removeprefix("W/") in tags
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since:
+        try:
+            return parsedate_to_datetime(last_modified) <= parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
+    return False
+
+
+@app.api_route("/files/{filename}", methods=["GET", "HEAD"])
+async def get_file(filename: str, request: Request):
+    decoded_filename = os.path.basename(unquote(filename))
+    progressive = _progressive.get(decoded_filename)
+    if progressive and not progressive.done:
+        return serve_progressive(progressive, request)
+    file_path = os.path.join(UPLOAD_DIR, decoded_filename)
+    if os.path.isfile(file_path):
+        response = MediaFileResponse(
+            file_path,
+            stat_result=os.stat(file_path),
+            headers={"Cache-Control": "private, max-age=3600"},
+        )
+        etag, last_modified = response.headers["etag"], response.headers["last-modified"]
+        if _not_modified(request, etag, last_modified):
+            return Response(status_code=304, headers={
+                "ETag": etag,
+                "Last-Modified": last_modified,
+                "Cache-Control": response.headers["cache-control"],
+            })
+        return response
+    return JSONResponse({"error": "הקובץ נמחק או לא נמצא."}, status_code=404)
+
+
+# ───────────────────────────────────────────────
+# 🎛 נרמול (opt-in): ערוץ האודיו בלבד, 16kHz מונו ב-Opus/FLAC – מה ש-Whisper צריך.
+#    וידאו או WAV של 48kHz קטנים פי כמה, וה-worker מוריד ומפענח פחות.
+_NORMALIZE_CODECS = {
+    "opus": (".opus", ["-c:a", "libopus", "-b:a", NORMALIZE_OPUS_BITRATE, "-application", "voip"]),
+    "flac": (".flac", ["-c:a", "flac"]),
+}
+_normalize_slots = threading.BoundedSemaphore(NORMALIZE_CONCURRENCY)   # תהליכי ffmpeg במקביל
+_normalize_locks = KeyedLocks()   # מקור אחד מומר פעם אחת, גם בבקשות מקבילות
+normalize_stats = {"converted": 0, "reused": 0, "skipped": 0, "failed": 0, "bytes_saved": 0}
+
+
+def normalized_blob(digest: str, fmt: str = NORMALIZE_FORMAT) -> dict | None:
+    """הגרסה המנורמלת של blob אם כבר הומר והקובץ עוד קיים ({"filename", "size_bytes"})."""
+    row = state_db().execute(
+        "SELECT filename, size_bytes FROM normalized_audio WHERE source_sha256 = ? AND format = ?", (digest, fmt)
+    ).fetchone()
+    if row and row["filename"] and os.path.isfile(os.path.join(UPLOAD_DIR, row["filename"])):
+        return dict(row)
+    return None
+
+
+def transcode_audio(digest: str, path: str, fmt: str = NORMALIZE_FORMAT) -> dict | None:
+    """
+    ממיר לקובץ 16kHz מונו ושומר באחסון לפי תוכן. None אם אין טעם (כבר 16kHz מונו,
+    או שהתוצאה לא קטנה מהמקור) או ש-ffmpeg נכשל – התשובה נשמרת, כך שמקור לא נבדק פעמיים.
+    """
+    existing = normalized_blob(digest, fmt)
+    if existing:
+        delete_later(os.path.join(UPLOAD_DIR, existing["filename"]))
+        normalize_stats["reused"] += 1
+        return existing
+    if state_db().execute(
+        "SELECT 1 FROM normalized_audio WHERE source_sha256 = ? AND format = ? AND filename IS NULL", (digest, fmt)
+    ).fetchone():
+        return None
+
+    def remember(filename: str | None, size: int | None):
+        state_db().execute(
+            "INSERT OR REPLACE INTO normalized_audio (source_sha256, format, filename, size_bytes, created_at) "
+            "VALUES (?, ?, ?, ?, ?)",
+            (digest, fmt, filename, size, time.time()),
+        )
+
+    media = media_info(digest, path)
+    if media and media["sample_rate"] and media["sample_rate"] <= 16000 and media["channels"] == 1:
+        normalize_stats["skipped"] += 1
+        remember(None, None)
+        return None
+
+    ext, codec_args = _NORMALIZE_CODECS[fmt]
+    fd, tmp_path = tempfile.mkstemp(prefix=".norm_", suffix=ext, dir=UPLOAD_DIR)
+    os.close(fd)
+    try:
+        with _normalize_slots:
+            subprocess.run(
+                [FFMPEG_BIN, "-hide_banner", "-loglevel", "error", "-y", "-i", path,
+                 "-map", "0:a:0", "-vn", "-ac", "1", "-ar", "16000", "-threads", "1", *codec_args, tmp_path],
+                capture_output=True, check=True,
+            )
+        size, source_size = os.path.getsize(tmp_path), os.path.getsize(path)
+        if not size or size >= source_size:
+            os.remove(tmp_path)
+            normalize_stats["skipped"] += 1
+            remember(None, None)
+            return None
+        normalized_digest = hash_file(tmp_path)
+        filename, _ = store_blob(tmp_path, normalized_digest, size, ext)
+        media_info(normalized_digest, os.path.join(UPLOAD_DIR, filename))
+    except (subprocess.CalledProcessError, FileNotFoundError) as e:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        normalize_stats["failed"] += 1
+        stderr = getattr(e, "stderr", b"") or b""
+        log.warning("⚠️ נרמול %s נכשל: %s", digest[:12], stderr.decode("utf-8", "replace").strip()[-300:] or e)
+        if isinstance(e, subprocess.CalledProcessError):
+            remember(None, None)   # ffmpeg לא הצליח לקרוא את המקור (למשל אין ערוץ אודיו)
+        return None
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+    remember(filename, size)
+    normalize_stats["converted"] += 1
+    normalize_stats["bytes_saved"] += source_size - size
+    log.info("🎛 %s נורמל: %s → %s בתים (%s)", digest[:12], source_size, size, filename)
+    return {"filename": filename, "size_bytes": size}
+
+
+async def normalize_stored(digest: str, path: str) -> dict | None:
+    """עטיפה אסינכרונית: המרה אחת לכל מקור, עד NORMALIZE_CONCURRENCY תהליכי ffmpeg במקביל."""
+    async with _normalize_locks(digest):
+        return await run_in_threadpool(transcode_audio, digest, path)
+
+
+def normalized_view(normalized: dict | None) -> dict | None:
+    if not normalized:
+        return None
+    return {"url": file_url(normalized["filename"]), "format": NORMALIZE_FORMAT, "size_bytes": normalized["size_bytes"]}
+
+
+def normalize_requested(request: Request) -> bool:
+    value = request.query_params.get("normalize")
+    return NORMALIZE_AUDIO if value is None else value.lower() in ("1", "true", "yes")
+
+
+def prefer_normalized(run_body: dict) -> dict:
+    """/transcribe על קובץ מהשרת שיש לו גרסה מנורמלת – ה-worker מקבל את הקובץ הקטן."""
+    run_input = run_body.get("input")
+    if not isinstance(run_input, dict):
+        return run_body
+    digest = audio_hash_from_url((run_input.get("transcribe_args") or {}).get("url") or run_input.get("url"))
+    small = normalized_blob(digest) if digest else None
+    if not small:
+        return run_body
+    delete_later(os.path.join(UPLOAD_DIR, small["filename"]))
+    return {**run_body, "input": _with_url(run_input, file_url(small["filename"]))}
+
+
+@app.get("/normalize/stats")
+def normalize_stats_endpoint():
+    return JSONResponse({
+        "enabled_by_default": NORMALIZE_AUDIO,
+        "format": NORMALIZE_FORMAT,
+        "concurrency": NORMALIZE_CONCURRENCY,
+        **normalize_stats,
+    })
+
+
+# ───────────────────────────────────────────────
+# 📥 שליפת קובץ מדרייב לשרת (לתמלול)
+DRIVE_EXT_MAP = {
+    "audio/mp4": ".m4a",
+    "audio/x-m4a": ".m4a",
+    "audio/mpeg": ".mp3",
+    "audio/wav": ".wav",
+    "video/mp4": ".mp4",
+}
+_drive_locks = KeyedLocks()   # שתי בקשות לאותו file_id לא יורידו אותו פעמיים
+
+
+class DriveError(Exception):
+    def __init__(self, message: str, status_code: int):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+async def _drive_metadata(file_id: str, headers: dict) -> dict:
+    """מטא-דאטה מדרייב (גם מאמת שלמשתמש יש גישה לקובץ)."""
+    r = await upstream_request(
+        "drive",
+        "GET",
+        f"{DRIVE_API_URL}/files/{file_id}",
+        params={"fields": "id,name,mimeType,size,md5Checksum,modifiedTime", "supportsAllDrives": "true"},
+        headers=headers,
+    )
+    if not r.is_success:
+        raise DriveError(f"שגיאה בשליפת קובץ מדרייב: {r.text}", r.status_code)
+    return r.json()
+
+
+async def _download_range(url: str, headers: dict, fd: int, start: int, end: int) -> bool:
+    """מוריד בתים start..end (כולל) וכותב אותם במיקומם בקובץ. False אם השרת התעלם מה-Range."""
+    async with http_client("drive").stream("GET", url, headers={**headers, "Range": f"bytes={start}-{end}"}) as res:
+        if res.status_code != 206:
+            return False
+        offset = start
+        async for chunk in res.aiter_bytes(UPLOAD_CHUNK_SIZE):
+            os.pwrite(fd, chunk, offset)
+            offset += len(chunk)
+        return offset == end + 1
+
+
+async def _download_drive_file(file_id: str, headers: dict, file_path: str, size: int):
+    """
+    הורדה מדרייב לקובץ. קבצים גדולים מחולקים ל-DRIVE_DOWNLOAD_PARTS טווחים שיורדים במקביל;
+    אם טווח כלשהו נכשל – נופלים להורדה רציפה אחת.
+    """
+    url = f"{DRIVE_API_URL}/files/{file_id}?alt=media"
+    if size >= DRIVE_PARALLEL_MIN_BYTES and DRIVE_DOWNLOAD_PARTS > 1:
+        part = -(-size // DRIVE_DOWNLOAD_PARTS)
+        fd = os.open(file_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            os.ftruncate(fd, size)
+            results = await asyncio.gather(*(
+                _download_range(url, headers, fd, start, min(start + part, size) - 1)
+                for start in range(0, size, part)
+            ), return_exceptions=True)
+        finally:
+            os.close(fd)
+        if all(r is True for r in results):
+            return
+        log.warning("⚠️ הורדה מקבילית של %s נכשלה – מעבר להורדה רציפה", file_id)
+
+    async with http_client("drive").stream("GET", url, headers=headers) as res:
+        if not res.is_success:
+            body = (await res.aread()).decode("utf-8", "replace")
+            raise DriveError(f"שגיאה בשליפת קובץ מדרייב: {body}", res.status_code)
+        with open(file_path, "wb") as f:
+            async for chunk in res.aiter_bytes(UPLOAD_CHUNK_SIZE):
+                f.write(chunk)
+
+
+def _cached_drive_file(file_id: str, version: str) -> str | None:
+    """שם הקובץ השמור לגרסה הזו של file_id (ומאריך את חייו), או None."""
+    cached = state_db().execute(
+        "SELECT filename FROM drive_cache WHERE file_id = ? AND version = ?", (file_id, version)
+    ).fetchone()
+    if not (cached and version and os.path.isfile(os.path.join(UPLOAD_DIR, cached["filename"]))):
+        return None
+    delete_later(os.path.join(UPLOAD_DIR, cached["filename"]))
+    return cached["filename"]
+
+
+def _remember_drive_file(file_id: str, version: str, filename: str, content_type: str):
+    state_db().execute(
+        "INSERT OR REPLACE INTO drive_cache (file_id, version, filename, content_type, stored_at) "
+        "VALUES (?, ?, ?, ?, ?)",
+        (file_id, version, filename, content_type, time.time()),
+    )
+
+
+async def store_drive_file(
+    file_id: str, google_token: str, normalize: bool = NORMALIZE_AUDIO, stream: bool = False
+) -> dict:
+    """
+    מביא קובץ מדרייב לתיקיית ההעלאות ומחזיר {"url", ...}.
+    אם אותו file_id כבר הורד ותוכנו לא השתנה (md5Checksum / modifiedTime) – מחזיר את הקובץ הקיים.
+    normalize – גם גרסה מנורמלת (16kHz מונו), ו-"url" מצביע עליה.
+    stream – מחזיר כתובת מיד, וההורדה ממשיכה ברקע (ראו start_progressive_download).
+    """
+    prewarm = prewarmer.signal("drive")
+    stored = await _store_drive_file(file_id, google_token, normalize, stream)
+    prewarmer.bind(prewarm, stored["url"], stored["original_url"])
+    return stored
+
+
+async def _store_drive_file(file_id: str, google_token: str, normalize: bool, stream: bool) -> dict:
+    headers = {"Authorization": f"Bearer {google_token}"}
+    meta = await _drive_metadata(file_id, headers)
+    version = meta.get("md5Checksum") or meta.get("modifiedTime") or ""
+    content_type = meta.get("mimeType", "application/octet-stream")
+
+    async with _drive_locks(file_id):
+        cached = await run_in_threadpool(_cached_drive_file, file_id, version)
+        if cached:
+            log.info("♻️ קובץ מדרייב כבר קיים: %s", cached)
+            return await _stored_drive_response(cached, cached.split(".", 1)[0], True, normalize)
+
+        size = int(meta.get("size") or 0)
+        progressive = _progressive.get(progressive_name(file_id, version, content_type))
+        if stream and size:
+            progressive = progressive or start_progressive_download(
+                file_id, headers, version, content_type, size
+            )
+            return progressive.response()
+        if progressive:
+            # הורדה ב-stream של אותו קובץ כבר רצה – מחכים לה במקום להוריד שוב
+            await progressive.wait_done()
+            if progressive.error is None:
+                return await _stored_drive_response(progressive.blob, progressive.blob.split(".", 1)[0], True, normalize)
+
+        fd, tmp_path = tempfile.mkstemp(prefix=".drive_", dir=UPLOAD_DIR)
+        os.close(fd)
+        try:
+            await _download_drive_file(file_id, headers, tmp_path, size)
+            digest = await run_in_threadpool(hash_file, tmp_path)
+            filename, _ = await run_in_threadpool(
+                store_blob, tmp_path, digest, os.path.getsize(tmp_path),
+                DRIVE_EXT_MAP.get(content_type, ".audio"),
+            )
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+        await run_in_threadpool(_remember_drive_file, file_id, version, filename, content_type)
+    log.info("✅ נשמר קובץ מדרייב: %s (%s)", filename, content_type)
+    return await _stored_drive_response(filename, digest, False, normalize)
+
+
+async def _stored_drive_response(filename: str, digest: str, cached: bool, normalize: bool) -> dict:
+    path = os.path.join(UPLOAD_DIR, filename)
+    media = await run_in_threadpool(media_info, digest, path)
+    normalized = await normalize_stored(digest, path) if normalize else None
+    return {
+        "url": file_url(normalized["filename"] if normalized else filename),
+        "original_url": file_url(filename),
+        "normalized": normalized_view(normalized),
+        "sha256": digest,
+        "cached": cached,
+        "media": media,
+    }
+
+
+# ───────────────────────────────────────────────
+# 🌊 stream-through: הכתובת חוזרת מיד, ו-/files מגיש את הבתים תוך כדי ההורדה מדרייב.
+#    ההורדה רציפה (לא בטווחים מקבילים) כדי שהקובץ יתמלא מההתחלה; קורא שמבקש טווח
+#    שעוד לא הגיע ממתין לו. בסוף ההורדה הקובץ נכנס גם לאחסון לפי תוכן ול-drive_cache.
+_progressive: dict[str, "ProgressiveFile"] = {}
+_progressive_tasks: set[asyncio.Task] = set()
+
+
+class ProgressiveFile:
+    def __init__(self, filename: str, tmp_path: str, size: int, content_type: str):
+        self.filename = filename
+        self.path = tmp_path              # מתחלף לקובץ הסופי ברגע שההורדה הושלמה
+        self.size = size
+        self.content_type = content_type
+        self.available = 0                # כמה בתים מההתחלה כבר על הדיסק
+        self.done = False
+        self.error: Exception | None = None
+        self.blob: str | None = None      # שם הקובץ באחסון לפי תוכן (אחרי הסיום)
+        self._changed = asyncio.Event()
+
+    def _notify(self):
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    def advance(self, n: int):
+        self.available += n
+        self._notify()
+
+    def finish(self, error: Exception | None):
+        self.done, self.error = True, error
+        self._notify()
+
+    async def wait_for(self, offset: int) -> bool:
+        """ממתין עד שבית offset נכתב. False אם ההורדה נכשלה או לא התקדמה זמן רב מדי."""
+        while self.available <= offset:
+            if self.done:
+                return False
+            try:
+                await asyncio.wait_for(self._changed.wait(), UPSTREAM_TIMEOUTS["drive"])
+            except asyncio.TimeoutError:
+                return False
+        return True
+
+    async def wait_done(self):
+        while not self.done:
+            await self._changed.wait()
+
+    def response(self) -> dict:
+        return {
+            "url": file_url(self.filename),
+            "original_url": file_url(self.filename),
+            "normalized": None,
+            "sha256": None,
+            "cached": False,
+            "media": None,
+            "streaming": True,
+            "size_bytes": self.size,
+        }
+
+
+def progressive_name(file_id: str, version: str, content_type: str) -> str:
+    """שם קבוע לכל גרסה של קובץ בדרייב – ה-sha256 של התוכן עוד לא ידוע כשהכתובת חוזרת."""
+    key = hashlib.sha256(f"{file_id}:{version}".encode("utf-8")).hexdigest()[:32]
+    return f"drive-{key}{DRIVE_EXT_MAP.get(content_type, '.audio')}"
+
+
+def start_progressive_download(
+    file_id: str, headers: dict, version: str, content_type: str, size: int
+) -> ProgressiveFile:
+    fd, tmp_path = tempfile.mkstemp(prefix=".stream_", dir=UPLOAD_DIR)
+    os.close(fd)
+    progressive = ProgressiveFile(progressive_name(file_id, version, content_type), tmp_path, size, content_type)
+    _progressive[progressive.filename] = progressive
+    task = asyncio.create_task(_progressive_download(progressive, file_id, headers, version))
+    _progressive_tasks.add(task)
+    task.add_done_callback(_progressive_tasks.discard)
+    log.info("🌊 הורדת stream מדרייב התחילה: %s → %s", file_id, progressive.filename)
+    return progressive
+
+
+def _adopt_progressive(progressive: ProgressiveFile, file_id: str, version: str) -> str:
+    """מכניס קובץ שהורד ב-stream לאחסון לפי תוכן (קישור קשיח – בלי העתקה) ול-drive_cache."""
+    digest = hash_file(progressive.path)
+    link_path = os.path.join(UPLOAD_DIR, f".link_{uuid.uuid4().hex}")
+    try:
+        os.link(progressive.path, link_path)
+    except OSError:
+        shutil.copyfile(progressive.path, link_path)
+    ext = DRIVE_EXT_MAP.get(progressive.content_type, ".audio")
+    filename, _ = store_blob(link_path, digest, progressive.size, ext)
+    _remember_drive_file(file_id, version, filename, progressive.content_type)
+    media_info(digest, os.path.join(UPLOAD_DIR, filename))
+    return filename
+
+
+async def _progressive_download(progressive: ProgressiveFile, file_id: str, headers: dict, version: str):
+    tmp_path = progressive.path
+    error: Exception | None = DriveError("הורדת הקובץ מדרייב הופסקה", 503)
+    try:
+        url = f"{DRIVE_API_URL}/files/{file_id}?alt=media"
+        async with http_client("drive").stream("GET", url, headers=headers) as res:
+            if not res.is_success:
+                body = (await res.aread()).decode("utf-8", "replace")
+                raise DriveError(f"שגיאה בשליפת קובץ מדרייב: {body}", res.status_code)
+            with open(tmp_path, "wb") as f:
+                async for chunk in res.aiter_bytes(UPLOAD_CHUNK_SIZE):
+                    f.write(chunk)
+                    f.flush()   # הקוראים פותחים את הקובץ בנפרד
+                    progressive.advance(len(chunk))
+        if progressive.available != progressive.size:
+            raise DriveError(f"הורדה חלקית מדרייב: {progressive.available}/{progressive.size} בתים", 502)
+
+        final_path = os.path.join(UPLOAD_DIR, progressive.filename)
+        os.replace(tmp_path, final_path)
+        progressive.path = final_path
+        await run_in_threadpool(delete_later, final_path)
+        progressive.blob = await run_in_threadpool(_adopt_progressive, progressive, file_id, version)
+        error = None
+        log.info("✅ הורדת stream מדרייב הושלמה: %s (%s)", progressive.filename, progressive.blob)
+    except Exception as e:
+        error = e
+        log.warning("⚠️ הורדת stream מדרייב של %s נכשלה: %s", file_id, e)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        _progressive.pop(progressive.filename, None)
+        progressive.finish(error)
+
+
+def _requested_range(header: str | None, size: int) -> tuple[int, int] | None:
+    """טווח יחיד מ-Range (None = כל הקובץ; ריבוי טווחים מוגש כקובץ מלא). ValueError – טווח לא חוקי."""
+    if not header or not header.startswith("bytes=") or "," in header:
+        return None
+    start_s, _, end_s = header[6:].strip().partition("-")
+    if not start_s:
+        start, end = max(0, size - int(end_s)), size - 1
+    else:
+        start, end = int(start_s), min(int(end_s) if end_s else size - 1, size - 1)
+    if start > end:
+        raise ValueError(header)
+    return start, end
+
+
+async def _progressive_body(progressive: ProgressiveFile, fd: int, start: int, end: int):
+    try:
+        offset = start
+        while offset <= end:
+            if not await progressive.wait_for(offset):
+                log.warning("⚠️ %s: הנתונים מבית %d לא הגיעו מדרייב – החיבור נסגר", progressive.filename, offset)
+                return
+            chunk = os.pread(fd, min(progressive.available, end + 1, offset + UPLOAD_CHUNK_SIZE) - offset, offset)
+            if not chunk:
+                return
+            offset += len(chunk)
+            yield chunk
+    finally:
+        os.close(fd)
+
+
+def serve_progressive(progressive: ProgressiveFile, request: Request) -> Response:
+    """
+    /files לקובץ שעוד יורד: Content-Length ו-Content-Range לפי הגודל מדרייב,
+    והגוף נשלח כשהבתים מגיעים לדיסק.
+    """
+    size = progressive.size
+    try:
+        byte_range = _requested_range(request.headers.get("range"), size)
+    except ValueError:
+        return Response(status_code=416, headers={"Content-Range": f"bytes */{size}"})
+    start, end = byte_range or (0, size - 1)
+    headers = {"Accept-Ranges": "bytes", "Content-Length": str(end - start + 1), "Cache-Control": "no-store"}
+    if byte_range:
+        headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+    status_code = 206 if byte_range else 200
+    if request.method == "HEAD":
+        return Response(status_code=status_code, headers=headers, media_type=progressive.content_type)
+    # נפתח כבר כאן (לא בתוך ה-generator): ה-fd ממשיך לעבוד גם אחרי שהקובץ הזמני מקבל את שמו הסופי
+    fd = os.open(progressive.path, os.O_RDONLY)
+    return StreamingResponse(
+        _progressive_body(progressive, fd, start, end),
+        status_code=status_code,
+        headers=headers,
+        media_type=progressive.content_type,
+    )
+
+
+@app.get("/fetch-and-store-audio")
+async def fetch_and_store_audio(request: Request, file_id: str):
+    """
+    שולף קובץ מדרייב, שומר זמנית, מחזיר URL.
+    תומך ב-Authorization header עם Bearer token.
+    stream=1 – הכתובת חוזרת מיד וההורדה ממשיכה ברקע (ברירת מחדל: DRIVE_STREAM_THROUGH).
+    """
+    try:
+        auth_header = request.headers.get("Authorization")
+        if not auth_header or not auth_header.startswith("Bearer "):
+            return JSONResponse({"error": "חסר access token של Google"}, status_code=400)
+
+        token = auth_header.split("Bearer ")[1]
+        stream = request.query_params.get("stream")
+        stream = DRIVE_STREAM_THROUGH if stream is None else stream.lower() in ("1", "true", "yes")
+        return JSONResponse(await store_drive_file(file_id, token, normalize_requested(request), stream))
+
+    except DriveError as e:
+        return JSONResponse({"error": str(e)}, status_code=e.status_code)
+    except Exception as e:
+        log.error("❌ /fetch-and-store-audio error: %s", e)
+        return JSONResponse({"error": str(e)}, status_code=500)
+
+
+# ───────────────────────────────────────────────
+# 🎯 בניית גוף הבקשה ל-RunPod
+def build_run_body(data: dict) -> dict:
+    """הגוף כפי שנשלח, או – אם נשלח רק file_url – בקשת ברירת המחדל (ivrit-ai, עברית, דיאריזציה)."""
+    if "input" not in data and data.get("file_url"):
+        return {
+            "input": {
+                "engine": "stable-whisper",
+                "model": "ivrit-ai/whisper-large-v3-turbo-ct2",
+                "transcribe_args": {
+                    "url": data["file_url"],
+                    "language": "he",
+                    "diarize": True,
+                    "vad": True,
+                    "word_timestamps": True,
+                },
+            }
+        }
+    return data
+
+
+# ───────────────────────────────────────────────
+# ♻️ מטמון תוצאות תמלול – לפי hash של האודיו + פרמטרי תמלול מנורמלים
+_SHA256_RE = re.compile(r"^[0-9a-f]{64}$")
+CACHED_JOB_PREFIX = "cached-"
+
+
+def audio_hash_from_url(url: str | None) -> str | None:
+    """ה-SHA-256 של קובץ מהאחסון שלנו (/files/<sha256>.<ext>), או None לכתובת חיצונית."""
+    prefix = f"{BASE_URL}/files/"
+    if not url or not url.startswith(prefix):
+        return None
+    stem = unquote(url[len(prefix):]).split(".", 1)[0]
+    return stem if _SHA256_RE.match(stem) else None
+
+
+def audio_hash_for_input(run_input: dict | None) -> str | None:
+    """
+    ה-SHA-256 של האודיו של בקשת תמלול – רק לקובץ מהאחסון שלנו.
+    hash שהקליינט שולח לא נלקח בחשבון: כתובת חיצונית יכולה להכיל כל תוכן.
+    """
+    if not isinstance(run_input, dict):
+        return None
+    url = (run_input.get("transcribe_args") or {}).get("url") or run_input.get("url")
+    return audio_hash_from_url(url)
+
+
+def _normalize_args(value):
+    if isinstance(value, dict):
+        return {k: _normalize_args(v) for k, v in sorted(value.items()) if v is not None}
+    if isinstance(value, list):
+        return [_normalize_args(v) for v in value]
+    return value
+
+
+class ResultCache:
+    """
+    תוצאות (output) של jobs שהושלמו, ב-state.db ודחוסות ב-zlib.
+    חסום ב-RESULT_CACHE_MAX_BYTES; בחריגה נמחקות התוצאות שלא נוצלו הכי הרבה זמן.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "stores": 0, "evictions": 0}
+
+    @staticmethod
+    def key_for(run_input: dict | None) -> str | None:
+        """מפתח המטמון, או None אם האודיו אינו blob שנמצא אצלנו (סינכרוני – ניגש ל-state.db)."""
+        audio = audio_hash_for_input(run_input)
+        if not audio or not find_blob(audio):
+            return None
+        args = dict(run_input.get("transcribe_args") or {})
+        args.pop("url", None)
+        rest = {k: v for k, v in run_input.items() if k not in ("transcribe_args", "url")}
+        canonical = json.dumps(
+            _normalize_args({**rest, "transcribe_args": args}), sort_keys=True, separators=(",", ":")
+        )
+        return hashlib.sha256(f"{audio}|{canonical}".encode()).hexdigest()
+
+    def get(self, key: str, count: bool = True):
+        """התוצאה השמורה או None. count=False – קריאה חוזרת (poll) שלא נספרת כ-hit/miss."""
+        db = state_db()
+        row = db.execute("SELECT output FROM result_cache WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            if count:
+                self.stats["misses"] += 1
+            return None
+        if count:
+            db.execute(
+                "UPDATE result_cache SET hits = hits + 1, last_hit_at = ? WHERE key = ?", (time.time(), key)
+            )
+            self.stats["hits"] += 1
+        return json.loads(zlib.decompress(row["output"]))
+
+    def put(self, key: str, output):
+        blob = zlib.compress(json.dumps(output, ensure_ascii=False).encode("utf-8"), 6)
+        now = time.time()
+        with self._lock:
+            db = state_db()
+            db.execute(
+                "INSERT OR REPLACE INTO result_cache (key, output, size_bytes, created_at, last_hit_at, hits) "
+                "VALUES (?, ?, ?, ?, ?, 0)",
+                (key, blob, len(blob), now, now),
+            )
+            self.stats["stores"] += 1
+            total = db.execute("SELECT COALESCE(SUM(size_bytes), 0) FROM result_cache").fetchone()[0]
+            while total > RESULT_CACHE_MAX_BYTES:
+                victim = db.execute(
+                    "SELECT key, size_bytes FROM result_cache ORDER BY last_hit_at LIMIT 1"
+                ).fetchone()
+                if victim is None or victim["key"] == key:
+                    break
+                db.execute("DELETE FROM result_cache WHERE key = ?", (victim["key"],))
+                total -= victim["size_bytes"]
+                self.stats["evictions"] += 1
+
+    def store_for_job(self, job_id: str, out: dict, job: sqlite3.Row | None = None):
+        """נקרא כש-job הושלם: שומר את התוצאה אם ה-job נשלח עם מפתח מטמון (ברישום ה-jobs)."""
+        job = job if job is not None else registered_job(job_id)
+        if job is None or not job["cache_key"] or not out.get("output"):
+            return
+        self.put(job["cache_key"], out["output"])
+
+    @staticmethod
+    def synthetic_job(key: str, output) -> dict:
+        return {
+            "id": f"{CACHED_JOB_PREFIX}{key}",
+            "status": "COMPLETED",
+            "delayTime": 0,
+            "executionTime": 0,
+            "output": output,
+            "_cache": {"hit": True},
+        }
+
+    def summary(self) -> dict:
+        row = state_db().execute(
+            "SELECT COUNT(*) AS n, COALESCE(SUM(size_bytes), 0) AS b FROM result_cache"
+        ).fetchone()
+        return {"entries": row["n"], "bytes": row["b"], "max_bytes": RESULT_CACHE_MAX_BYTES, **self.stats}
+
+
+result_cache = ResultCache()
+
+
+@app.get("/cache/stats")
+def cache_stats():
+    return JSONResponse(result_cache.summary())
+
+
+# ───────────────────────────────────────────────
+# 🚀 קריאות ל-RunPod
+async def submit_runpod_job(token: str, run_body: dict) -> tuple[dict, int]:
+    """
+    שולח job ל-/run (עם webhook, אם מופעל). מחזיר (תשובת RunPod, status_code).
+    כל שליחה עוברת ב-token bucket של הטוקן – פרץ בקשות לא יחטוף 429 מ-RunPod.
+    """
+    await token_bucket(token).acquire()
+
+    # 🔔 RunPod יודיע על סיום ב-webhook (במקום שהקליינט ישאל שוב ושוב)
+    if RUNPOD_WEBHOOKS and "webhook" not in run_body:
+        run_body = {**run_body, "webhook": runpod_webhook_url()}
+
+    response = await upstream_request(
+        "runpod",
+        "POST",
+        f"{RUNPOD_ENDPOINT_URL}/run",
+        idempotent=False,
+        headers={"Authorization": f"Bearer {token}", "Content-Type": "application/json"},
+        json=run_body,
+    )
+    out = response.json() if response.content else {}
+    prewarmed_at = prewarmer.claim(token, run_body) if response.is_success and out.get("id") else None
+    if prewarmed_at:
+        await run_in_threadpool(prewarmer.attach, out["id"], prewarmed_at)
+    return out, (response.status_code if response.status_code else 200)
+
+
+async def fetch_runpod_status(token: str, job_id: str) -> tuple[dict, int]:
+    """סטטוס job מ-RunPod: (תשובה, status_code); בשגיאה – ({"error": ...}, status_code)."""
+    r = await upstream_request(
+        "runpod",
+        "GET",
+        f"{RUNPOD_ENDPOINT_URL}/status/{job_id}",
+        headers={"Authorization": f"Bearer {token}"},
+        timeout=30,
+    )
+    if not r.is_success:
+        return {"error": "שגיאה בשליפת סטטוס מ-RunPod"}, r.status_code
+    return (r.json() if r.content else {}), r.status_code
+
+
+# ───────────────────────────────────────────────
+# 🔥 prewarm: כשמתחילה העלאה או שליפה מדרייב, ה-job יגיע בעוד רגע – מעירים worker כבר עכשיו.
+#    נשלח רק כשזה שווה: חציון ה-boot האחרון גבוה, ו-/health מראה שאין worker פנוי או בעלייה.
+#    החיסכון לכל job = חציון ה-boot של jobs בלי prewarm פחות ה-boot שלו בפועל.
+#    רק ה-job הראשון (על RUNPOD_API_KEY) שנשלח לקובץ שהפעיל את ה-prewarm נחשב "מחומם".
+class Prewarmer:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._boots: deque[float] = deque(maxlen=PREWARM_SAMPLE_SIZE)   # boot של jobs בלי prewarm
+        self._targets: OrderedDict[str, dict] = OrderedDict()             # כתובת הקובץ → handle של ה-signal
+        self._last_attempt = 0.0
+        self.last_sent = 0.0
+        self._tasks: set[asyncio.Task] = set()
+        self.decisions: Counter = Counter()
+        self.prewarmed_jobs = 0
+        self.saved_seconds = 0.0
+
+    def _decided(self, result: str):
+        self.decisions[result] += 1
+        prewarm_total.inc(result=result)
+
+    def baseline(self) -> float | None:
+        with self._lock:
+            boots = sorted(self._boots)
+        if len(boots) < PREWARM_MIN_SAMPLES:
+            return None
+        return boots[len(boots) // 2]
+
+    def signal(self, source: str) -> dict | None:
+        """
+        נקרא בתחילת העלאה / שליפה מדרייב; ההחלטה והשליחה רצות ברקע.
+        מחזיר handle (או None) – כשהקובץ נשמר, bind מקשר אותו לכתובות הקובץ.
+        """
+        if not RUNPOD_PREWARM or not RUNPOD_API_KEY:
+            return None
+        now = time.time()
+        if now - self._last_attempt < PREWARM_COOLDOWN_SECONDS:
+            self._decided("cooldown")
+            return None
+        self._last_attempt = now
+        handle = {"source": source, "sent_at": None}
+        task = asyncio.create_task(self._maybe_prewarm(handle))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return handle
+
+    def bind(self, handle: dict | None, *urls: str):
+        if handle is None:
+            return
+        for url in urls:
+            self._targets[url] = handle
+            self._targets.move_to_end(url)
+        while len(self._targets) > 1000:
+            self._targets.popitem(last=False)
+
+    def claim(self, token: str, run_body: dict) -> float | None:
+        """
+        זמן ה-prewarm שה-job הזה נהנה ממנו, או None: רק job על RUNPOD_API_KEY, לקובץ שהפעיל
+        prewarm שנשלח בפועל, בתוך PREWARM_WINDOW_SECONDS – ורק הראשון לכל קובץ.
+        """
+        run_input = run_body.get("input")
+        if token != RUNPOD_API_KEY or not self._targets or not isinstance(run_input, dict):
+            return None
+        url = (run_input.get("transcribe_args") or {}).get("url") or run_input.get("url")
+        handle = self._targets.get(url) if url else None
+        if handle is None or not handle["sent_at"] or time.time() - handle["sent_at"] > PREWARM_WINDOW_SECONDS:
+            return None
+        for key in [k for k, h in self._targets.items() if h is handle]:
+            del self._targets[key]
+        return handle["sent_at"]
+
+    async def _maybe_prewarm(self, handle: dict):
+        source = handle["source"]
+        baseline = self.baseline()
+        if baseline is not None and baseline < PREWARM_MIN_BOOT_SECONDS:
+            self._decided("fast_boot")
+            return
+        headers = {"Authorization": f"Bearer {RUNPOD_API_KEY}"}
+        try:
+            r = await upstream_request("runpod", "GET", f"{RUNPOD_ENDPOINT_URL}/health", headers=headers, timeout=5)
+            health = r.json() if r.is_success else {}
+            workers, jobs = health.get("workers") or {}, health.get("jobs") or {}
+            if not r.is_success:
+                result = "error"
+            elif workers.get("idle") or workers.get("ready"):
+                result = "warm"
+            elif workers.get("initializing") or jobs.get("inQueue"):
+                result = "busy"   # workers כבר עולים בשביל מה שבתור
+            else:
+                # job זול: הקלט לא תקין ל-worker, ונזרק אם לא נאסף בחלון ה-prewarm
+                r = await upstream_request(
+                    "runpod",
+                    "POST",
+                    f"{RUNPOD_ENDPOINT_URL}/run",
+                    idempotent=False,
+                    headers=headers,
+                    json={
+                        "input": {"prewarm": True},
+                        "policy": {"executionTimeout": 10_000, "ttl": int(PREWARM_WINDOW_SECONDS * 1000)},
+                    },
+                )
+                result = "sent" if r.is_success else "error"
+        except httpx.HTTPError as e:
+            log.warning("⚠️ prewarm נכשל: %s", e)
+            result = "error"
+        self._decided(result)
+        if result == "sent":
+            self.last_sent = handle["sent_at"] = time.time()
+            log.info("🔥 prewarm נשלח ל-RunPod (%s, חציון boot: %s)", source, baseline)
+
+    def attach(self, job_id: str, prewarmed_at: float):
+        state_db().execute(
+            "INSERT OR IGNORE INTO prewarmed_jobs (job_id, prewarmed_at, submitted_at) VALUES (?, ?, ?)",
+            (job_id, prewarmed_at, time.time()),
+        )
+
+    def observe(self, job_id: str, delay_ms) -> dict | None:
+        """
+        boot של job שהסתיים. job בלי prewarm נכנס לחציון; ל-job עם prewarm מחושב החיסכון
+        ומוחזר {"prewarmed_at", "boot_seconds", "baseline_boot_seconds", "saved_seconds"}.
+        """
+        boot = float(delay_ms) / 1000.0 if delay_ms else None
+        row = state_db().execute("SELECT * FROM prewarmed_jobs WHERE job_id = ?", (job_id,)).fetchone()
+        if row is None:
+            if boot is not None:
+                with self._lock:
+                    self._boots.append(boot)
+            return None
+        if row["boot_seconds"] is None and boot is not None:
+            baseline = self.baseline()
+            saved = max(0.0, baseline - boot) if baseline is not None else None
+            state_db().execute(
+                "UPDATE prewarmed_jobs SET boot_seconds = ?, baseline_boot_seconds = ?, saved_seconds = ? "
+                "WHERE job_id = ?",
+                (boot, baseline, saved, job_id),
+            )
+            with self._lock:
+                self.prewarmed_jobs += 1
+                self.saved_seconds += saved or 0.0
+            if saved is not None:
+                prewarm_saved_seconds.observe(saved)
+            row = state_db().execute("SELECT * FROM prewarmed_jobs WHERE job_id = ?", (job_id,)).fetchone()
+        return {k: row[k] for k in ("prewarmed_at", "boot_seconds", "baseline_boot_seconds", "saved_seconds")}
+
+    def stats(self) -> dict:
+        with self._lock:
+            samples = len(self._boots)
+        return {
+            "enabled": RUNPOD_PREWARM and bool(RUNPOD_API_KEY),
+            "baseline_boot_seconds": self.baseline(),
+            "boot_samples": samples,
+            "last_sent_at": self.last_sent or None,
+            "decisions": dict(self.decisions),
+            "prewarmed_jobs": self.prewarmed_jobs,
+            "saved_seconds_total": round(self.saved_seconds, 3),
+            "saved_seconds_avg": round(self.saved_seconds / self.prewarmed_jobs, 3) if self.prewarmed_jobs else None,
+        }
+
+
+prewarmer = Prewarmer()
+
+
+@app.get("/prewarm/stats")
+def prewarm_stats():
+    return JSONResponse(prewarmer.stats())
+
+
+# ───────────────────────────────────────────────
+# 🚦 בקרת קבלה: token bucket לכל טוקן + תור הוגן (round-robin בין משתמשים) ל-fallback
+QUEUE_TICKET_PREFIX = "q-"
+
+
+class TokenBucket:
+    """rate אסימונים לשנייה, עד burst. משמש רק מתוך ה-event loop."""
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = max(burst, 1.0)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, n: float = 1) -> float:
+        """כמה שניות עד שיהיו n אסימונים (בלי לצרוך)."""
+        if self.rate <= 0:
+            return 0.0
+        self._refill()
+        return max(0.0, n - self.tokens) / self.rate
+
+    async def acquire(self):
+        if self.rate <= 0:
+            return
+        while True:
+            self._refill()
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+# bucket שלא נגעו בו עד שהתמלא מחדש שקול לחדש – מותר לשכוח אותו (כמו שאר המטמונים לפי משתמש)
+_token_buckets = TTLCache(
+    ACCOUNT_CACHE_SIZE,
+    max(ACCOUNT_CACHE_TTL, RUNPOD_SUBMIT_BURST / RUNPOD_SUBMIT_RATE if RUNPOD_SUBMIT_RATE > 0 else 0.0),
+)
+
+
+def token_bucket(token: str) -> TokenBucket:
+    key = token_key(token)
+    bucket = _token_buckets.get(key)
+    if bucket is None:
+        bucket = TokenBucket(RUNPOD_SUBMIT_RATE, RUNPOD_SUBMIT_BURST)
+    _token_buckets.set(key, bucket)   # כל שימוש מאריך את התפוגה – bucket פעיל לא מתאפס באמצע
+    return bucket
+
+
+class QueueFull(Exception):
+    pass
+
+
+class AdmissionQueue:
+    """
+    תור jobs של משתמשי fallback (שחולקים את RUNPOD_API_KEY).
+    כל משתמש מקבל תור משלו, ו-dispatcher ברקע שולח לסירוגין ממשתמש למשתמש בקצב ה-token bucket –
+    משתמש ששלח 100 קבצים לא מעכב את מי ששלח קובץ אחד.
+    כרטיס (q-...) נשמר ב-state.db, כך ש-restart לא מאבד jobs שעוד לא נשלחו.
+    כשהתור ריק ויש אסימון פנוי (admit_now) – אין כרטיס: ה-job נשלח מיד ומוחזר ה-id של RunPod.
+    """
+
+    def __init__(self):
+        self._queues: OrderedDict[str, deque] = OrderedDict()   # user_email → ids, לפי סדר הסבב
+        self._pending: dict[str, dict] = {}
+        self._task: asyncio.Task | None = None
+        self._wakeup: asyncio.Event | None = None
+        self._loaded = False
+        self.dispatched = 0
+        self.failed = 0
+        self.immediate = 0
+
+    def _ensure_running(self):
+        loop = asyncio.get_running_loop()
+        if self._task is None or self._task.done() or self._task.get_loop() is not loop:
+            self._wakeup = asyncio.Event()
+            self._task = loop.create_task(self._run())
+        self._wakeup.set()
+
+    def _push(self, ticket: dict):
+        self._pending[ticket["id"]] = ticket
+        self._queues.setdefault(ticket["user_email"], deque()).append(ticket["id"])
+
+    async def _load(self):
+        """כרטיסים שלא נשלחו לפני ה-restart חוזרים לתור, לפי סדר יצירתם."""
+        self._loaded = True
+        rows = await run_in_threadpool(lambda: state_db().execute(
+            "SELECT id, user_email, run_body, created_at FROM queue_tickets "
+            "WHERE job_id IS NULL AND error IS NULL ORDER BY created_at"
+        ).fetchall())
+        for row in rows:
+            self._push({**dict(row), "run_body": json.loads(row["run_body"])})
+        if rows:
+            log.info("🚦 %s jobs חזרו לתור אחרי הפעלה מחדש", len(rows))
+
+    async def start(self):
+        if not self._loaded:
+            await self._load()
+        if RUNPOD_API_KEY:
+            self._ensure_running()
+
+    async def enqueue(self, user_email: str, run_body: dict, cache_key: str | None = None,
+                      audio_id: str | None = None, audio_length: float | None = None) -> dict:
+        if not self._loaded:
+            await self._load()
+        if len(self._queues.get(user_email, ())) >= QUEUE_MAX_PER_USER:
+            raise QueueFull(f"יותר מדי jobs ממתינים בתור (עד {QUEUE_MAX_PER_USER} למשתמש)")
+        ticket = {
+            "id": f"{QUEUE_TICKET_PREFIX}{uuid.uuid4().hex}",
+            "user_email": user_email,
+            "run_body": run_body,
+            "created_at": time.time(),
+        }
+
+        def save():
+            state_db().execute(
+                "INSERT INTO queue_tickets (id, user_email, run_body, created_at) VALUES (?, ?, ?, ?)",
+                (ticket["id"], user_email, json.dumps(run_body, ensure_ascii=False), ticket["created_at"]),
+            )
+            # הרישום נפתח על שם הכרטיס ועובר ל-job_id האמיתי בשליחה
+            register_job(ticket["id"], user_email, True, audio_id, audio_length, cache_key)
+
+        # נשמר לפני שנכנס לתור – ה-dispatcher מעדכן שורה שכבר קיימת
+        await run_in_threadpool(save)
+        self._push(ticket)
+        self._ensure_running()
+        return ticket
+
+    async def admit_now(self) -> bool:
+        """אין ממתינים ויש אסימון ב-bucket של RUNPOD_API_KEY – שליחה ישירה לא עוקפת אף אחד."""
+        if not self._loaded:
+            await self._load()
+        if self._pending or not RUNPOD_API_KEY:
+            return False
+        admitted = token_bucket(RUNPOD_API_KEY).delay() == 0
+        if admitted:
+            self.immediate += 1
+        return admitted
+
+    def position(self, ticket_id: str) -> int | None:
+        """
+        כמה jobs יישלחו לפני הכרטיס, לפי סדר הסבב: מכל משתמש שלפניו בסבב – עד k+1 jobs,
+        ומכל משתמש שאחריו – עד k (k = מיקום הכרטיס בתור של המשתמש שלו).
+        """
+        ticket = self._pending.get(ticket_id)
+        if ticket is None:
+            return None
+        users = list(self._queues)
+        me = users.index(ticket["user_email"])
+        k = self._queues[ticket["user_email"]].index(ticket_id)
+        return sum(
+            min(len(self._queues[user]), k + 1 if n < me else k)
+            for n, user in enumerate(users)
+        )
+
+    def queue_info(self, ticket_id: str) -> dict | None:
+        position = self.position(ticket_id)
+        if position is None:
+            return None
+        eta = token_bucket(RUNPOD_API_KEY).delay(position + 1) if RUNPOD_API_KEY else None
+        return {"position": position, "eta_seconds": round(eta, 1) if eta is not None else None}
+
+    def lookup(self, ticket_id: str) -> dict | None:
+        if ticket_id in self._pending:
+            return self._pending[ticket_id]
+        row = state_db().execute(
+            "SELECT id, user_email, job_id, error FROM queue_tickets WHERE id = ?", (ticket_id,)
+        ).fetchone()
+        return dict(row) if row else None
+
+    def resolve(self, job_id: str) -> str | None:
+        """ה-job_id האמיתי ב-RunPod (עבור כרטיס תור); None אם הכרטיס עוד ממתין או נכשל."""
+        if not job_id.startswith(QUEUE_TICKET_PREFIX):
+            return job_id
+        ticket = self.lookup(job_id)
+        return ticket.get("job_id") if ticket else None
+
+    def _next(self) -> dict | None:
+        while self._queues:
+            user, ids = next(iter(self._queues.items()))
+            ticket_id = ids.popleft()
+            if ids:
+                self._queues.move_to_end(user)
+            else:
+                del self._queues[user]
+            ticket = self._pending.pop(ticket_id, None)
+            if ticket is not None:
+                return ticket
+        return None
+
+    async def _dispatch(self, ticket: dict):
+        job_id, error = None, None
+        try:
+            out, status_code = await submit_runpod_job(RUNPOD_API_KEY, ticket["run_body"])
+            job_id = out.get("id") if status_code < 400 else None
+            if not job_id:
+                error = str(out.get("error") or f"RunPod {status_code}")
+        except Exception as e:
+            error = str(e)
+
+        def save():
+            state_db().execute(
+                "UPDATE queue_tickets SET job_id = ?, error = ?, dispatched_at = ? WHERE id = ?",
+                (job_id, error, time.time(), ticket["id"]),
+            )
+            if job_id:
+                rename_registered_job(ticket["id"], job_id)
+
+        await run_in_threadpool(save)
+        if job_id:
+            self.dispatched += 1
+            log.info("🚦 %s → job %s (user=%s)", ticket["id"], job_id, ticket["user_email"])
+        else:
+            self.failed += 1
+            log.error("❌ %s נכשל בשליחה: %s", ticket["id"], error)
+
+    async def _run(self):
+        while True:
+            ticket = self._next()
+            if ticket is None:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            await self._dispatch(ticket)   # submit_runpod_job ממתין ל-token bucket של RUNPOD_API_KEY
+
+    def stats(self) -> dict:
+        return {
+            "queued": len(self._pending),
+            "users": len(self._queues),
+            "dispatched": self.dispatched,
+            "immediate": self.immediate,
+            "failed": self.failed,
+        }
+
+
+admission_queue = AdmissionQueue()
+
+
+@app.on_event("startup")
+async def start_admission_queue():
+    await admission_queue.start()
+
+
+@app.get("/queue/stats")
+def queue_stats():
+    return JSONResponse(admission_queue.stats())
+
+
+async def queue_ticket_status(ticket_id: str, user_email: str | None) -> tuple[dict, int]:
+    ticket = await run_in_threadpool(admission_queue.lookup, ticket_id)
+    if ticket is None:
+        return {"error": "job לא נמצא"}, 404
+    if ticket.get("job_id"):
+        out, status_code = await _job_status(ticket["job_id"], user_email or ticket["user_email"])
+        out["ticket"] = ticket_id
+        return out, status_code
+    if ticket.get("error"):
+        return {"id": ticket_id, "status": "FAILED", "error": ticket["error"]}, 200
+    return {"id": ticket_id, "status": "IN_QUEUE", "queue": admission_queue.queue_info(ticket_id)}, 200
+
+
+# ───────────────────────────────────────────────
+@app.post("/transcribe")
+async def transcribe(request: Request):
+    """
+    שליחת בקשת תמלול ל-RunPod.
+
+    ⚠️ שים לב:
+    - כאן **לא** מחויבים קרדיטים.
+    - החיוב נעשה רק ב-/status כשהסטטוס COMPLETED ויש executionTime.
+    """
+    try:
+        data = await request.json()
+        user_email = data.get("user_email")
+        if not user_email:
+            return JSONResponse({"error": "user_email is required"}, status_code=400)
+
+        run_body = await run_in_threadpool(prefer_normalized, build_run_body(data))
+        # 📒 אופציונלי: רשומת התמלול ב-DB – נרשם עם ה-job, וחוסך חיפוש בסיום
+        audio_id = data.get("audio_id")
+        audio_length = data.get("audio_length_seconds") or None
+        if audio_length is not None:
+            try:
+                audio_length = float(audio_length)
+            except (TypeError, ValueError):
+                audio_length = None
+            if audio_length is None or not 0 <= audio_length < float("inf"):
+                return JSONResponse(
+                    {"error": "audio_length_seconds חייב להיות מספר שניות אי-שלילי"}, status_code=400
+                )
+        else:
+            # 📏 קובץ מהאחסון שלנו – האורך כבר ידוע מכותרות הקובץ (בהעלאה / דרייב)
+            audio = audio_hash_for_input(run_body.get("input"))
+            media = await run_in_threadpool(media_info, audio) if audio else None
+            audio_length = media["audio_length_seconds"] if media else None
+
+        # 🔑 שליפת טוקן (אישי או fallback)
+        token_to_use, using_fallback = await run_in_threadpool(get_user_token, user_email)
+
+        if not token_to_use:
+            return JSONResponse(
+                {
+                    "error": "לא הוגדר טוקן לשימוש (אין טוקן אישי ואין RUNPOD_API_KEY בשרת).",
+                    "action": "יש להזין טוקן RunPod אישי"
+                },
+                status_code=401,
+            )
+
+        # 🔒 בדיקת מגבלת שימוש (רק למשתמשים על fallback)
+        if using_fallback:
+            allowed, used, limit = await run_in_threadpool(check_fallback_allowance, user_email)
+            if not allowed:
+                return JSONResponse(
+                    {
+                        "error": "חריגה ממגבלת שימוש",
+                        "used": used,
+                        "limit": limit,
+                        "action": "יש להזין טוקן RunPod אישי"
+                    },
+                    status_code=402,
+                )
+
+        # ♻️ אותו אודיו עם אותם פרמטרים כבר תומלל → job סינתטי שהושלם, בלי RunPod ובלי חיוב
+        #    (אחרי בדיקות הטוקן והמגבלה – מטמון אינו דרך לעקוף אותן)
+        cache_key = None
+        if data.get("cache", True):
+            cache_key = await run_in_threadpool(result_cache.key_for, run_body.get("input"))
+            cached = await run_in_threadpool(result_cache.get, cache_key) if cache_key else None
+            if cached is not None:
+                log.info("♻️ /transcribe → user=%s, cache hit %s", user_email, cache_key[:12])
+                return JSONResponse(result_cache.synthetic_job(cache_key, cached))
+
+        # ✂️ מצב פיצול (opt-in): חלוקה בשקטים ושליחת כל קטע כ-job נפרד במקביל
+        if data.get("split"):
+            if using_fallback:
+                # קטעים במקביל היו עוקפים את התור ההוגן של RUNPOD_API_KEY
+                return JSONResponse(
+                    {"error": "מצב פיצול זמין רק עם טוקן RunPod אישי", "action": "יש להזין טוקן RunPod אישי"},
+                    status_code=400,
+                )
+            out, status_code = await start_split_job(user_email, using_fallback, token_to_use, run_body)
+            if out.get("id"):
+                await run_in_threadpool(
+                    register_job, out["id"], user_email, using_fallback, audio_id, audio_length, cache_key
+                )
+            return JSONResponse(content=out, status_code=status_code)
+
+        # 🚦 משתמשי fallback נכנסים לתור ההוגן רק כשצריך לחכות; ה-dispatcher ישלח ל-RunPod ברקע
+        if using_fallback and not await admission_queue.admit_now():
+            try:
+                ticket = await admission_queue.enqueue(user_email, run_body, cache_key, audio_id, audio_length)
+            except QueueFull as e:
+                return JSONResponse({"error": str(e)}, status_code=429)
+            log.info("🚦 /transcribe → user=%s, queued %s", user_email, ticket["id"])
+            return JSONResponse({
+                "id": ticket["id"],
+                "status": "IN_QUEUE",
+                "queue": admission_queue.queue_info(ticket["id"]),
+            })
+
+        # 🚀 שליחה ל-RunPod (asynchronous run)
+        out, status_code = await submit_runpod_job(token_to_use, run_body)
+        if out.get("id"):
+            await run_in_threadpool(
+                register_job, out["id"], user_email, using_fallback, audio_id, audio_length, cache_key
+            )
+
+        log.info(
+            "🚀 /transcribe → user=%s, using_fallback=%s, resp_keys=%s",
+            user_email,
+            using_fallback,
+            list(out.keys()),
+        )
+        return JSONResponse(content=out, status_code=status_code)
+
+    except Exception as e:
+        log.error("❌ /transcribe error: %s", e)
+        return JSONResponse({"error": str(e)}, status_code=500)
+# ───────────────────────────────────────────────
+def _record_job_completion(job_id: str, user_email: str | None, using_fallback: bool, out: dict):
+    """
+    עיבוד job שהסתיים (סינכרוני – רץ ב-threadpool):
+    מחייב משתמש fallback (ומוסיף out["_usage"]), ומעדכן נתוני עיבוד
+    (זמן, חיוב, יחס, boot) במסד הנתונים בעדכון אחד.
+    audio_id ואורך האודיו נלקחים מרישום ה-jobs; אם ה-job לא נרשם איתם – חיפוש לפי job_id,
+    ואם אין התאמה → נופל להקצאת הרשומה האחרונה של המשתמש.
+    """
+    outputs = out.get("output") or []
+    job = registered_job(job_id)
+
+    # ───────────────────────────────────────────
+    # 💰 עדכון קרדיטים למשתמש fallback
+    # ───────────────────────────────────────────
+    if user_email and using_fallback:
+        billed = get_billed_job(job_id)
+        if billed:
+            # כבר חויב – polls חוזרים לא נוגעים ב-DB בכלל
+            out["_usage"] = {
+                "estimated_cost_usd": billed["amount_usd"],
+                "used_credits": billed["used_credits"],
+                "remaining": max(FALLBACK_LIMIT_DEFAULT - (billed["used_credits"] or 0.0), 0.0),
+                "already_billed": True,
+            }
+        else:
+            cost = estimate_cost_from_response(out)
+            if cost > 0:
+                charged, new_used = charge_fallback_job(job_id, user_email, cost)
+                remaining = max(FALLBACK_LIMIT_DEFAULT - new_used, 0.0)
+
+                out["_usage"] = {
+                    "estimated_cost_usd": cost,
+                    "used_credits": new_used,
+                    "remaining": remaining,
+                    "already_billed": not charged,
+                }
+
+                if charged:
+                    log.info(
+                        "💰 fallback user %s used %.8f$ (total %.6f$, remaining %.6f$)",
+                        user_email,
+                        cost,
+                        new_used,
+                        remaining,
+                    )
+            else:
+                log.info("⚖️ עלות לא אותרה או אפסית בתגובה של RunPod.")
+    elif user_email:
+        # 🪙 טוקן אישי – RunPod מחייב בעצמו; רק מורידים מהיתרה השמורה עד הרענון הבא
+        token, fallback = get_user_token(user_email)
+        if token and not fallback:
+            balance_cache.spend(token, estimate_cost_from_response(out))
+
+    # ♻️ שמירת התוצאה במטמון (אם ה-job נשלח עם מפתח מטמון)
+    try:
+        result_cache.store_for_job(job_id, out, job)
+    except Exception as e:
+        log.warning("⚠️ כשל בשמירת תוצאה במטמון: %s", e)
+
+    # ───────────────────────────────────────────
+    # 🗄 עדכון נתוני ביצועים במסד – כתיבה אחת
+    # ───────────────────────────────────────────
+    audio_id = job["audio_id"] if job is not None else None
+    audio_len = float(job["audio_length"] or 0.0) if job is not None else 0.0
+
+    if not audio_id:
+        # 1️⃣ ה-job לא נרשם עם audio_id – חיפוש לפי job_id
+        rec = (
+            supabase.table("transcriptions")
+            .select("id,audio_id,audio_length_seconds")
+            .eq("job_id", job_id)
+            .maybe_single()
+            .execute()
+        )
+        row = rec.data if hasattr(rec, "data") else None
+
+        # 2️⃣ Fallback – אין job_id או לא נמצא: לוקחים את הרשומה האחרונה של המשתמש
+        if (not row or not row.get("audio_id")) and user_email:
+            try:
+                rec2 = (
+                    supabase.table("transcriptions")
+                    .select("id,audio_id,audio_length_seconds")
+                    .eq("user_email", user_email)
+                    .order("created_at", desc=True)
+                    .limit(1)
+                    .execute()
+                )
+                data2 = rec2.data if hasattr(rec2, "data") else None
+                if data2:
+                    # supabase-py מחזיר בדרך כלל list
+                    row = data2[0] if isinstance(data2, list) else data2
+                    log.debug(
+                        "🧩 Fallback: משתמש %s → משייך job_id=%s ל-audio_id=%s",
+                        user_email,
+                        job_id,
+                        row.get("audio_id"),
+                    )
+            except Exception as e:
+                log.warning("⚠️ כשל בשליפת fallback לפי user_email: %s", e)
+
+        if row and row.get("audio_id"):
+            audio_id = row["audio_id"]
+            # 3️⃣ אורך האודיו – מאותה שורה, בלי שאילתה נוספת
+            if not audio_len and row.get("audio_length_seconds") is not None:
+                audio_len = float(row["audio_length_seconds"] or 0.0)
+                log.debug("📏 אורך אודיו מה-DB: %.2f שניות", audio_len)
+
+    if audio_id:
+        # זמן עיבוד בפועל (מ-RunPod)
+        exec_ms = out.get("executionTime", 0) or 0
+        exec_sec = float(exec_ms) / 1000.0
+
+        # אם אין אורך ב-DB – ניסיון לחלץ מה-output
+        if (not audio_len) and outputs:
+            try:
+                if outputs[0].get("result"):
+                    last_seg = outputs[0]["result"][-1][-1]
+                    audio_len = float(last_seg.get("end", 0.0) or 0.0)
+                    log.debug("📏 אורך אודיו מ-RunPod: %.2f שניות", audio_len)
+            except Exception as e:
+                log.warning("⚠️ כשל בחילוץ אורך אודיו מ-output: %s", e)
+
+        # 4️⃣ יחס עיבוד
+        ratio = exec_sec / audio_len if audio_len > 0 else None
+
+        # 5️⃣ חיוב (על פי executionTime)
+        billing = exec_sec * 0.00016 if exec_sec > 0 else None
+
+        # 6️⃣ זמן boot
+        delay_ms = out.get("delayTime", 0) or 0
+        boot_sec = float(delay_ms) / 1000.0 if delay_ms else None
+
+        # 7️⃣ זמן משוער ע"פ אורך האודיו
+        estimated = audio_len * 0.08 if audio_len > 0 else None
+
+        if ratio is not None:
+            job_processing_ratio.observe(ratio)
+        if boot_sec is not None:
+            job_worker_boot_seconds.observe(boot_sec)
+
+        updates = {
+            "job_id": job_id,   # גם שיוך ה-job לרשומה (במקום עדכון נפרד)
+            "audio_length_seconds": audio_len or None,
+            "estimated_processing_seconds": estimated,
+            "actual_processing_seconds": exec_sec or None,
+            "billing_usd": billing,
+            "processing_ratio": ratio,
+            "worker_boot_time_seconds": boot_sec,
+            "updated_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        }
+
+        transcription_writes.update("audio_id", audio_id, updates)
+
+        log.info("🗄 נתוני ביצועים עודכנו לכל הרשומות עם audio_id=%s", audio_id)
+    else:
+        log.warning("⚠️ לא נמצאה רשומה לעדכון עבור job_id=%s (user_email=%s)", job_id, user_email)
+
+    # 🔥 boot שנחסך בזכות prewarm (נשמר גם בתוצאה הרשומה)
+    prewarm = prewarmer.observe(job_id, out.get("delayTime"))
+    if prewarm:
+        out["_prewarm"] = prewarm
+
+    # 📒 מכאן – polls על ה-job מוגשים מהרישום המקומי
+    complete_registered_job(job_id, out, keep_result=not is_local_job(job_id))
+
+
+_completion_locks = KeyedLocks()
+
+
+async def finish_job(job_id: str, user_email: str | None, using_fallback: bool, out: dict) -> dict:
+    """עיבוד סיום פעם אחת לכל job; קריאות חוזרות רק מצרפות את _usage השמור."""
+    async with _completion_locks(job_id):
+        job = await run_in_threadpool(registered_job, job_id)
+        if job is not None and job["completed_at"]:
+            if job["usage"]:
+                out["_usage"] = json.loads(job["usage"])
+            return out
+        await run_in_threadpool(_record_job_completion, job_id, user_email, using_fallback, out)
+        return out
+
+
+async def _job_status(job_id: str, user_email: str | None) -> tuple[dict, int]:
+    """
+    סטטוס job כ-(payload, status_code).
+    אם התוצאה כבר הגיעה ב-webhook – משתמשים בה בלי לפנות ל-RunPod.
+    job סינתטי ממטמון התוצאות (cached-...) מוחזר מהמטמון, בלי RunPod ובלי חיוב;
+    job מפוצל (split-...) מורכב מסטטוס הקטעים שלו; כרטיס תור (q-...) – מיקום בתור, או ה-job שנשלח בשבילו.
+    """
+    if job_id.startswith(QUEUE_TICKET_PREFIX):
+        return await queue_ticket_status(job_id, user_email)
+    if job_id.startswith(SPLIT_JOB_PREFIX):
+        return await split_job_status(job_id)
+    if job_id.startswith(CACHED_JOB_PREFIX):
+        key = job_id[len(CACHED_JOB_PREFIX):]
+        cached = await run_in_threadpool(result_cache.get, key, False)
+        if cached is None:
+            return {"error": "התוצאה כבר לא נמצאת במטמון"}, 404
+        return result_cache.synthetic_job(key, cached), 200
+
+    # ───────────────────────────────────────────
+    # 📒 job שכבר עובד – מוגש מהרישום המקומי, בלי RunPod ובלי Supabase
+    # ───────────────────────────────────────────
+    job = await run_in_threadpool(registered_job, job_id)
+    done = registered_result(job)
+    if done is not None:
+        return done, 200
+    if job is not None:
+        user_email = user_email or job["user_email"]
+
+    # ───────────────────────────────────────────
+    # 🔑 שליפת טוקן לשימוש
+    # ───────────────────────────────────────────
+    token_to_use, using_fallback = await run_in_threadpool(get_user_token, user_email)
+    if job is not None and job["using_fallback"] and RUNPOD_API_KEY:
+        # נשלח על ה-fallback – נשאר עליו גם אם בינתיים נשמר טוקן אישי
+        token_to_use, using_fallback = RUNPOD_API_KEY, True
+
+    if not token_to_use:
+        return {"error": "Missing token"}, 401
+
+    # ───────────────────────────────────────────
+    # 📡 שליפת סטטוס (webhook או RunPod)
+    # ───────────────────────────────────────────
+    out = job_events.result(job_id)
+    status_code = 200
+    if out is None:
+        out, status_code = await fetch_runpod_status(token_to_use, job_id)
+        if status_code >= 400:
+            return out, status_code
+        log.debug("🔍 RunPod status %s: %s", job_id, out.get("status"))
+    else:
+        out = dict(out)
+
+    status_lower = str(out.get("status", "")).lower()
+
+    # ───────────────────────────────────────────
+    # 💰🗄 חיוב ועדכון נתוני ביצועים (DB סינכרוני → threadpool)
+    # ───────────────────────────────────────────
+    if status_lower == "completed":
+        out = await finish_job(job_id, user_email, using_fallback, out)
+
+    return out, status_code
+
+
+_status_flights = SingleFlight()
+_terminal_status_cache = TTLCache(STATUS_CACHE_SIZE, STATUS_CACHE_TTL)
+
+
+async def job_status(job_id: str, user_email: str | None) -> tuple[dict, int]:
+    """
+    _job_status משותף: polls מקבילים לאותו job (למשל כמה לשוניות) חולקים קריאה אחת,
+    ותשובה במצב סופי נשמרת ל-STATUS_CACHE_TTL שניות.
+    """
+    key = (job_id, user_email)
+    result = _terminal_status_cache.get(key)
+    if result is None:
+        result = await _status_flights.do(key, lambda: _job_status(job_id, user_email))
+        out, status_code = result
+        if status_code < 400 and str(out.get("status", "")).upper() in TERMINAL_STATUSES:
+            _terminal_status_cache.set(key, result)
+    out, status_code = result
+    return dict(out), status_code
+
+
+# ───────────────────────────────────────────────
+# 📉 תשובות סטטוס מצומצמות: בחירת שדות, בלי מילים, דפדוף בסגמנטים, עמודות, msgpack ודחיסה
+STATUS_FORMATS = {"json", "columnar", "msgpack"}
+
+
+class StatusViewError(Exception):
+    pass
+
+
+def status_view(
+    fields: str | None = None,
+    words: bool = True,
+    offset: int = 0,
+    limit: int | None = None,
+    format: str = "json",
+) -> dict:
+    """פרמטרי תצוגה של /status (query); ב-/status/batch – אותם שמות בגוף הבקשה."""
+    if format not in STATUS_FORMATS:
+        raise StatusViewError(f"format חייב להיות אחד מ: {', '.join(sorted(STATUS_FORMATS))}")
+    if format == "msgpack" and msgpack is None:
+        raise StatusViewError("msgpack לא מותקן בשרת")
+    return {
+        "fields": {f.strip() for f in fields.split(",") if f.strip()} if fields else None,
+        "words": words,
+        "offset": max(int(offset or 0), 0),
+        "limit": max(int(limit), 0) if limit is not None else None,
+        "format": format,
+    }
+
+
+def _status_view_dependency(
+    fields: str | None = None,
+    words: bool = True,
+    offset: int = 0,
+    limit: int | None = None,
+    format: str = "json",
+):
+    try:
+        return status_view(fields, words, offset, limit, format)
+    except StatusViewError as e:
+        return e
+
+
+def project_status(out: dict, view: dict) -> dict:
+    """
+    מחזיר עותק מצומצם של תשובת הסטטוס (בלי לגעת במקור – הוא משותף ל-polls אחרים).
+    כשלא התבקש שום צמצום – מוחזרת התשובה כמו שהיא.
+    """
+    if view["fields"]:
+        out = {k: v for k, v in out.items() if k in view["fields"]}
+    outputs = out.get("output")
+    paged = view["offset"] or view["limit"] is not None
+    if not isinstance(outputs, list) or (view["words"] and not paged and view["format"] != "columnar"):
+        return out
+
+    segments = _iter_result_segments(outputs)
+    out = dict(out)
+    if paged:
+        end = view["offset"] + view["limit"] if view["limit"] is not None else None
+        out["_page"] = {"offset": view["offset"], "limit": view["limit"], "total": len(segments)}
+        segments = segments[view["offset"]:end]
+
+    if view["format"] == "columnar":
+        del out["output"]
+        out["columns"] = {
+            "start": [seg.get("start") for seg in segments],
+            "end": [seg.get("end") for seg in segments],
+            "speaker": [(_speakers(seg) or [None])[0] for seg in segments],
+            "text": [seg.get("text") for seg in segments],
+        }
+        if view["words"]:
+            out["columns"]["words"] = [seg.get("words") for seg in segments]
+        return out
+
+    if not view["words"]:
+        segments = [{k: v for k, v in seg.items() if k != "words"} for seg in segments]
+    first = outputs[0] if outputs and isinstance(outputs[0], dict) else {}
+    out["output"] = [{**first, "result": [segments]}]
+    return out
+
+
+def encoded_response(request: Request, content, status_code: int = 200, fmt: str = "json") -> Response:
+    """JSON (או msgpack), דחוס ב-brotli/gzip לפי Accept-Encoding כשהגוף גדול מ-STATUS_COMPRESS_MIN_BYTES."""
+    if fmt == "msgpack":
+        body, media_type = msgpack.packb(content, use_bin_type=True), "application/msgpack"
+    else:
+        body = json.dumps(content, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+        media_type = "application/json"
+
+    headers = {"Vary": "Accept-Encoding"}
+    if len(body) >= STATUS_COMPRESS_MIN_BYTES:
+        accepted = set()
+        for part in request.headers.get("accept-encoding", "").split(","):
+            name, _, params = part.partition(";")
+            if params.replace(" ", "") not in ("q=0", "q=0.0"):
+                accepted.add(name.strip().lower())
+        if brotli is not None and "br" in accepted:
+            body = brotli.compress(body, quality=4)
+            headers["Content-Encoding"] = "br"
+        elif "gzip" in accepted:
+            body = gzip.compress(body, compresslevel=5)
+            headers["Content-Encoding"] = "gzip"
+    return Response(body, status_code=status_code, media_type=media_type, headers=headers)
+
+
+@app.get("/status/{job_id}")
+async def get_job_status(
+    job_id: str,
+    request: Request,
+    user_email: str | None = None,
+    view=Depends(_status_view_dependency),
+):
+    """
+    בודק סטטוס מ-RunPod, מחייב (אם fallback),
+    ומעדכן נתוני עיבוד (זמן, חיוב, יחס, boot) במסד הנתונים.
+    אם אין התאמה לפי job_id → נופל להקצאת הרשומה האחרונה של המשתמש.
+
+    תצוגה (אופציונלי): fields=id,status,output · words=false · offset/limit (סגמנטים) ·
+    format=json|columnar|msgpack.
+    """
+    if isinstance(view, StatusViewError):
+        return JSONResponse({"error": str(view)}, status_code=400)
+    try:
+        out, status_code = await job_status(job_id, user_email)
+        return encoded_response(request, project_status(out, view), status_code, view["format"])
+
+    except Exception as e:
+        log.error("❌ /status error: %s", e)
+        return JSONResponse({"error": str(e)}, status_code=500)
+
+
+@app.post("/status/batch")
+async def get_job_statuses(request: Request):
+    """
+    סטטוס של הרבה jobs בבקשה אחת: {"job_ids": [...], "user_email": ...}
+    → {"jobs": {job_id: תשובת /status}}; לכל job עם שגיאה – {"error", "status_code"}.
+    פרמטרי התצוגה של /status (fields, words, offset, limit, format) – בגוף הבקשה.
+    """
+    try:
+        data = await request.json()
+        job_ids = list(dict.fromkeys(data.get("job_ids") or []))
+        user_email = data.get("user_email")
+        if not job_ids or len(job_ids) > STATUS_BATCH_MAX:
+            return JSONResponse({"error": f"job_ids חייב להכיל 1 עד {STATUS_BATCH_MAX} מזהים"}, status_code=400)
+        try:
+            view = status_view(
+                data.get("fields"), data.get("words", True), data.get("offset", 0),
+                data.get("limit"), data.get("format", "json"),
+            )
+        except StatusViewError as e:
+            return JSONResponse({"error": str(e)}, status_code=400)
+
+        sem = asyncio.Semaphore(BATCH_STATUS_CONCURRENCY)
+
+        async def one(job_id: str) -> dict:
+            async with sem:
+                try:
+                    out, status_code = await job_status(str(job_id), user_email)
+                except Exception as e:
+                    out, status_code = {"error": str(e)}, 500
+            if status_code >= 400:
+                return {**out, "status_code": status_code}
+            return project_status(out, view)
+
+        results = await asyncio.gather(*(one(job_id) for job_id in job_ids))
+        return encoded_response(request, {"jobs": dict(zip(job_ids, results))}, fmt=view["format"])
+
+    except Exception as e:
+        log.error("❌ /status/batch error: %s", e)
+        return JSONResponse({"error": str(e)}, status_code=500)
+
+
+# ───────────────────────────────────────────────
+# 🔔 Webhook של RunPod + המתנה לסיום job (long-poll / SSE)
+TERMINAL_STATUSES = {"COMPLETED", "FAILED", "CANCELLED", "TIMED_OUT"}
+
+
+def runpod_webhook_url() -> str:
+    return f"{BASE_URL}/webhooks/runpod/{RUNPOD_WEBHOOK_SECRET}"
+
+
+class JobEvents:
+    """
+    תוצאות סופיות של jobs שהגיעו ב-webhook, ו-asyncio.Event לכל job שמישהו ממתין לו.
+    התוצאות נשמרות בזיכרון לזמן מוגבל; אחרי restart חוזרים לשאילתת RunPod רגילה.
+    """
+
+    def __init__(self, maxsize: int = 4096, ttl: float = 3600):
+        self._results = TTLCache(maxsize, ttl)
+        self._waiters: dict[str, list] = {}   # job_id → [Event, מספר ממתינים]
+
+    def result(self, job_id: str) -> dict | None:
+        return self._results.get(job_id)
+
+    def publish(self, job_id: str, payload: dict):
+        self._results.set(job_id, payload)
+        waiter = self._waiters.pop(job_id, None)
+        if waiter:
+            waiter[0].set()
+
+    async def wait(self, job_id: str, timeout: float) -> dict | None:
+        """ממתין עד timeout שניות לתוצאה; מחזיר אותה, או None אם לא הגיעה."""
+        if (res := self.result(job_id)) is not None:
+            return res
+        waiter = self._waiters.setdefault(job_id, [asyncio.Event(), 0])
+        waiter[1] += 1
+        try:
+            await asyncio.wait_for(waiter[0].wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            waiter[1] -= 1
+            if waiter[1] <= 0 and self._waiters.get(job_id) is waiter:
+                del self._waiters[job_id]
+        return self.result(job_id)
+
+
+job_events = JobEvents()
+
+
+@app.post("/webhooks/runpod/{secret}")
+async def runpod_webhook(secret: str, request: Request):
+    """
+    מקבל מ-RunPod את תוצאת ה-job בסיומו (אותו מבנה כמו /status)
+    ומעיר את כל מי שממתין לה. החיוב עצמו נעשה כשהקליינט מקבל את התוצאה.
+    """
+    if not RUNPOD_WEBHOOK_SECRET or not secrets.compare_digest(secret, RUNPOD_WEBHOOK_SECRET):
+        return JSONResponse({"error": "forbidden"}, status_code=403)
+    try:
+        payload = await request.json()
+    except Exception:
+        return JSONResponse({"error": "invalid json"}, status_code=400)
+
+    job_id = payload.get("id")
+    status = str(payload.get("status", "")).upper()
+    if job_id and status in TERMINAL_STATUSES:
+        job_events.publish(job_id, payload)
+        log.info("🔔 webhook: job %s → %s", job_id, status)
+    return JSONResponse({"status": "ok"})
+
+
+@app.get("/jobs/{job_id}/wait")
+async def wait_for_job(job_id: str, user_email: str | None = None, timeout: float = 25):
+    """
+    Long-poll: מחזיר ברגע שה-webhook של ה-job מגיע, או אחרי timeout שניות
+    (עד JOB_WAIT_MAX_SECONDS) את הסטטוס הנוכחי. התשובה זהה לזו של /status.
+    """
+    try:
+        target = await run_in_threadpool(admission_queue.resolve, job_id)
+        if target and not is_local_job(target):
+            await job_events.wait(target, max(0.0, min(timeout, JOB_WAIT_MAX_SECONDS)))
+        out, status_code = await job_status(job_id, user_email)
+        return JSONResponse(content=out, status_code=status_code)
+    except Exception as e:
+        log.error("❌ /jobs/wait error: %s", e)
+        return JSONResponse({"error": str(e)}, status_code=500)
+
+
+@app.get("/jobs/{job_id}/events")
+async def job_event_stream(job_id: str, user_email: str | None = None):
+    """
+    Server-Sent Events: אירוע status מיידי, ואירוע נוסף כשה-job מסתיים.
+    כל 15 שניות נשלחת הערת keep-alive; אם webhook לא הגיע תוך
+    JOB_EVENTS_FALLBACK_POLL_SECONDS – נבדק הסטטוס ב-RunPod (למשל אחרי restart).
+    """
+
+    def sse(out: dict) -> str:
+        return f"event: status\ndata: {json.dumps(out, ensure_ascii=False)}\n\n"
+
+    async def stream():
+        try:
+            out, status_code = await job_status(job_id, user_email)
+            yield sse(out)
+            last_check = time.monotonic()
+            while status_code < 400 and str(out.get("status", "")).upper() not in TERMINAL_STATUSES:
+                target = await run_in_threadpool(admission_queue.resolve, job_id)
+                if target is None:
+                    # עדיין בתור – עדכון מיקום כל כמה שניות
+                    await asyncio.sleep(5)
+                    out, status_code = await job_status(job_id, user_email)
+                    yield sse(out)
+                    continue
+                if await job_events.wait(target, 15) is None and (
+                    time.monotonic() - last_check < JOB_EVENTS_FALLBACK_POLL_SECONDS
+                ):
+                    yield ": keep-alive\n\n"
+                    continue
+                out, status_code = await job_status(job_id, user_email)
+                last_check = time.monotonic()
+                yield sse(out)
+        except Exception as e:
+            log.error("❌ /jobs/events error: %s", e)
+            yield f"event: error\ndata: {json.dumps({'error': str(e)})}\n\n"
+
+    return StreamingResponse(
+        stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+
+# ───────────────────────────────────────────────
+# ✂️ פיצול הקלטות ארוכות: חיתוך בשקטים, job לכל קטע במקביל, ואיחוד עם תיקון זמנים ודוברים
+SPLIT_JOB_PREFIX = "split-"
+_split_locks = KeyedLocks()
+
+_DURATION_RE = re.compile(r"Duration: (\d+):(\d+):(\d+(?:\.\d+)?)")
+_SILENCE_START_RE = re.compile(r"silence_start: (-?\d+(?:\.\d+)?)")
+_SILENCE_END_RE = re.compile(r"silence_end: (\d+(?:\.\d+)?)")
+
+
+def is_local_job(job_id: str) -> bool:
+    """jobs שהסטטוס שלהם מחושב אצלנו (ולכן אין webhook להמתין לו)."""
+    return job_id.startswith((CACHED_JOB_PREFIX, SPLIT_JOB_PREFIX))
+
+
+def local_path_from_url(url: str | None) -> str | None:
+    prefix = f"{BASE_URL}/files/"
+    if not url or not url.startswith(prefix):
+        return None
+    path = os.path.join(UPLOAD_DIR, os.path.basename(unquote(url[len(prefix):])))
+    return path if os.path.isfile(path) else None
+
 
-        seconds = float(ms) / 1000.0
-        cost = seconds * RUNPOD_RATE_PER_SEC
+def detect_silences(path: str) -> tuple[float, list[tuple[float, float]]]:
+    """משך הקובץ ורשימת קטעי שקט (התחלה, סוף) בעזרת ffmpeg silencedetect."""
+    proc = subprocess.run(
+        [FFMPEG_BIN, "-hide_banner", "-nostats", "-i", path, "-vn",
+         "-af", f"silencedetect=noise={SPLIT_SILENCE_NOISE}:d={SPLIT_SILENCE_MIN_SECONDS}",
+         "-f", "null", "-"],
+        capture_output=True, text=True, check=True,
+    )
+    m = _DURATION_RE.search(proc.stderr)
+    duration = int(m.group(1)) * 3600 + int(m.group(2)) * 60 + float(m.group(3)) if m else 0.0
+    starts = [float(x) for x in _SILENCE_START_RE.findall(proc.stderr)]
+    ends = [float(x) for x in _SILENCE_END_RE.findall(proc.stderr)]
+    return duration, list(zip(starts, ends))
 
-        if cost > 0:
-            print(f"⏱ זמן עיבוד כולל: {seconds:.2f} שניות → עלות מוערכת: {cost:.8f}$")
-        else:
-            print("⚠️ זמן עיבוד לא זוהה בתגובה של RunPod:", resp_json.keys())
 
-        return round(cost, 8)
-    except Exception as e:
-        print(f"❌ שגיאה ב-estimate_cost_from_response: {e}")
-        return 0.0
+def choose_cut_points(duration: float, silences: list[tuple[float, float]], target: float) -> list[float]:
+    """נקודות חיתוך כל ~target שניות – באמצע השקט הקרוב ביותר (עד רבע קטע מהיעד)."""
+    cuts, pos = [], 0.0
+    mids = [(a + b) / 2 for a, b in silences]
+    while duration - pos > target * 1.25:
+        goal, window = pos + target, target / 4
+        near = [m for m in mids if goal - window <= m <= goal + window]
+        cut = min(near, key=lambda m: abs(m - goal)) if near else goal
+        cuts.append(cut)
+        pos = cut
+    return cuts
 
-# שליפת יתרה אמיתית מ-RunPod
-def get_real_runpod_balance(token: str) -> tuple[float, bool]:
+
+def extract_segment(path: str, start: float, end: float) -> str:
+    """חותך [start, end) לקובץ FLAC מונו 16kHz ומחזיר את שמו באחסון לפי תוכן."""
+    fd, tmp_path = tempfile.mkstemp(prefix=".split_", suffix=".flac", dir=UPLOAD_DIR)
+    os.close(fd)
     try:
-        payload = {
-            "query": "{ myself { clientBalance hostBalance } }"
-        }
-        r = requests.post(
-            "https://api.runpod.io/graphql",
-            headers={
-                "Authorization": f"Bearer {token}",
-                "Content-Type": "application/json",
-            },
-            json=payload,
-            timeout=10,
+        subprocess.run(
+            [FFMPEG_BIN, "-hide_banner", "-loglevel", "error", "-y",
+             "-ss", f"{start:.3f}", "-i", path, "-t", f"{end - start:.3f}",
+             "-vn", "-ac", "1", "-ar", "16000", "-c:a", "flac", tmp_path],
+            capture_output=True, check=True,
         )
+        filename, _ = store_blob(tmp_path, hash_file(tmp_path), os.path.getsize(tmp_path), ".flac")
+        return filename
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
 
-        if not r.ok:
-            print(f"❌ GraphQL account fetch failed: status={r.status_code}, body={r.text}")
-            return 0.0, False
 
-        data = r.json() or {}
-        if "errors" in data:
-            print(f"❌ GraphQL errors: {data['errors']}")
-            return 0.0, False
+def plan_split(path: str) -> list[dict]:
+    """
+    מחלק את הקובץ לקטעים. כל קטע (פרט לראשון) מתחיל SPLIT_OVERLAP_SECONDS לפני נקודת החיתוך –
+    החפיפה משמשת להתאמת דוברים בין קטעים, ותוכנה מגיע מהקטע הקודם.
+    """
+    duration, silences = detect_silences(path)
+    bounds = [0.0, *choose_cut_points(duration, silences, SPLIT_SEGMENT_SECONDS), duration]
+    segments = []
+    for i in range(len(bounds) - 1):
+        offset = max(0.0, bounds[i] - SPLIT_OVERLAP_SECONDS) if i else 0.0
+        filename = extract_segment(path, offset, bounds[i + 1])
+        segments.append({
+            "index": i,
+            "offset": offset,
+            "boundary": bounds[i],
+            "end": bounds[i + 1],
+            "url": file_url(filename),
+            "job_id": None,
+            "status": "PENDING",
+            "attempts": 0,
+        })
+    return segments
 
-        myself = (data.get("data") or {}).get("myself") or None
-        if not myself or "clientBalance" not in myself:
-            print(f"❌ GraphQL response missing clientBalance: {data}")
-            return 0.0, False
 
-        bal = float(myself.get("clientBalance", 0.0))
-        return bal, True
+def _with_url(run_input: dict, url: str) -> dict:
+    new = copy.deepcopy(run_input)
+    if isinstance(new.get("transcribe_args"), dict):
+        new["transcribe_args"]["url"] = url
+    else:
+        new["url"] = url
+    return new
+
+
+async def _submit_segment(token: str, run_input: dict, seg: dict):
+    """שליחת קטע אחד; כישלון (גם חריגה) מסמן SUBMIT_FAILED ונספר מול SPLIT_MAX_RETRIES – לא מפיל את השאר."""
+    seg["attempts"] += 1
+    try:
+        out, status_code = await submit_runpod_job(token, {"input": _with_url(run_input, seg["url"])})
     except Exception as e:
-        print(f"❌ Error parsing GraphQL balance: {e}")
-        return 0.0, False
-# ───────────────────────────────────────────────
-@app.post("/upload")
-async def upload_file(request: Request, file: UploadFile = File(None)):
+        log.warning("⚠️ קטע %s לא נשלח: %s", seg["index"], e)
+        seg.update({"job_id": None, "status": "SUBMIT_FAILED", "error": str(e)})
+        return
+    if status_code < 400 and out.get("id"):
+        seg.update({"job_id": out["id"], "status": out.get("status", "IN_QUEUE")})
+    else:
+        seg.update({"job_id": None, "status": "SUBMIT_FAILED", "error": out.get("error") or status_code})
+
+
+def _save_split(split_id: str, segments: list[dict], status: str, result=None):
+    state_db().execute(
+        "UPDATE split_jobs SET segments = ?, status = ?, result = ?, updated_at = ? WHERE id = ?",
+        (json.dumps(segments, ensure_ascii=False), status,
+         zlib.compress(json.dumps(result, ensure_ascii=False).encode("utf-8")) if result is not None else None,
+         time.time(), split_id),
+    )
+
+
+async def start_split_job(user_email: str, using_fallback: bool, token: str, run_body: dict) -> tuple[dict, int]:
+    run_input = run_body.get("input") or {}
+    url = (run_input.get("transcribe_args") or {}).get("url") or run_input.get("url")
+    path = local_path_from_url(url)
+    if not path:
+        return {"error": "מצב פיצול דורש קובץ שהועלה לשרת הזה (/upload או /fetch-and-store-audio)"}, 400
+    try:
+        segments = await run_in_threadpool(plan_split, path)
+    except FileNotFoundError:
+        return {"error": f"ffmpeg לא נמצא ({FFMPEG_BIN}) – מצב פיצול לא זמין"}, 501
+
+    split_id = f"{SPLIT_JOB_PREFIX}{uuid.uuid4().hex}"
+    now = time.time()
+    await run_in_threadpool(lambda: state_db().execute(
+        "INSERT INTO split_jobs (id, user_email, using_fallback, run_input, segments, status, created_at, updated_at) "
+        "VALUES (?, ?, ?, ?, ?, 'IN_QUEUE', ?, ?)",
+        (split_id, user_email, int(using_fallback), json.dumps(run_input, ensure_ascii=False), "[]", now, now),
+    ))
+    sem = asyncio.Semaphore(SPLIT_SUBMIT_CONCURRENCY)
+
+    async def submit(seg):
+        async with sem:
+            await _submit_segment(token, run_input, seg)
+
+    await asyncio.gather(*(submit(seg) for seg in segments))
+    await run_in_threadpool(_save_split, split_id, segments, "IN_QUEUE")
+    log.info("✂️ /transcribe split → user=%s, %s, %s segments", user_email, split_id, len(segments))
+    return {"id": split_id, "status": "IN_QUEUE", "segments": {"total": len(segments)}}, 200
+
+
+async def split_job_status(split_id: str) -> tuple[dict, int]:
     """
-    מקבל קובץ מהקליינט, שומר זמנית בשרת ומחזיר URL גישה.
+    מרענן את סטטוס הקטעים (webhook או RunPod), שולח מחדש קטעים שנכשלו (עד SPLIT_MAX_RETRIES),
+    וכשכולם הושלמו – מאחד לתמלול אחד, מחייב פעם אחת ושומר את התוצאה.
     """
-    try:
-        filename, content = None, None
-        if file:
-            filename, content = file.filename, await file.read()
+    async with _split_locks(split_id):
+        row = await run_in_threadpool(
+            lambda: state_db().execute("SELECT * FROM split_jobs WHERE id = ?", (split_id,)).fetchone()
+        )
+        if row is None:
+            return {"error": "job לא נמצא"}, 404
+        user_email, using_fallback = row["user_email"], bool(row["using_fallback"])
+
+        if row["status"] == "COMPLETED" and row["result"]:
+            out = json.loads(zlib.decompress(row["result"]))
         else:
-            body = await request.body()
-            if body:
-                filename, content = f"upload_{int(time.time())}.bin", body
-        if not content:
-            return JSONResponse({"error": "לא התקבל קובץ תקין."}, status_code=400)
+            # הקטעים נשלחו עם טוקן מסוים – נשארים עליו גם אם בינתיים נשמר (או נמחק) טוקן אישי
+            if using_fallback:
+                token = RUNPOD_API_KEY
+            else:
+                token, token_is_fallback = await run_in_threadpool(get_user_token, user_email)
+                if token_is_fallback:
+                    token = None
+            if not token:
+                return {"error": "Missing token"}, 401
+            run_input = json.loads(row["run_input"])
+            segments = json.loads(row["segments"])
 
-        file_path = os.path.join(UPLOAD_DIR, filename)
-        with open(file_path, "wb") as f:
-            f.write(content)
-        delete_later(file_path)
-        encoded_filename = quote(filename)
-        file_url = f"{BASE_URL}/files/{encoded_filename}"
-        return JSONResponse({"url": file_url, "message": "הקובץ הועלה בהצלחה ויימחק תוך שעה."})
-    except Exception as e:
-        return JSONResponse({"error": f"שגיאה בעת העלאת הקובץ: {str(e)}"}, status_code=500)
+            async def refresh(seg):
+                if seg["status"] in ("COMPLETED", "FAILED"):
+                    return
+                if seg["job_id"]:
+                    res = job_events.result(seg["job_id"])
+                    if res is None:
+                        res, code = await fetch_runpod_status(token, seg["job_id"])
+                        if code >= 400:
+                            return
+                    status = str(res.get("status", "")).upper()
+                    if status == "COMPLETED":
+                        seg.update({
+                            "status": "COMPLETED",
+                            "output": res.get("output"),
+                            "executionTime": res.get("executionTime") or 0,
+                            "delayTime": res.get("delayTime") or 0,
+                        })
+                        return
+                    if status not in TERMINAL_STATUSES:
+                        seg["status"] = status or seg["status"]
+                        return
+                    seg["error"] = res.get("error") or status
+                # נכשל (או לא נשלח) – שליחה חוזרת של הקטע הזה בלבד
+                if seg["attempts"] > SPLIT_MAX_RETRIES:
+                    seg["status"] = "FAILED"
+                    return
+                log.warning(
+                    "🔁 split %s: קטע %s נשלח מחדש (ניסיון %s)",
+                    split_id,
+                    seg["index"],
+                    seg["attempts"] + 1,
+                )
+                await _submit_segment(token, run_input, seg)
 
+            await asyncio.gather(*(refresh(seg) for seg in segments))
+            done = sum(seg["status"] == "COMPLETED" for seg in segments)
+            failed = [seg["index"] for seg in segments if seg["status"] == "FAILED"]
 
-@app.get("/files/{filename}")
-async def get_file(filename: str):
-    decoded_filename = unquote(filename)
-    file_path = os.path.join(UPLOAD_DIR, decoded_filename)
-    if os.path.exists(file_path):
-        return FileResponse(file_path)
-    return JSONResponse({"error": "הקובץ נמחק או לא נמצא."}, status_code=404)
+            if failed:
+                await run_in_threadpool(_save_split, split_id, segments, "FAILED")
+                return {"id": split_id, "status": "FAILED", "error": f"קטעים שנכשלו: {failed}"}, 200
+            if done < len(segments):
+                await run_in_threadpool(_save_split, split_id, segments, "IN_PROGRESS")
+                return {
+                    "id": split_id,
+                    "status": "IN_PROGRESS",
+                    "segments": {
+                        "total": len(segments),
+                        "completed": done,
+                        "retries": sum(max(seg["attempts"] - 1, 0) for seg in segments),
+                    },
+                }, 200
 
+            merged, speaker_maps = merge_split_outputs(segments)
+            out = {
+                "id": split_id,
+                "status": "COMPLETED",
+                "delayTime": max(seg["delayTime"] for seg in segments),
+                "executionTime": sum(seg["executionTime"] for seg in segments),
+                "output": [{"result": [merged]}],
+                "_split": {
+                    "segments": [
+                        {"index": seg["index"], "offset": seg["offset"], "job_id": seg["job_id"]}
+                        for seg in segments
+                    ],
+                    "speaker_maps": speaker_maps,
+                },
+            }
+            for seg in segments:
+                seg.pop("output", None)
+            await run_in_threadpool(_save_split, split_id, segments, "COMPLETED", out)
+            log.info("✂️ split %s הושלם: %s קטעים, %s סגמנטים", split_id, len(segments), len(merged))
 
-# ───────────────────────────────────────────────
-# 📥 שליפת קובץ מדרייב לשרת (לתמלול)
-@app.get("/fetch-and-store-audio")
-async def fetch_and_store_audio(request: Request, file_id: str):
-    """
-    שולף קובץ מדרייב, שומר זמנית, מחזיר URL.
-    תומך ב-Authorization header עם Bearer token.
+    # חיוב (idempotent לפי split_id) ועדכון נתוני ביצועים – כמו job רגיל
+    return await finish_job(split_id, user_email, using_fallback, out), 200
+
+
+def _iter_result_segments(output) -> list[dict]:
+    """output[i]["result"] הוא רשימה של קבוצות סגמנטים (או של סגמנטים) – משטחים לרשימה אחת."""
+    segs = []
+    for item in output or []:
+        for group in (item.get("result") if isinstance(item, dict) else None) or []:
+            if isinstance(group, dict):
+                segs.append(group)
+            elif isinstance(group, list):
+                segs.extend(g for g in group if isinstance(g, dict))
+    return segs
+
+
+def _speakers(seg: dict) -> list[str]:
+    if isinstance(seg.get("speakers"), list):
+        return [s for s in seg["speakers"] if s]
+    return [seg["speaker"]] if seg.get("speaker") else []
+
+
+def _shift_segment(seg: dict, offset: float) -> dict:
+    seg = copy.deepcopy(seg)
+    for item in [seg, *(seg.get("words") or [])]:
+        for key in ("start", "end"):
+            if isinstance(item.get(key), (int, float)):
+                item[key] = round(item[key] + offset, 3)
+    return seg
+
+
+def _relabel(seg: dict, mapping: dict):
+    if isinstance(seg.get("speakers"), list):
+        seg["speakers"] = [mapping.get(s, s) for s in seg["speakers"]]
+    for item in [seg, *(seg.get("words") or [])]:
+        if item.get("speaker"):
+            item["speaker"] = mapping.get(item["speaker"], item["speaker"])
+
+
+def merge_split_outputs(segments: list[dict]) -> tuple[list[dict], list[dict]]:
     """
-    try:
-        auth_header = request.headers.get("Authorization")
-        if not auth_header or not auth_header.startswith("Bearer "):
-            return JSONResponse({"error": "חסר access token של Google"}, status_code=400)
+    מאחד את תוצאות הקטעים לרשימת סגמנטים אחת בזמנים של הקובץ המקורי.
 
-        token = auth_header.split("Bearer ")[1]
-        headers = {"Authorization": f"Bearer {token}"}
-        drive_url = f"https://www.googleapis.com/drive/v3/files/{file_id}?alt=media"
-
-        res = requests.get(drive_url, headers=headers, stream=True)
-        if not res.ok:
-            return JSONResponse({"error": f"שגיאה בשליפת קובץ מדרייב: {res.text}"}, status_code=res.status_code)
-
-        content_type = res.headers.get("Content-Type", "application/octet-stream")
-        ext_map = {
-            "audio/mp4": ".m4a",
-            "audio/x-m4a": ".m4a",
-            "audio/mpeg": ".mp3",
-            "audio/wav": ".wav",
-            "video/mp4": ".mp4",
-        }
-        ext = ext_map.get(content_type, ".audio")
+    - זמנים (כולל מילים) מוזזים ב-offset של הקטע.
+    - מקטע i נשמרים רק סגמנטים שאמצעם אחרי נקודת החיתוך; מה שלפניה (אזור החפיפה) כבר הגיע מהקטע הקודם.
+    - דוברים: באזור החפיפה משווים מי מדבר מתי בשני הקטעים, ומצמידים כל דובר מקומי לדובר הגלובלי
+      שחופף לו הכי הרבה זמן. דובר בלי התאמה שומר את שמו אם אף דובר גלובלי (מקטעים קודמים או מהקטע הזה)
+      לא משתמש בו, אחרת מקבל שם חדש.
+    """
+    merged: list[dict] = []
+    speaker_maps: list[dict] = []
+    used: set[str] = set()
 
-        filename = f"drive_{file_id}_{int(time.time())}{ext}"
-        file_path = os.path.join(UPLOAD_DIR, filename)
+    for i, part in enumerate(segments):
+        shifted = [_shift_segment(s, part["offset"]) for s in _iter_result_segments(part.get("output"))]
+        boundary = part["boundary"]
+        local = sorted({sp for s in shifted for sp in _speakers(s)})
+        mapping: dict[str, str] = {}
 
-        with open(file_path, "wb") as f:
-            for chunk in res.iter_content(chunk_size=8192):
-                f.write(chunk)
+        if i:
+            overlap = defaultdict(float)
+            tail = [b for b in merged if b.get("end", 0) > part["offset"]]
+            for a in shifted:
+                if a.get("start", 0) >= boundary:
+                    continue
+                for b in tail:
+                    inter = (min(a.get("end", 0), b.get("end", 0), boundary)
+                             - max(a.get("start", 0), b.get("start", 0), part["offset"]))
+                    if inter > 0:
+                        for la in _speakers(a):
+                            for gb in _speakers(b):
+                                overlap[(la, gb)] += inter
+            taken: set[str] = set()
+            for (la, gb), _ in sorted(overlap.items(), key=lambda kv: -kv[1]):
+                if la not in mapping and gb not in taken:
+                    mapping[la] = gb
+                    taken.add(gb)
+            for la in local:
+                if la in mapping:
+                    continue
+                if la not in used | taken:
+                    mapping[la] = la
+                else:
+                    n = 0
+                    while f"SPEAKER_{n:02d}" in used | taken:
+                        n += 1
+                    mapping[la] = f"SPEAKER_{n:02d}"
+                taken.add(mapping[la])
+        else:
+            mapping = {sp: sp for sp in local}
 
-        delete_later(file_path)
-        file_url = f"{BASE_URL}/files/{quote(filename)}"
-        print(f"✅ נשמר קובץ מדרייב: {file_path} ({content_type})")
-        return JSONResponse({"url": file_url})
+        for seg in shifted:
+            if i and (seg.get("start", 0) + seg.get("end", 0)) / 2 < boundary:
+                continue
+            _relabel(seg, mapping)
+            merged.append(seg)
+        used |= set(mapping.values())
+        speaker_maps.append(mapping)
 
-    except Exception as e:
-        print(f"❌ /fetch-and-store-audio error: {e}")
-        return JSONResponse({"error": str(e)}, status_code=500)
+    for n, seg in enumerate(merged):
+        if "id" in seg:
+            seg["id"] = n
+    return merged, speaker_maps
 
 
 # ───────────────────────────────────────────────
-@app.post("/transcribe")
-async def transcribe(request: Request):
+# 📦 שליחת אצווה: הרבה קבצים בבקשה אחת, טוקן ומגבלה נבדקים פעם אחת
+_batch_tasks: dict[str, asyncio.Task] = {}
+
+
+def _save_batch(batch_id: str, items: list[dict]):
+    state_db().execute(
+        "UPDATE batches SET items = ?, updated_at = ? WHERE id = ?",
+        (json.dumps(items, ensure_ascii=False), time.time(), batch_id),
+    )
+
+
+async def _run_batch(batch_id: str, user_email: str, using_fallback: bool, token: str, items: list[dict],
+                     google_token: str | None, transcribe_args: dict):
+    sem = asyncio.Semaphore(BATCH_SUBMIT_CONCURRENCY)
+
+    async def submit(item: dict):
+        async with sem:
+            try:
+                if not item.get("file_url"):
+                    if not google_token:
+                        raise DriveError("חסר access token של Google", 400)
+                    item["file_url"] = (await store_drive_file(item["drive_file_id"], google_token))["url"]
+                run_body = build_run_body({"file_url": item["file_url"]})
+                run_body["input"]["transcribe_args"].update(transcribe_args)
+
+                cache_key = await run_in_threadpool(result_cache.key_for, run_body["input"])
+                cached = await run_in_threadpool(result_cache.get, cache_key) if cache_key else None
+                if cached is not None:
+                    item.update({"job_id": f"{CACHED_JOB_PREFIX}{cache_key}", "status": "COMPLETED"})
+                    return
+                if using_fallback:
+                    ticket = await admission_queue.enqueue(user_email, run_body, cache_key)
+                    item.update({"job_id": ticket["id"], "status": "IN_QUEUE"})
+                    return
+                out, status_code = await submit_runpod_job(token, run_body)
+                if status_code >= 400 or not out.get("id"):
+                    item.update({"status": "FAILED", "error": out.get("error") or f"RunPod {status_code}"})
+                    return
+                item.update({"job_id": out["id"], "status": out.get("status", "IN_QUEUE")})
+                await run_in_threadpool(register_job, out["id"], user_email, False, cache_key=cache_key)
+            except Exception as e:
+                item.update({"status": "FAILED", "error": str(e)})
+            finally:
+                await run_in_threadpool(_save_batch, batch_id, items)
+
+    try:
+        await asyncio.gather(*(submit(item) for item in items))
+        log.info("📦 batch %s: %s/%s נשלחו", batch_id, sum(bool(i.get("job_id")) for i in items), len(items))
+    finally:
+        _batch_tasks.pop(batch_id, None)
+
+
+@app.post("/transcribe/batch")
+async def transcribe_batch(request: Request):
     """
-    שליחת בקשת תמלול ל-RunPod.
+    שליחת הרבה קבצים לתמלול בבקשה אחת.
 
-    ⚠️ שים לב:
-    - כאן **לא** מחויבים קרדיטים.
-    - החיוב נעשה רק ב-/status כשהסטטוס COMPLETED ויש executionTime.
+    גוף: {"user_email", "items": [{"file_url": ...} | {"drive_file_id": ...}], "transcribe_args": {...}}
+    (לקבצי דרייב – Authorization: Bearer <Google access token>).
+    הטוקן ומגבלת ה-fallback נבדקים פעם אחת; הקבצים נשלחים ברקע, עד BATCH_SUBMIT_CONCURRENCY במקביל.
+    מחזיר batch_id – ההתקדמות ב-GET /transcribe/batch/{batch_id}.
     """
     try:
         data = await request.json()
         user_email = data.get("user_email")
+        raw_items = data.get("items") or []
         if not user_email:
             return JSONResponse({"error": "user_email is required"}, status_code=400)
+        if not raw_items or len(raw_items) > BATCH_MAX_ITEMS:
+            return JSONResponse({"error": f"items חייב להכיל 1 עד {BATCH_MAX_ITEMS} קבצים"}, status_code=400)
 
-        # 🔑 שליפת טוקן (אישי או fallback)
-        token_to_use, using_fallback = get_user_token(user_email)
+        items = []
+        for n, raw in enumerate(raw_items):
+            raw = raw if isinstance(raw, dict) else {"file_url": raw}
+            if not raw.get("file_url") and not raw.get("drive_file_id"):
+                return JSONResponse({"error": f"פריט {n}: חסר file_url או drive_file_id"}, status_code=400)
+            items.append({
+                "index": n,
+                "file_url": raw.get("file_url"),
+                "drive_file_id": raw.get("drive_file_id"),
+                "job_id": None,
+                "status": "QUEUED",
+            })
 
+        token_to_use, using_fallback = await run_in_threadpool(get_user_token, user_email)
         if not token_to_use:
             return JSONResponse(
-                {
-                    "error": "לא הוגדר טוקן לשימוש (אין טוקן אישי ואין RUNPOD_API_KEY בשרת).",
-                    "action": "יש להזין טוקן RunPod אישי"
-                },
+                {"error": "לא הוגדר טוקן לשימוש (אין טוקן אישי ואין RUNPOD_API_KEY בשרת).",
+                 "action": "יש להזין טוקן RunPod אישי"},
                 status_code=401,
             )
-
-        # 🔒 בדיקת מגבלת שימוש (רק למשתמשים על fallback)
         if using_fallback:
-            allowed, used, limit = check_fallback_allowance(user_email)
+            allowed, used, limit = await run_in_threadpool(check_fallback_allowance, user_email)
             if not allowed:
                 return JSONResponse(
-                    {
-                        "error": "חריגה ממגבלת שימוש",
-                        "used": used,
-                        "limit": limit,
-                        "action": "יש להזין טוקן RunPod אישי"
-                    },
+                    {"error": "חריגה ממגבלת שימוש", "used": used, "limit": limit,
+                     "action": "יש להזין טוקן RunPod אישי"},
                     status_code=402,
                 )
 
-        # 🎯 בניית גוף הבקשה ל-RunPod
-        run_body = data
-        if "input" not in data and data.get("file_url"):
-            run_body = {
-                "input": {
-                    "engine": "stable-whisper",
-                    "model": "ivrit-ai/whisper-large-v3-turbo-ct2",
-                    "transcribe_args": {
-                        "url": data["file_url"],
-                        "language": "he",
-                        "diarize": True,
-                        "vad": True,
-                        "word_timestamps": True,
-                    },
-                }
-            }
+        auth_header = request.headers.get("Authorization") or ""
+        google_token = auth_header.split("Bearer ")[1] if auth_header.startswith("Bearer ") else None
 
-        # 🚀 שליחה ל-RunPod (asynchronous run)
-        response = requests.post(
-            "https://api.runpod.ai/v2/lco4rijwxicjyi/run",
-            headers={"Authorization": f"Bearer {token_to_use}", "Content-Type": "application/json"},
-            json=run_body,
-            timeout=180,
+        batch_id = f"batch-{uuid.uuid4().hex}"
+        now = time.time()
+        await run_in_threadpool(lambda: state_db().execute(
+            "INSERT INTO batches (id, user_email, using_fallback, items, created_at, updated_at) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (batch_id, user_email, int(using_fallback), json.dumps(items, ensure_ascii=False), now, now),
+        ))
+        _batch_tasks[batch_id] = asyncio.create_task(
+            _run_batch(batch_id, user_email, using_fallback, token_to_use, items, google_token,
+                       data.get("transcribe_args") or {})
         )
-
-        out = response.json() if response.content else {}
-        status_code = response.status_code if response.status_code else 200
-
-        print(f"🚀 /transcribe → user={user_email}, using_fallback={using_fallback}, resp_keys={list(out.keys())}")
-        return JSONResponse(content=out, status_code=status_code)
+        log.info("📦 /transcribe/batch → user=%s, %s, %s items", user_email, batch_id, len(items))
+        return JSONResponse({"batch_id": batch_id, "total": len(items), "status": "QUEUED"})
 
     except Exception as e:
-        print(f"❌ /transcribe error: {e}")
+        log.error("❌ /transcribe/batch error: %s", e)
         return JSONResponse({"error": str(e)}, status_code=500)
-# ───────────────────────────────────────────────
-@app.get("/status/{job_id}")
-def get_job_status(job_id: str, user_email: str | None = None):
-    """
-    בודק סטטוס מ-RunPod, מחייב (אם fallback),
-    ומעדכן נתוני עיבוד (זמן, חיוב, יחס, boot) במסד הנתונים.
-    אם אין התאמה לפי job_id → נופל להקצאת הרשומה האחרונה של המשתמש.
-    """
-    try:
-        # ───────────────────────────────────────────
-        # 🔑 שליפת טוקן לשימוש
-        # ───────────────────────────────────────────
-        if not user_email:
-            token_to_use, _ = get_user_token(None)
-        else:
-            token_to_use, using_fallback = get_user_token(user_email)
-
-        if not token_to_use:
-            return JSONResponse({"error": "Missing token"}, status_code=401)
-
-        # ───────────────────────────────────────────
-        # 📡 שליפת סטטוס מ-RunPod
-        # ───────────────────────────────────────────
-        r = requests.get(
-            "https://api.runpod.ai/v2/lco4rijwxicjyi/status/" + job_id,
-            headers={"Authorization": f"Bearer {token_to_use}"},
-            timeout=30,
-        )
-        if not r.ok:
-            return JSONResponse(
-                {"error": "שגיאה בשליפת סטטוס מ-RunPod"},
-                status_code=r.status_code,
-            )
-
-        out = r.json() if r.content else {}
-        print("🔍 RAW RunPod response:", out)
-
-        status_lower = str(out.get("status", "")).lower()
-        outputs = out.get("output") or []
-
-        # ───────────────────────────────────────────
-        # 💰 עדכון קרדיטים למשתמש fallback
-        # ───────────────────────────────────────────
-        if (
-            user_email
-            and "using_fallback" in locals()
-            and using_fallback
-            and status_lower == "completed"
-        ):
-            cost = estimate_cost_from_response(out)
-            if cost > 0:
-                new_used = add_fallback_usage(user_email, cost)
-                remaining = max(FALLBACK_LIMIT_DEFAULT - new_used, 0.0)
-
-                out["_usage"] = {
-                    "estimated_cost_usd": cost,
-                    "used_credits": new_used,
-                    "remaining": remaining,
-                }
-
-                print(
-                    f"💰 fallback user {user_email} used {cost:.8f}$ "
-                    f"(total {new_used:.6f}$, remaining {remaining:.6f}$)"
-                )
-            else:
-                print("⚖️ עלות לא אותרה או אפסית בתגובה של RunPod.")
-
-        # ───────────────────────────────────────────
-        # 🗄 עדכון נתוני ביצועים במסד
-        # ───────────────────────────────────────────
-        if status_lower == "completed":
-
-            # 1️⃣ ניסיון ראשון – לפי job_id
-            rec = (
-                supabase.table("transcriptions")
-                .select("id,audio_id")
-                .eq("job_id", job_id)
-                .maybe_single()
-                .execute()
-            )
-            row = rec.data if hasattr(rec, "data") else None
 
-            # 2️⃣ Fallback – אין job_id או לא נמצא: לוקחים את הרשומה האחרונה של המשתמש
-            if (not row or not row.get("audio_id")) and user_email:
-                try:
-                    rec2 = (
-                        supabase.table("transcriptions")
-                        .select("id,audio_id")
-                        .eq("user_email", user_email)
-                        .order("created_at", desc=True)
-                        .limit(1)
-                        .execute()
-                    )
-                    data2 = rec2.data if hasattr(rec2, "data") else None
-                    if data2:
-                        # supabase-py מחזיר בדרך כלל list
-                        if isinstance(data2, list):
-                            row = data2[0]
-                        else:
-                            row = data2
-                        print(
-                            f"🧩 Fallback: משתמש {user_email} → "
-                            f"משייך job_id={job_id} ל-audio_id={row.get('audio_id')}"
-                        )
-
-                        # נשמור גם את ה-job_id הזה ברשומה
-                        try:
-                            supabase.table("transcriptions").update(
-                                {
-                                    "job_id": job_id,
-                                    "updated_at": time.strftime(
-                                        "%Y-%m-%dT%H:%M:%S"
-                                    ),
-                                }
-                            ).eq("id", row["id"]).execute()
-                        except Exception as e:
-                            print("⚠️ כשל בעדכון job_id ב-fallback:", e)
-                except Exception as e:
-                    print("⚠️ כשל בשליפת fallback לפי user_email:", e)
-
-            if row and row.get("audio_id"):
-                audio_id = row["audio_id"]
 
-                # 2️⃣ זמן עיבוד בפועל (מ-RunPod)
-                exec_ms = out.get("executionTime", 0) or 0
-                exec_sec = float(exec_ms) / 1000.0
+@app.get("/transcribe/batch/{batch_id}")
+async def batch_progress(batch_id: str):
+    """התקדמות מצטברת של אצווה: סטטוס כל קובץ וספירה לפי סטטוס (התוצאות עצמן – ב-/status/{job_id})."""
+    try:
+        row = await run_in_threadpool(
+            lambda: state_db().execute("SELECT * FROM batches WHERE id = ?", (batch_id,)).fetchone()
+        )
+        if row is None:
+            return JSONResponse({"error": "batch לא נמצא"}, status_code=404)
+        user_email, items = row["user_email"], json.loads(row["items"])
+        submitting = batch_id in _batch_tasks
 
-                # 3️⃣ אורך האודיו – קודם מה-DB
-                audio_len = 0.0
-                try:
-                    len_rec = (
-                        supabase.table("transcriptions")
-                        .select("audio_length_seconds")
-                        .eq("audio_id", audio_id)
-                        .maybe_single()
-                        .execute()
-                    )
-                    if (
-                        hasattr(len_rec, "data")
-                        and len_rec.data
-                        and len_rec.data.get("audio_length_seconds") is not None
-                    ):
-                        audio_len = float(
-                            len_rec.data["audio_length_seconds"] or 0.0
-                        )
-                        print(f"📏 אורך אודיו מה-DB: {audio_len:.2f} שניות")
-                except Exception as e:
-                    print("⚠️ כשל בשליפת אורך אודיו מה-DB:", e)
-
-                # אם אין אורך ב-DB – ניסיון לחלץ מה-output
-                if (not audio_len) and outputs:
-                    try:
-                        if outputs[0].get("result"):
-                            last_seg = outputs[0]["result"][-1][-1]
-                            audio_len = float(last_seg.get("end", 0.0) or 0.0)
-                            print(
-                                f"📏 אורך אודיו מ-RunPod: {audio_len:.2f} שניות"
-                            )
-                    except Exception as e:
-                        print("⚠️ כשל בחילוץ אורך אודיו מ-output:", e)
-
-                # 4️⃣ יחס עיבוד
-                ratio = exec_sec / audio_len if audio_len > 0 else None
-
-                # 5️⃣ חיוב (על פי executionTime)
-                billing = exec_sec * 0.00016 if exec_sec > 0 else None
-
-                # 6️⃣ זמן boot
-                delay_ms = out.get("delayTime", 0) or 0
-                boot_sec = float(delay_ms) / 1000.0 if delay_ms else None
-
-                # 7️⃣ זמן משוער ע"פ אורך האודיו
-                estimated = audio_len * 0.08 if audio_len > 0 else None
-
-                updates = {
-                    "audio_length_seconds": audio_len or None,
-                    "estimated_processing_seconds": estimated,
-                    "actual_processing_seconds": exec_sec or None,
-                    "billing_usd": billing,
-                    "processing_ratio": ratio,
-                    "worker_boot_time_seconds": boot_sec,
-                    "updated_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
-                }
+        sem = asyncio.Semaphore(BATCH_STATUS_CONCURRENCY)
 
-                supabase.table("transcriptions").update(updates).eq(
-                    "audio_id", audio_id
-                ).execute()
+        async def refresh(item: dict):
+            if not item.get("job_id"):
+                # השליחה נקטעה (למשל restart) – הפריט לא יישלח יותר
+                if not submitting and item["status"] == "QUEUED":
+                    item.update({"status": "FAILED", "error": "השליחה נקטעה"})
+                return
+            if item["status"] in TERMINAL_STATUSES:
+                return
+            async with sem:
+                out, status_code = await job_status(item["job_id"], user_email)
+            if status_code < 400:
+                item["status"] = str(out.get("status") or item["status"]).upper()
 
-                print(
-                    f"🗄 נתוני ביצועים עודכנו לכל הרשומות עם audio_id={audio_id}"
-                )
-            else:
-                print(
-                    f"⚠️ לא נמצאה רשומה לעדכון עבור job_id={job_id} "
-                    f"(user_email={user_email})"
-                )
+        await asyncio.gather(*(refresh(item) for item in items))
+        if not submitting:
+            await run_in_threadpool(_save_batch, batch_id, items)
 
-        # ───────────────────────────────────────────
-        # החזרת תשובת RunPod כפי שהיא
-        # ───────────────────────────────────────────
-        return JSONResponse(content=out, status_code=r.status_code)
+        counts = Counter(item["status"] for item in items)
+        return JSONResponse({
+            "batch_id": batch_id,
+            "total": len(items),
+            "counts": dict(counts),
+            "done": not submitting and all(item["status"] in TERMINAL_STATUSES for item in items),
+            "items": [
+                {k: item.get(k) for k in ("index", "file_url", "drive_file_id", "job_id", "status", "error")}
+                for item in items
+            ],
+        })
 
     except Exception as e:
-        print(f"❌ /status error: {e}")
+        log.error("❌ /transcribe/batch status error: %s", e)
         return JSONResponse({"error": str(e)}, status_code=500)
 
 
-
 # ───────────────────────────────────────────────
 @app.get("/effective-balance")
-def effective_balance(user_email: str):
+async def effective_balance(user_email: str):
     """
     מחזיר יתרה אפקטיבית למשתמש.
 
     - אם המשתמש לא קיים → נוצרת רשומת fallback חדשה (used_credits=0, limit_credits=FALLBACK_LIMIT_DEFAULT).
-    - אם יש טוקן מוצפן אישי → נבדקת היתרה האמיתית ב-RunPod (GraphQL account API).
+    - אם יש טוקן מוצפן אישי → היתרה ב-RunPod (GraphQL account API), דרך balance_cache:
+      רענון ברקע כל BALANCE_CACHE_TTL שניות, ובינתיים הורדה מקומית של עלות jobs שהסתיימו.
       אם הטוקן האישי **לא תקין** → מוחקים אותו, עוברים ל-fallback ומחזירים need_token=True.
     - אחרת → נעשה שימוש ביתרת fallback (limit - used_credits).
 
@@ -570,7 +4265,7 @@ def effective_balance(user_email: str):
     """
     try:
         # 🟢 בדיקה אם המשתמש כבר קיים במסד
-        row = get_account(user_email)
+        row = await run_in_threadpool(get_account, user_email)
 
         # 🆕 אם אין רשומה – צור חדשה כ-fallback בלבד (בלי טוקן מוצפן)
         if not row:
@@ -579,9 +4274,10 @@ def effective_balance(user_email: str):
                 "used_credits": 0.0,
                 "limit_credits": FALLBACK_LIMIT_DEFAULT,
             }
-            supabase.table("accounts").insert(payload).execute()
+            await run_in_threadpool(supabase.table("accounts").insert(payload).execute)
+            invalidate_account(user_email)
             balance_str = f"{FALLBACK_LIMIT_DEFAULT:.6f}"
-            print(f"💰 יתרה נוכחית של {user_email}: {balance_str}$ (new fallback account)")
+            log.info("💰 יתרה נוכחית של %s: %s$ (new fallback account)", user_email, balance_str)
             return JSONResponse({
                 "balance": balance_str,
                 "need_token": False
@@ -590,26 +4286,29 @@ def effective_balance(user_email: str):
         # 🪙 אם יש טוקן מוצפן – נבדוק יתרה אמיתית בחשבון RunPod (GraphQL)
         enc = row.get("runpod_token_encrypted")
         if enc:
-            token = decrypt_token(enc)
+            token = decrypt_user_token(user_email, enc)
             if token:
-                bal, valid = get_real_runpod_balance(token)
+                bal, valid = await balance_cache.get(token)
 
                 if valid:
                     balance_str = f"{bal:.6f}"
-                    print(f"💰 יתרה נוכחית של {user_email}: {balance_str}$ (personal token)")
+                    log.info("💰 יתרה נוכחית של %s: %s$ (personal token)", user_email, balance_str)
                     return JSONResponse({
                         "balance": balance_str,
                         "need_token": False
                     })
                 else:
                     # 🔴 טוקן אישי לא תקין → מוחקים אותו ועוברים למצב fallback
-                    print(f"⚠️ טוקן אישי לא תקין עבור {user_email} – מעבר ל-fallback ומבוקש טוקן חדש.")
-                    supabase.table("accounts").update(
-                        {
-                            "runpod_token_encrypted": None,
-                            "updated_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
-                        }
-                    ).eq("user_email", user_email).execute()
+                    log.warning("⚠️ טוקן אישי לא תקין עבור %s – מעבר ל-fallback ומבוקש טוקן חדש.", user_email)
+                    await run_in_threadpool(
+                        supabase.table("accounts").update(
+                            {
+                                "runpod_token_encrypted": None,
+                                "updated_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                            }
+                        ).eq("user_email", user_email).execute
+                    )
+                    invalidate_account(user_email)
                     # נמשיך מטה לחישוב fallback
 
         # 🧮 חישוב יתרת fallback
@@ -618,7 +4317,7 @@ def effective_balance(user_email: str):
         remaining = max(limit - used, 0.0)
         balance_str = f"{remaining:.6f}"
 
-        print(f"💰 יתרה נוכחית של {user_email}: {balance_str}$ (fallback)")
+        log.info("💰 יתרה נוכחית של %s: %s$ (fallback)", user_email, balance_str)
         need_token_flag = remaining <= 0 or (enc is not None)
 
         return JSONResponse({
@@ -627,7 +4326,7 @@ def effective_balance(user_email: str):
         })
 
     except Exception as e:
-        print(f"❌ /effective-balance error: {e}")
+        log.error("❌ /effective-balance error: %s", e)
         return JSONResponse({"error": str(e)}, status_code=500)
 
 
@@ -643,67 +4342,73 @@ async def create_transcription(request: Request):
         audio_id = body.get("audio_id")
         media_type = body.get("media_type", "audio")
 
-        res = supabase.table("transcriptions").insert({
+        res = await run_in_threadpool(supabase.table("transcriptions").insert({
             "user_email": user_email,
             "alias": alias,
             "folder_id": folder_id,
             "audio_id": audio_id,
             "media_type": media_type
-        }).execute()
+        }).execute)
 
         return JSONResponse({"status": "ok", "data": res.data})
 
     except Exception as e:
-        print("❌ /db/transcriptions/create:", e)
+        log.error("❌ /db/transcriptions/create: %s", e)
         return JSONResponse({"error": str(e)}, status_code=500)
 
 
+def normalize_transcription_updates(updates: dict) -> dict:
+    """updated_at עדכני, והמרת שדות מספריים שמגיעים מהקליינט כמחרוזות."""
+    # 🕒 תמיד מעדכן זמן
+    updates["updated_at"] = time.strftime("%Y-%m-%dT%H:%M:%S")
+
+    # 🎵 שמירת אורך האודיו (אם קיים)
+    if "audio_length_seconds" in updates:
+        try:
+            updates["audio_length_seconds"] = float(updates["audio_length_seconds"])
+        except:
+            pass
+
+    # ⏱️ זמן עיבוד משוער
+    if "estimated_processing_seconds" in updates:
+        try:
+            updates["estimated_processing_seconds"] = float(updates["estimated_processing_seconds"])
+        except:
+            pass
+
+    # 🧾 שמירת גודל קובץ
+    if "file_size_bytes" in updates:
+        try:
+            updates["file_size_bytes"] = int(updates["file_size_bytes"])
+        except:
+            pass
+
+    return updates
+
+
 @app.post("/db/transcriptions/update")
 async def update_transcription(request: Request):
     try:
         body = await request.json()
         id = body.get("id")
-        updates = body.get("updates", {})
-
-        # 🕒 תמיד מעדכן זמן
-        updates["updated_at"] = time.strftime("%Y-%m-%dT%H:%M:%S")
-
-        # 🎵 שמירת אורך האודיו (אם קיים)
-        if "audio_length_seconds" in updates:
-            try:
-                updates["audio_length_seconds"] = float(updates["audio_length_seconds"])
-            except:
-                pass
-
-        # ⏱️ זמן עיבוד משוער
-        if "estimated_processing_seconds" in updates:
-            try:
-                updates["estimated_processing_seconds"] = float(updates["estimated_processing_seconds"])
-            except:
-                pass
-
-        # 🧾 שמירת גודל קובץ
-        if "file_size_bytes" in updates:
-            try:
-                updates["file_size_bytes"] = int(updates["file_size_bytes"])
-            except:
-                pass
+        updates = normalize_transcription_updates(body.get("updates", {}))
 
-        # 🆔 שמירת job_id
-        if "job_id" in updates:
-            updates["job_id"] = updates["job_id"]
+        if TRANSCRIPTION_WRITE_BEHIND:
+            # 🗄 נכתב ב-flush הבא; /db/transcriptions/get כבר מחזיר את הערכים החדשים
+            await run_in_threadpool(transcription_writes.update, "id", id, updates)
+            return JSONResponse({"status": "ok", "data": None, "queued": True})
 
-        res = (
+        res = await run_in_threadpool(
             supabase.table("transcriptions")
             .update(updates)
             .eq("id", id)
-            .execute()
+            .execute
         )
 
         return JSONResponse({"status": "ok", "data": res.data})
 
     except Exception as e:
-        print("❌ /db/transcriptions/update:", e)
+        log.error("❌ /db/transcriptions/update: %s", e)
         return JSONResponse({"error": str(e)}, status_code=500)
 @app.get("/db/transcriptions/get")
 def get_transcription(id: str):
@@ -720,12 +4425,152 @@ def get_transcription(id: str):
         )
 
         if result.data:
-            return JSONResponse(content=result.data, status_code=200)
+            return JSONResponse(content=transcription_writes.overlay(result.data), status_code=200)
         else:
             return JSONResponse({"error": "רשומה לא נמצאה"}, status_code=404)
 
     except Exception as e:
-        print(f"❌ /db/transcriptions/get: {e}")
+        log.error("❌ /db/transcriptions/get: %s", e)
+        return JSONResponse({"error": str(e)}, status_code=500)
+
+
+# 📂 רשימה (keyset) ופעולות מרובות – תיקייה שלמה בבקשה אחת או שתיים
+_COLUMN_NAME = re.compile(r"^[a-z_][a-z0-9_]*$")
+
+
+def _list_cursor(row: dict) -> str:
+    return base64.urlsafe_b64encode(json.dumps([row["created_at"], row["id"]]).encode()).decode()
+
+
+def _parse_list_cursor(cursor: str) -> tuple[str, str]:
+    created_at, row_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    return str(created_at), str(row_id)
+
+
+@app.get("/db/transcriptions/list")
+def list_transcriptions(
+    user_email: str | None = None,
+    folder_id: str | None = None,
+    columns: str | None = None,
+    limit: int = 100,
+    cursor: str | None = None,
+):
+    """
+    תמלולים של משתמש ו/או תיקייה, מהחדש לישן, בדפים של עד TRANSCRIPTIONS_PAGE_MAX.
+    columns=id,alias,... – רק העמודות האלה (id ו-created_at תמיד נכללים).
+    folder_id=null – תמלולים שלא בתיקייה.
+    הדף הבא: cursor=next_cursor מהתשובה הקודמת (keyset לפי created_at,id – בלי OFFSET).
+    """
+    if not user_email and not folder_id:
+        return JSONResponse({"error": "חסר user_email או folder_id"}, status_code=400)
+    if not 1 <= limit <= TRANSCRIPTIONS_PAGE_MAX:
+        return JSONResponse({"error": f"limit חייב להיות בין 1 ל-{TRANSCRIPTIONS_PAGE_MAX}"}, status_code=400)
+
+    wanted = [c.strip() for c in columns.split(",") if c.strip()] if columns else ["*"]
+    if wanted != ["*"]:
+        bad = [c for c in wanted if not _COLUMN_NAME.match(c)]
+        if bad:
+            return JSONResponse({"error": f"עמודות לא חוקיות: {', '.join(bad)}"}, status_code=400)
+        wanted = list(dict.fromkeys(["id", "created_at", *wanted]))
+    # audio_id – גם בשביל עדכונים ממתינים של write-behind (לפי audio_id)
+    select = "*" if wanted == ["*"] else ",".join(dict.fromkeys([*wanted, "audio_id"]))
+
+    try:
+        query = supabase.table("transcriptions").select(select)
+        if user_email:
+            query = query.eq("user_email", user_email)
+        if folder_id == "null":
+            query = query.is_("folder_id", "null")
+        elif folder_id:
+            query = query.eq("folder_id", folder_id)
+        if cursor:
+            try:
+                created_at, row_id = _parse_list_cursor(cursor)
+            except Exception:
+                return JSONResponse({"error": "cursor לא תקין"}, status_code=400)
+            query = query.or_(
+                f'created_at.lt."{created_at}",and(created_at.eq."{created_at}",id.lt."{row_id}")'
+            )
+        res = query.order("created_at", desc=True).order("id", desc=True).limit(limit + 1).execute()
+
+        rows = res.data or []
+        more = len(rows) > limit
+        rows = rows[:limit]
+        items = [transcription_writes.overlay(row) for row in rows]
+        if wanted != ["*"]:
+            items = [{c: item.get(c) for c in wanted} for item in items]
+        return JSONResponse({
+            "items": items,
+            "next_cursor": _list_cursor(rows[-1]) if more else None,
+        })
+
+    except Exception as e:
+        log.error("❌ /db/transcriptions/list: %s", e)
+        return JSONResponse({"error": str(e)}, status_code=500)
+
+
+def _bulk_ids(body: dict) -> list | JSONResponse:
+    ids = body.get("ids")
+    if not isinstance(ids, list) or not 1 <= len(ids) <= TRANSCRIPTIONS_BULK_MAX:
+        return JSONResponse({"error": f"ids חייב להכיל 1 עד {TRANSCRIPTIONS_BULK_MAX} מזהים"}, status_code=400)
+    return list(dict.fromkeys(ids))
+
+
+@app.post("/db/transcriptions/bulk-update")
+async def bulk_update_transcriptions(request: Request):
+    """
+    {"ids": [...], "updates": {...}, "user_email": (אופציונלי – רק רשומות שלו)}
+    אותו עדכון לכל הרשומות, ב-UPDATE אחד.
+    """
+    try:
+        body = await request.json()
+        ids = _bulk_ids(body)
+        if isinstance(ids, JSONResponse):
+            return ids
+        updates = body.get("updates")
+        if not isinstance(updates, dict) or not updates:
+            return JSONResponse({"error": "חסר updates"}, status_code=400)
+        updates = normalize_transcription_updates(updates)
+
+        def run():
+            # עדכונים ממתינים (write-behind) נכתבים קודם – כדי שלא ידרסו את העדכון הזה
+            transcription_writes.flush()
+            query = supabase.table("transcriptions").update(updates).in_("id", ids)
+            if body.get("user_email"):
+                query = query.eq("user_email", body["user_email"])
+            return query.execute()
+
+        res = await run_in_threadpool(run)
+        return JSONResponse({"status": "ok", "updated": len(res.data or []), "data": res.data})
+
+    except Exception as e:
+        log.error("❌ /db/transcriptions/bulk-update: %s", e)
+        return JSONResponse({"error": str(e)}, status_code=500)
+
+
+@app.post("/db/transcriptions/bulk-delete")
+async def bulk_delete_transcriptions(request: Request):
+    """{"ids": [...], "user_email": (אופציונלי – רק רשומות שלו)} – DELETE אחד."""
+    try:
+        body = await request.json()
+        ids = _bulk_ids(body)
+        if isinstance(ids, JSONResponse):
+            return ids
+
+        def run():
+            for id in ids:
+                transcription_writes.discard("id", id)
+            query = supabase.table("transcriptions").delete().in_("id", ids)
+            if body.get("user_email"):
+                query = query.eq("user_email", body["user_email"])
+            return query.execute()
+
+        res = await run_in_threadpool(run)
+        deleted = [row.get("id") for row in res.data or []]
+        return JSONResponse({"status": "deleted", "deleted": len(deleted), "ids": deleted})
+
+    except Exception as e:
+        log.error("❌ /db/transcriptions/bulk-delete: %s", e)
         return JSONResponse({"error": str(e)}, status_code=500)
 
 
@@ -735,11 +4580,12 @@ async def delete_transcription(request: Request):
         body = await request.json()
         id = body.get("id")
 
-        supabase.table("transcriptions").delete().eq("id", id).execute()
+        transcription_writes.discard("id", id)
+        await run_in_threadpool(supabase.table("transcriptions").delete().eq("id", id).execute)
         return JSONResponse({"status": "deleted", "id": id})
 
     except Exception as e:
-        print("❌ /db/transcriptions/delete:", e)
+        log.error("❌ /db/transcriptions/delete: %s", e)
         return JSONResponse({"error": str(e)}, status_code=500)
 
 
@@ -766,7 +4612,7 @@ async def save_token(request: Request):
             return JSONResponse({"error": "ENCRYPTION_KEY לא מוגדר בשרת"}, status_code=500)
 
         # ✔️ בדיקת תקינות טוקן מול RunPod (כולל clientBalance)
-        balance, valid = get_real_runpod_balance(token)
+        balance, valid = await get_real_runpod_balance(token)
         if not valid:
             return JSONResponse({"error": "טוקן RunPod שגוי או לא מורשה"}, status_code=400)
 
@@ -779,25 +4625,29 @@ async def save_token(request: Request):
         padded = token.encode() + bytes([padding_len]) * padding_len
         encrypted = base64.b64encode(iv + cipher.encrypt(padded)).decode()
 
-        # ✔️ שמירה ב-DB
-        row = get_account(user_email)
-        if row:
-            supabase.table("accounts").update(
-                {
-                    "runpod_token_encrypted": encrypted,
-                    "used_credits": 0.0,  # איפוס fallback — מרגע זה החיוב עובר למשתמש
-                    "updated_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
-                }
-            ).eq("user_email", user_email).execute()
-        else:
-            supabase.table("accounts").insert(
-                {
-                    "user_email": user_email,
-                    "runpod_token_encrypted": encrypted,
-                    "used_credits": 0.0,
-                    "limit_credits": FALLBACK_LIMIT_DEFAULT,
-                }
-            ).execute()
+        # ✔️ שמירה ב-DB (Supabase סינכרוני → threadpool)
+        def save():
+            if get_account(user_email):
+                supabase.table("accounts").update(
+                    {
+                        "runpod_token_encrypted": encrypted,
+                        "used_credits": 0.0,  # איפוס fallback — מרגע זה החיוב עובר למשתמש
+                        "updated_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                    }
+                ).eq("user_email", user_email).execute()
+            else:
+                supabase.table("accounts").insert(
+                    {
+                        "user_email": user_email,
+                        "runpod_token_encrypted": encrypted,
+                        "used_credits": 0.0,
+                        "limit_credits": FALLBACK_LIMIT_DEFAULT,
+                    }
+                ).execute()
+            invalidate_account(user_email)
+
+        await run_in_threadpool(save)
+        balance_cache.put(token, balance)
 
         # ✔️ מחזירים יתרה אמיתית של המשתמש
         return JSONResponse({
@@ -806,7 +4656,7 @@ async def save_token(request: Request):
         })
 
     except Exception as e:
-        print(f"❌ /save-token error: {e}")
+        log.error("❌ /save-token error: %s", e)
         return JSONResponse({"error": str(e)}, status_code=500)
 # ────────────────────────────────
 # בדיקת תמלול שהושלם אם המשתמש התנתק לפני קבלת התמלול
@@ -825,21 +4675,27 @@ async def update_job(request: Request):
             )
 
         # עדכון כל הרשומות של אותו קובץ
-        res = (
-            supabase.table("transcriptions")
-            .update({
-                "job_id": job_id,
-                "updated_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
-            })
-            .eq("audio_id", audio_id)
-            .execute()
-        )
+        updates = {
+            "job_id": job_id,
+            "updated_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        }
+        if TRANSCRIPTION_WRITE_BEHIND:
+            await run_in_threadpool(transcription_writes.update, "audio_id", audio_id, updates)
+            data = None
+        else:
+            res = await run_in_threadpool(
+                supabase.table("transcriptions").update(updates).eq("audio_id", audio_id).execute
+            )
+            data = res.data
 
-        print(f"🔥 job_id עודכן בכל הרשומות עם audio_id={audio_id} → {job_id}")
+        log.info("🔥 job_id עודכן בכל הרשומות עם audio_id=%s → %s", audio_id, job_id)
 
-        return JSONResponse({"status": "ok", "data": res.data})
+        # 📒 גם ברישום המקומי – סיום ה-job לא יצטרך לחפש את הרשומה
+        await run_in_threadpool(lambda: register_job(admission_queue.resolve(job_id) or job_id, audio_id=audio_id))
+
+        return JSONResponse({"status": "ok", "data": data, "queued": TRANSCRIPTION_WRITE_BEHIND})
 
     except Exception as e:
-        print("❌ /db/transcriptions/update-job:", e)
+        log.error("❌ /db/transcriptions/update-job: %s", e)
         return JSONResponse({"error": str(e)}, status_code=500)
 
@@ -0,0 +1,326 @@
+"""
+בנצ'מרק ובדיקת עומס – בלי שירותים בתשלום.
+
+מרים את devtools/fakes.py (RunPod, GraphQL, Supabase, Drive) ואת app.py כתהליכים נפרדים,
+מזין חשבונות דמה, ומריץ תרחישים מול השרת. לכל תרחיש: בקשות, שגיאות, תפוקה (req/s),
+p50/p99 ו-RSS של תהליך השרת (בסוף התרחיש ושיא שנדגם במהלכו).
+
+    python -m devtools.bench                                  # כל התרחישים
+    python -m devtools.bench --scenarios poll,balance --duration 20 --concurrency 64
+    python -m devtools.bench --json results.json              # שמירת תוצאות
+    python -m devtools.bench --baseline results.json          # השוואה; קוד יציאה 1 אם יש רגרסיה
+
+השהיה/תקלות ב-upstreams – דרך משתני FAKE_* (ראו devtools/fakes.py), למשל:
+    FAKE_SUPABASE_LATENCY_MS=40 FAKE_RUNPOD_FAILURE_RATE=0.02 python -m devtools.bench
+
+מדידת הזיכרון קוראת את /proc (Linux).
+"""
+import argparse
+import asyncio
+import base64
+import json
+import math
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+from Crypto.Cipher import AES
+from Crypto.Util.Padding import pad
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ENCRYPTION_KEY = "bench-encryption-key-32-bytes!!!"
+FAKE_SUPABASE_KEY = "eyJhbGciOiJIUzI1NiJ9.eyJyb2xlIjoic2VydmljZV9yb2xlIn0.bench"
+SCENARIOS = ("upload", "poll", "balance", "drive", "mixed")
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def rss_mb(pid: int) -> float:
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return 0.0
+
+
+def encrypt_token(token: str) -> str:
+    """כמו /save-token: AES-CBC עם iv בתחילת הגוף, ב-base64."""
+    iv = os.urandom(16)
+    cipher = AES.new(ENCRYPTION_KEY.encode()[:32], AES.MODE_CBC, iv)
+    return base64.b64encode(iv + cipher.encrypt(pad(token.encode(), AES.block_size))).decode()
+
+
+def percentile(sorted_values: list[float], q: float) -> float:
+    if not sorted_values:
+        return 0.0
+    return sorted_values[max(0, math.ceil(q * len(sorted_values)) - 1)]
+
+
+# ───────────────────────────────────────────────
+# הרמת התהליכים
+class Stack:
+    def __init__(self, args):
+        self.args = args
+        self.workdir = tempfile.mkdtemp(prefix="bench_")
+        self.fakes_port = free_port()
+        self.app_port = free_port()
+        self.fakes_url = f"http://127.0.0.1:{self.fakes_port}"
+        self.app_url = f"http://127.0.0.1:{self.app_port}"
+        self.procs: list[subprocess.Popen] = []
+
+    def _spawn(self, target: str, port: int, env: dict) -> subprocess.Popen:
+        proc = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", target, "--port", str(port), "--log-level", "warning"],
+            cwd=self.workdir,
+            env={**os.environ, "PYTHONPATH": REPO_ROOT, **env},
+        )
+        self.procs.append(proc)
+        return proc
+
+    async def _wait_ready(self, url: str):
+        async with httpx.AsyncClient() as client:
+            for _ in range(200):
+                try:
+                    await client.get(url)
+                    return
+                except httpx.TransportError:
+                    await asyncio.sleep(0.05)
+        raise RuntimeError(f"{url} לא עלה")
+
+    async def start(self):
+        self._spawn("devtools.fakes:app", self.fakes_port, {"FAKE_JOB_SECONDS": str(self.args.job_seconds)})
+        self.app = self._spawn("app:app", self.app_port, {
+            "SUPABASE_URL": self.fakes_url,
+            "SUPABASE_KEY": FAKE_SUPABASE_KEY,
+            "RUNPOD_ENDPOINT_URL": f"{self.fakes_url}/runpod/v2/bench",
+            "RUNPOD_GRAPHQL_URL": f"{self.fakes_url}/graphql",
+            "DRIVE_API_URL": f"{self.fakes_url}/drive/v3",
+            "BASE_URL": self.app_url,
+            "RUNPOD_API_KEY": "bench-fallback-key",
+            "ENCRYPTION_KEY": ENCRYPTION_KEY,
+            "RUNPOD_SUBMIT_RATE": "0",
+            "FALLBACK_LIMIT_DEFAULT": "1000",
+            "UPLOAD_DIR_QUOTA_BYTES": str(self.args.upload_quota_mb * 1024 * 1024),
+            "LOG_LEVEL": "ERROR",
+        })
+        await self._wait_ready(f"{self.fakes_url}/_fake/state")
+        await self._wait_ready(f"{self.app_url}/ping")
+
+    def stop(self):
+        # קודם השרת ואז הדמה – כדי שלא יישארו webhooks בדרך לשרת שכבר ירד
+        for proc in reversed(self.procs):
+            proc.terminate()
+        for proc in reversed(self.procs):
+            try:
+                proc.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+
+# ───────────────────────────────────────────────
+# הרצת תרחיש: concurrency עובדים שמריצים בקשות עד תום הזמן
+async def run_scenario(name: str, stack: Stack, request_fn, concurrency: int, duration: float) -> dict:
+    latencies: list[float] = []
+    errors = 0
+    peak = rss_mb(stack.app.pid)
+    deadline = time.perf_counter() + duration
+
+    async def worker(n: int):
+        nonlocal errors
+        while time.perf_counter() < deadline:
+            start = time.perf_counter()
+            try:
+                ok = await request_fn(n)
+            except httpx.HTTPError:
+                ok = False
+            latencies.append(time.perf_counter() - start)
+            errors += not ok
+
+    async def sample_memory():
+        nonlocal peak
+        while True:
+            peak = max(peak, rss_mb(stack.app.pid))
+            await asyncio.sleep(0.1)
+
+    rss_before = rss_mb(stack.app.pid)
+    sampler = asyncio.create_task(sample_memory())
+    started = time.perf_counter()
+    await asyncio.gather(*(worker(n) for n in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    sampler.cancel()
+
+    latencies.sort()
+    rss_after = rss_mb(stack.app.pid)
+    return {
+        "scenario": name,
+        "requests": len(latencies),
+        "errors": errors,
+        "rps": round(len(latencies) / elapsed, 1),
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 1),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 1),
+        "rss_mb": round(rss_after, 1),
+        "peak_rss_mb": round(max(peak, rss_after), 1),
+        "rss_delta_mb": round(rss_after - rss_before, 1),
+    }
+
+
+async def seed(stack: Stack, client: httpx.AsyncClient, users: int) -> list[str]:
+    """חצי מהמשתמשים עם טוקן אישי (GraphQL), חצי על fallback."""
+    emails = [f"bench{n}@example.com" for n in range(users)]
+    rows = [
+        {"user_email": email, "used_credits": 0.0, "limit_credits": 1000.0,
+         **({"runpod_token_encrypted": encrypt_token(f"personal-{n}")} if n % 2 else {})}
+        for n, email in enumerate(emails)
+    ]
+    await client.post(f"{stack.fakes_url}/rest/v1/accounts", json=rows)
+    return emails
+
+
+async def bench(args) -> list[dict]:
+    stack = Stack(args)
+    await stack.start()
+    results = []
+    try:
+        limits = httpx.Limits(max_connections=args.concurrency * 2, max_keepalive_connections=args.concurrency * 2)
+        async with httpx.AsyncClient(base_url=stack.app_url, timeout=120, limits=limits) as client:
+            emails = await seed(stack, client, args.users)
+            upload_body = os.urandom(args.upload_mb * 1024 * 1024)
+
+            async def upload(n: int, body: bytes = upload_body) -> bool:
+                # תחילית ייחודית – כל העלאה היא תוכן חדש (לא dedup)
+                content = os.urandom(16) + body
+                r = await client.post("/upload", files={"file": ("bench.wav", content, "audio/wav")})
+                return r.status_code == 200
+
+            async def transcribe(n: int) -> str | None:
+                r = await client.post("/transcribe", json={
+                    "user_email": random.choice(emails), "file_url": f"{stack.app_url}/files/bench-{n}.wav",
+                    "cache": False,
+                })
+                return r.json().get("id") if r.status_code == 200 else None
+
+            job_ids = [j for j in await asyncio.gather(*(transcribe(n) for n in range(args.jobs))) if j]
+
+            async def poll(n: int) -> bool:
+                r = await client.get(f"/status/{random.choice(job_ids)}")
+                return r.status_code == 200
+
+            async def balance(n: int) -> bool:
+                r = await client.get("/effective-balance", params={"user_email": random.choice(emails)})
+                return r.status_code == 200
+
+            async def drive(n: int) -> bool:
+                r = await client.get(
+                    "/fetch-and-store-audio",
+                    params={"file_id": f"bench-drive-{random.randrange(args.drive_files)}"},
+                    headers={"Authorization": "Bearer bench-google-token"},
+                )
+                return r.status_code == 200
+
+            small = os.urandom(256 * 1024)
+
+            async def mixed(n: int) -> bool:
+                roll = random.random()
+                if roll < 0.70:
+                    return await poll(n)
+                if roll < 0.90:
+                    return await balance(n)
+                if roll < 0.95:
+                    return await upload(n, small)
+                return await transcribe(random.randrange(1 << 30)) is not None
+
+            scenarios = {
+                "upload": (upload, max(1, args.concurrency // 8)),
+                "poll": (poll, args.concurrency),
+                "balance": (balance, args.concurrency),
+                "drive": (drive, max(1, args.concurrency // 8)),
+                "mixed": (mixed, args.concurrency),
+            }
+            for name in args.scenarios:
+                request_fn, concurrency = scenarios[name]
+                result = await run_scenario(name, stack, request_fn, concurrency, args.duration)
+                result["concurrency"] = concurrency
+                results.append(result)
+                print_row(result)
+    finally:
+        stack.stop()
+    return results
+
+
+# ───────────────────────────────────────────────
+# דיווח והשוואה ל-baseline
+COLUMNS = ("scenario", "concurrency", "requests", "errors", "rps", "p50_ms", "p99_ms", "rss_mb", "peak_rss_mb")
+
+
+def print_row(result: dict):
+    print("  ".join(f"{str(result.get(c, '')):>11}" for c in COLUMNS), flush=True)
+
+
+def compare(results: list[dict], baseline_path: str, tolerance: float) -> list[str]:
+    with open(baseline_path) as f:
+        baseline = {r["scenario"]: r for r in json.load(f)}
+    regressions = []
+    for r in results:
+        base = baseline.get(r["scenario"])
+        if not base:
+            continue
+        if r["rps"] < base["rps"] * (1 - tolerance):
+            regressions.append(f"{r['scenario']}: rps {base['rps']} → {r['rps']}")
+        if r["p99_ms"] > base["p99_ms"] * (1 + tolerance):
+            regressions.append(f"{r['scenario']}: p99 {base['p99_ms']}ms → {r['p99_ms']}ms")
+        if r["peak_rss_mb"] > base["peak_rss_mb"] * (1 + tolerance):
+            regressions.append(f"{r['scenario']}: peak rss {base['peak_rss_mb']}MB → {r['peak_rss_mb']}MB")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="בנצ'מרק מול upstreams מדומים")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS))
+    parser.add_argument("--duration", type=float, default=10, help="שניות לכל תרחיש")
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--jobs", type=int, default=200, help="jobs שנשלחים לפני תרחיש ה-poll")
+    parser.add_argument("--job-seconds", type=float, default=2, help="אחרי כמה שניות job מדומה מסתיים")
+    parser.add_argument("--upload-mb", type=int, default=20)
+    parser.add_argument("--upload-quota-mb", type=int, default=1024)
+    parser.add_argument("--drive-files", type=int, default=10)
+    parser.add_argument("--json", help="קובץ לשמירת התוצאות")
+    parser.add_argument("--baseline", help="קובץ תוצאות קודם להשוואה")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="סטייה מותרת מה-baseline (0.2 = 20%%)")
+    args = parser.parse_args()
+    args.scenarios = [s.strip() for s in args.scenarios.split(",") if s.strip()]
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"תרחישים לא מוכרים: {', '.join(sorted(unknown))}")
+
+    print("  ".join(f"{c:>11}" for c in COLUMNS))
+    results = asyncio.run(bench(args))
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        regressions = compare(results, args.baseline, args.tolerance)
+        for line in regressions:
+            print(f"❌ רגרסיה – {line}")
+        if regressions:
+            sys.exit(1)
+        print("✅ אין רגרסיות מול ה-baseline")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+"""
+שרת RunPod מדומה לפיתוח ובדיקות מקומיות – בלי לשלם על GPU.
+
+מממש את /v2/{endpoint}/run, /v2/{endpoint}/status/{job_id} ו-/v2/{endpoint}/health, מסיים כל job
+אחרי FAKE_JOB_SECONDS שניות, ואם בגוף הבקשה היה "webhook" – שולח אליו את התוצאה.
+
+worker נשאר "חם" FAKE_IDLE_SECONDS אחרי כל job: job שמגיע כשיש worker חם מקבל delayTime של
+FAKE_WARM_DELAY_MS במקום FAKE_DELAY_MS (cold start) – כך אפשר לראות את השפעת ה-prewarm.
+
+הרצה:
+    uvicorn devtools.fake_runpod:app --port 9100
+    RUNPOD_ENDPOINT_URL=http://127.0.0.1:9100/v2/fake BASE_URL=http://127.0.0.1:10000 \\
+        uvicorn app:app --port 10000
+"""
+import asyncio
+import os
+import time
+import uuid
+
+import httpx
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+
+FAKE_JOB_SECONDS = float(os.getenv("FAKE_JOB_SECONDS", "2"))
+FAKE_EXECUTION_MS = int(os.getenv("FAKE_EXECUTION_MS", "1500"))
+FAKE_DELAY_MS = int(os.getenv("FAKE_DELAY_MS", "800"))
+FAKE_WARM_DELAY_MS = int(os.getenv("FAKE_WARM_DELAY_MS", "50"))
+FAKE_IDLE_SECONDS = float(os.getenv("FAKE_IDLE_SECONDS", "5"))
+
+app = FastAPI()
+jobs: dict[str, dict] = {}
+ready_at = 0.0     # מתי ה-worker שעולה כרגע יהיה מוכן (time.monotonic)
+warm_until = 0.0   # עד מתי יש worker פנוי
+
+
+def fake_result(audio_seconds: float = 12.0) -> list:
+    """פלט בצורה של ivrit-ai: output[0]["result"] = רשימת קבוצות של סגמנטים."""
+    half = audio_seconds / 2
+    return [{
+        "result": [[
+            {"start": 0.0, "end": half, "text": "שלום", "speakers": ["SPEAKER_00"],
+             "words": [{"word": "שלום", "start": 0.0, "end": half}]},
+            {"start": half, "end": audio_seconds, "text": "עולם", "speakers": ["SPEAKER_01"],
+             "words": [{"word": "עולם", "start": half, "end": audio_seconds}]},
+        ]]
+    }]
+
+
+def public_view(job: dict) -> dict:
+    return {k: v for k, v in job.items() if k != "input"}
+
+
+def worker_delay_ms() -> int:
+    """delayTime ל-job חדש: worker חם, worker שעוד עולה (היתרה), או cold start."""
+    global ready_at, warm_until
+    now = time.monotonic()
+    if now < ready_at:
+        return max(FAKE_WARM_DELAY_MS, int((ready_at - now) * 1000))
+    if now < warm_until:
+        return FAKE_WARM_DELAY_MS
+    ready_at = now + FAKE_DELAY_MS / 1000
+    warm_until = ready_at + FAKE_IDLE_SECONDS
+    return FAKE_DELAY_MS
+
+
+async def finish_later(job_id: str, webhook: str | None, delay_ms: int):
+    global warm_until
+    await asyncio.sleep(FAKE_JOB_SECONDS)
+    warm_until = max(warm_until, time.monotonic() + FAKE_IDLE_SECONDS)
+    job = jobs[job_id]
+    job.update({
+        "status": "COMPLETED",
+        "delayTime": delay_ms,
+        "executionTime": FAKE_EXECUTION_MS,
+        "output": fake_result(),
+    })
+    if webhook:
+        async with httpx.AsyncClient(timeout=10) as client:
+            try:
+                await client.post(webhook, json=public_view(job))
+            except httpx.HTTPError as e:
+                print(f"⚠️ fake webhook failed: {e}")
+
+
+@app.post("/v2/{endpoint}/run")
+async def run(endpoint: str, request: Request):
+    body = await request.json()
+    job_id = f"fake-{uuid.uuid4().hex[:12]}"
+    jobs[job_id] = {"id": job_id, "status": "IN_QUEUE", "input": body.get("input")}
+    delay_ms = worker_delay_ms()
+    asyncio.create_task(finish_later(job_id, body.get("webhook"), delay_ms))
+    return {"id": job_id, "status": "IN_QUEUE"}
+
+
+@app.get("/v2/{endpoint}/status/{job_id}")
+async def status(endpoint: str, job_id: str):
+    job = jobs.get(job_id)
+    if not job:
+        return JSONResponse({"error": "job not found"}, status_code=404)
+    return public_view(job)
+
+
+@app.get("/v2/{endpoint}/health")
+async def health(endpoint: str):
+    queued = sum(1 for job in jobs.values() if job["status"] == "IN_QUEUE")
+    return {
+        "jobs": {"inQueue": queued, "inProgress": 0, "completed": len(jobs) - queued, "failed": 0},
+        "workers": {
+            "idle": int(ready_at <= time.monotonic() < warm_until),
+            "initializing": int(time.monotonic() < ready_at),
+            "running": 0,
+        },
+    }
@@ -0,0 +1,257 @@
+"""
+שרתי דמה לכל ה-upstreams של השרת – RunPod (REST + GraphQL), Supabase PostgREST ו-Google Drive –
+באפליקציה אחת, עם השהיה ותקלות מוזרקות. משמש את devtools/bench.py, ואפשר גם להריץ ידנית:
+
+    uvicorn devtools.fakes:app --port 9100
+    SUPABASE_URL=http://127.0.0.1:9100 SUPABASE_KEY=<כל JWT> \\
+    RUNPOD_ENDPOINT_URL=http://127.0.0.1:9100/runpod/v2/fake \\
+    RUNPOD_GRAPHQL_URL=http://127.0.0.1:9100/graphql \\
+    DRIVE_API_URL=http://127.0.0.1:9100/drive/v3 \\
+        uvicorn app:app --port 10000
+
+הזרקה (לכל השירותים, או לשירות אחד עם FAKE_<RUNPOD|GRAPHQL|SUPABASE|DRIVE>_...):
+    FAKE_LATENCY_MS   – השהיה ממוצעת לכל בקשה
+    FAKE_JITTER_MS    – סטייה אקראית (±) סביב הממוצע
+    FAKE_FAILURE_RATE – שיעור בקשות שנענות ב-503 (0..1)
+
+FAKE_DRIVE_BYTES_PER_SECOND – קצב שליחת התוכן מדרייב (0 = בלי הגבלה); לבדיקת הגשה תוך כדי הורדה.
+"""
+import asyncio
+import hashlib
+import os
+import random
+import time
+from collections import defaultdict
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+
+from devtools import fake_runpod
+
+FAKE_DRIVE_FILE_BYTES = int(os.getenv("FAKE_DRIVE_FILE_BYTES", str(8 * 1024 * 1024)))
+FAKE_DRIVE_BYTES_PER_SECOND = int(os.getenv("FAKE_DRIVE_BYTES_PER_SECOND", "0"))
+FAKE_BALANCE = float(os.getenv("FAKE_BALANCE", "12.5"))
+
+SERVICE_PREFIXES = {"/runpod": "runpod", "/graphql": "graphql", "/rest": "supabase", "/drive": "drive"}
+
+app = FastAPI()
+app.mount("/runpod", fake_runpod.app)
+
+
+def _setting(service: str, name: str, default: str = "0") -> float:
+    return float(os.getenv(f"FAKE_{service.upper()}_{name}", os.getenv(f"FAKE_{name}", default)))
+
+
+@app.middleware("http")
+async def inject_faults(request: Request, call_next):
+    service = next((s for p, s in SERVICE_PREFIXES.items() if request.url.path.startswith(p)), None)
+    if service:
+        latency = _setting(service, "LATENCY_MS")
+        jitter = _setting(service, "JITTER_MS")
+        delay = max(0.0, latency + random.uniform(-jitter, jitter)) / 1000
+        if delay:
+            await asyncio.sleep(delay)
+        if random.random() < _setting(service, "FAILURE_RATE"):
+            return JSONResponse({"error": f"injected {service} failure"}, status_code=503)
+    return await call_next(request)
+
+
+# ───────────────────────────────────────────────
+# RunPod GraphQL – myself { clientBalance }
+@app.post("/graphql")
+async def graphql(request: Request):
+    if not request.headers.get("authorization", "").startswith("Bearer "):
+        return JSONResponse({"errors": [{"message": "unauthorized"}]}, status_code=401)
+    return {"data": {"myself": {"clientBalance": FAKE_BALANCE, "hostBalance": 0}}}
+
+
+# ───────────────────────────────────────────────
+# Supabase PostgREST – טבלאות בזיכרון, מסננים בסיסיים ו-rpc (charge_fallback_job, update_transcriptions)
+tables: dict[str, list[dict]] = defaultdict(list)
+ledger: dict[str, dict] = {}
+_next_id = 0
+_RESERVED_PARAMS = {"select", "order", "limit", "offset", "on_conflict", "columns"}
+
+
+def _unquote(value: str) -> str:
+    return value[1:-1] if len(value) > 1 and value[0] == value[-1] == '"' else value
+
+
+def _compare(actual, op: str, value: str) -> bool:
+    if op == "is":
+        return actual is None if value == "null" else True
+    if op == "in":
+        return str(actual) in {_unquote(v) for v in value.strip("()").split(",")}
+    value = _unquote(value)
+    if isinstance(actual, (int, float)) and not isinstance(actual, bool):
+        actual, value = float(actual), float(value)
+    else:
+        actual = "" if actual is None else str(actual)
+    return {
+        "eq": actual == value, "neq": actual != value,
+        "lt": actual < value, "lte": actual <= value,
+        "gt": actual > value, "gte": actual >= value,
+    }.get(op, True)
+
+
+def _split_top(expr: str) -> list[str]:
+    """מפצל לפי פסיקים ברמה העליונה (לא בתוך סוגריים או מרכאות)."""
+    parts, depth, quoted, current = [], 0, False, ""
+    for ch in expr:
+        if ch == '"':
+            quoted = not quoted
+        elif not quoted and ch in "()":
+            depth += 1 if ch == "(" else -1
+        elif not quoted and depth == 0 and ch == ",":
+            parts.append(current)
+            current = ""
+            continue
+        current += ch
+    return parts + [current] if current else parts
+
+
+def _matches_logic(row: dict, expr: str) -> bool:
+    """or=(a.lt.1,and(a.eq.1,b.lt.2)) – הצורה שבה משתמשים ב-keyset."""
+    if expr.startswith(("and(", "or(")):
+        kind, _, inner = expr.partition("(")
+        results = [_matches_logic(row, part) for part in _split_top(inner[:-1])]
+        return all(results) if kind == "and" else any(results)
+    column, op, value = expr.split(".", 2)
+    return _compare(row.get(column), op, value)
+
+
+def _matches(row: dict, params) -> bool:
+    for column, expr in params.multi_items():
+        if column in _RESERVED_PARAMS:
+            continue
+        if column in ("or", "and"):
+            if not _matches_logic(row, f"{column}{expr}"):
+                return False
+            continue
+        op, _, value = expr.partition(".")
+        if not _compare(row.get(column), op, value):
+            return False
+    return True
+
+
+def _project(row: dict, select: str | None) -> dict:
+    if not select or select == "*":
+        return dict(row)
+    return {c.strip(): row.get(c.strip()) for c in select.split(",")}
+
+
+@app.post("/rest/v1/rpc/charge_fallback_job")
+async def charge_fallback_job(request: Request):
+    body = await request.json()
+    account = next((a for a in tables["accounts"] if a.get("user_email") == body["p_user_email"]), None)
+    charged = body["p_job_id"] not in ledger
+    if charged:
+        ledger[body["p_job_id"]] = body
+        if account is not None:
+            account["used_credits"] = round(float(account.get("used_credits") or 0) + float(body["p_amount"]), 6)
+    total = float(account.get("used_credits") or 0) if account else 0.0
+    return [{"charged": charged, "total_used": total}]
+
+
+@app.post("/rest/v1/rpc/update_transcriptions")
+async def update_transcriptions(request: Request):
+    body = await request.json()
+    total = 0
+    for item in body["p_updates"]:
+        for row in tables["transcriptions"]:
+            if str(row.get(item["column"])) == str(item["value"]):
+                row.update(item["set"])
+                total += 1
+    return total
+
+
+@app.api_route("/rest/v1/{table}", methods=["GET", "POST", "PATCH", "DELETE"])
+async def postgrest(table: str, request: Request):
+    global _next_id
+    params = request.query_params
+    rows = tables[table]
+
+    if request.method == "POST":
+        body = await request.json()
+        created = []
+        for item in body if isinstance(body, list) else [body]:
+            _next_id += 1
+            row = {"id": _next_id, "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"), **item}
+            rows.append(row)
+            created.append(row)
+        return JSONResponse(created, status_code=201)
+
+    matched = [r for r in rows if _matches(r, params)]
+    if request.method == "PATCH":
+        updates = await request.json()
+        for row in matched:
+            row.update(updates)
+        return matched
+    if request.method == "DELETE":
+        tables[table] = [r for r in rows if r not in matched]
+        return matched
+
+    if "order" in params:
+        for term in reversed(params["order"].split(",")):
+            column, _, direction = term.partition(".")
+            matched.sort(key=lambda r: (r.get(column) is not None, r.get(column) or 0), reverse=direction.startswith("desc"))
+    offset = int(params.get("offset", 0))
+    limit = int(params["limit"]) if "limit" in params else None
+    matched = matched[offset:offset + limit if limit is not None else None]
+    return [_project(r, params.get("select")) for r in matched]
+
+
+# ───────────────────────────────────────────────
+# Google Drive – מטא-דאטה ו-alt=media עם Range; תוכן דטרמיניסטי לכל file_id
+_drive_files: dict[str, bytes] = {}
+
+
+def drive_content(file_id: str) -> bytes:
+    if file_id not in _drive_files:
+        _drive_files[file_id] = random.Random(file_id).randbytes(FAKE_DRIVE_FILE_BYTES)
+    return _drive_files[file_id]
+
+
+async def _throttled(data: bytes, chunk_size: int = 64 * 1024):
+    for start in range(0, len(data), chunk_size):
+        yield data[start:start + chunk_size]
+        await asyncio.sleep(chunk_size / FAKE_DRIVE_BYTES_PER_SECOND)
+
+
+@app.get("/drive/v3/files/{file_id}")
+async def drive_file(file_id: str, request: Request, alt: str | None = None):
+    if not request.headers.get("authorization", "").startswith("Bearer "):
+        return JSONResponse({"error": {"code": 401, "message": "unauthorized"}}, status_code=401)
+    content = drive_content(file_id)
+    if alt != "media":
+        return {
+            "id": file_id,
+            "name": f"{file_id}.mp3",
+            "mimeType": "audio/mpeg",
+            "size": str(len(content)),
+            "md5Checksum": hashlib.md5(content).hexdigest(),
+            "modifiedTime": "2024-01-01T00:00:00.000Z",
+        }
+
+    status_code, headers = 200, {}
+    range_header = request.headers.get("range", "")
+    if range_header.startswith("bytes="):
+        start_s, _, end_s = range_header[6:].partition("-")
+        start = int(start_s)
+        end = min(int(end_s) if end_s else len(content) - 1, len(content) - 1)
+        status_code, headers = 206, {"Content-Range": f"bytes {start}-{end}/{len(content)}"}
+        content = content[start:end + 1]
+    if FAKE_DRIVE_BYTES_PER_SECOND:
+        headers["Content-Length"] = str(len(content))
+        return StreamingResponse(_throttled(content), status_code=status_code, media_type="audio/mpeg", headers=headers)
+    return Response(content, status_code=status_code, media_type="audio/mpeg", headers=headers)
+
+
+@app.get("/_fake/state")
+def state():
+    """מבט על מצב הדמה: מספר שורות לכל טבלה, חיובים ו-jobs."""
+    return {
+        "tables": {name: len(rows) for name, rows in tables.items()},
+        "ledger": len(ledger),
+        "jobs": len(fake_runpod.jobs),
+    }
@@ -0,0 +1,48 @@
+-- 📒 ledger חיובי fallback – חיוב אחד לכל job_id, כתוספת אטומית ל-used_credits.
+-- להרצה פעם אחת ב-Supabase (SQL Editor). נקרא מ-app.py דרך supabase.rpc("charge_fallback_job").
+
+create table if not exists public.credit_ledger (
+    job_id      text primary key,
+    user_email  text not null,
+    amount_usd  numeric(14, 8) not null,
+    created_at  timestamptz not null default now()
+);
+
+create index if not exists credit_ledger_user_email_idx on public.credit_ledger (user_email);
+
+create or replace function public.charge_fallback_job(
+    p_job_id text,
+    p_user_email text,
+    p_amount numeric
+)
+returns table (charged boolean, total_used numeric)
+language plpgsql
+as $$
+begin
+    insert into public.credit_ledger (job_id, user_email, amount_usd)
+    values (p_job_id, p_user_email, p_amount)
+    on conflict (job_id) do nothing;
+
+    if found then
+        -- job חדש: תוספת אטומית (נעילת השורה ע"י UPDATE, בלי read-modify-write)
+        return query
+            update public.accounts a
+               set used_credits = round(coalesce(a.used_credits, 0) + p_amount, 6)
+             where a.user_email = p_user_email
+            returning true, a.used_credits::numeric;
+        if not found then
+            -- אין שורת accounts: ה-job נרשם ב-ledger ואין used_credits לעדכן
+            return query select true, 0::numeric;
+        end if;
+    else
+        -- כבר חויב – מחזירים את המצב הנוכחי בלי לשנות
+        return query
+            select false, a.used_credits::numeric
+              from public.accounts a
+             where a.user_email = p_user_email;
+        if not found then
+            return query select false, 0::numeric;
+        end if;
+    end if;
+end;
+$$;
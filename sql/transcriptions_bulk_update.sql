@@ -0,0 +1,41 @@
+-- 🗄 עדכון מרוכז של transcriptions – כמה רשומות בקריאה אחת (ובטרנזקציה אחת).
+-- להרצה פעם אחת ב-Supabase (SQL Editor). נקרא מ-app.py דרך supabase.rpc("update_transcriptions").
+--
+-- p_updates: מערך של {"column": "id" | "audio_id", "value": ..., "set": {עמודה: ערך, ...}}
+-- כל פריט מעדכן רק את העמודות שב-"set" (בלי upsert – רשומה שלא קיימת לא נוצרת).
+
+create or replace function public.update_transcriptions(p_updates jsonb)
+returns integer
+language plpgsql
+as $$
+declare
+    item jsonb;
+    sets text;
+    affected integer;
+    total integer := 0;
+begin
+    for item in select * from jsonb_array_elements(p_updates) loop
+        if item->>'column' not in ('id', 'audio_id') then
+            raise exception 'update_transcriptions: unsupported key column %', item->>'column';
+        end if;
+
+        select string_agg(format('%I = r.%I', k, k), ', ')
+          into sets
+          from jsonb_object_keys(item->'set') as k;
+        continue when sets is null;
+
+        -- הערכים (וגם המפתח) עוברים דרך jsonb_populate_record – כך הם מקבלים את טיפוסי העמודות
+        execute format(
+            'update public.transcriptions t set %s '
+            'from jsonb_populate_record(null::public.transcriptions, $1) r '
+            'where t.%I = r.%I',
+            sets, item->>'column', item->>'column'
+        )
+        using (item->'set') || jsonb_build_object(item->>'column', item->'value');
+
+        get diagnostics affected = row_count;
+        total := total + affected;
+    end loop;
+    return total;
+end;
+$$;
@@ -0,0 +1,9 @@
+import os
+import sys
+import tempfile
+
+# app.py יוצר לקוח Supabase ותיקיית מצב בזמן import – ערכי דמה, בלי רשת
+os.environ.setdefault("SUPABASE_URL", "http://127.0.0.1:1")
+os.environ.setdefault("SUPABASE_KEY", "eyJhbGciOiJIUzI1NiJ9.eyJyb2xlIjoiYW5vbiJ9.x")
+os.environ.setdefault("DATA_DIR", tempfile.mkdtemp(prefix="tests-data-"))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,110 @@
+import asyncio
+
+import pytest
+
+import app
+
+
+def part(offset, boundary, segs):
+    return {"offset": offset, "boundary": boundary, "output": [{"result": [segs]}]}
+
+
+def seg(start, end, *speakers, **extra):
+    return {"start": start, "end": end, "speakers": list(speakers), **extra}
+
+
+# ── choose_cut_points ──────────────────────────
+
+def test_short_file_is_not_cut():
+    assert app.choose_cut_points(120, [], 100) == []
+    assert app.choose_cut_points(125, [], 100) == []
+
+
+def test_cut_at_nearest_silence_midpoint():
+    silences = [(80, 82), (98, 100), (140, 150)]
+    assert app.choose_cut_points(180, silences, 100) == [99]
+
+
+def test_cut_at_target_without_nearby_silence():
+    assert app.choose_cut_points(300, [(10, 12)], 100) == [100, 200]
+
+
+def test_last_segment_not_longer_than_limit():
+    cuts = app.choose_cut_points(1000, [(95, 96), (230, 240)], 100)
+    bounds = [0, *cuts, 1000]
+    assert all(b - a <= 125 for a, b in zip(bounds, bounds[1:]))
+
+
+# ── merge_split_outputs ────────────────────────
+
+def test_times_and_words_are_shifted_and_overlap_dropped():
+    segments = [
+        part(0, 0, [seg(0, 8, "SPEAKER_00", id=0)]),
+        part(7, 10, [
+            seg(0, 2, "SPEAKER_00", id=0),   # 7–9: לפני נקודת החיתוך → מהקטע הקודם
+            seg(4, 6, "SPEAKER_00", id=1, words=[{"start": 4.5, "end": 5, "word": "x"}]),
+        ]),
+    ]
+    merged, _ = app.merge_split_outputs(segments)
+    assert [(s["start"], s["end"]) for s in merged] == [(0, 8), (11, 13)]
+    assert merged[1]["words"][0]["start"] == 11.5
+    assert [s["id"] for s in merged] == [0, 1]
+
+
+def test_speakers_matched_by_overlap():
+    segments = [
+        part(0, 0, [seg(0, 8, "SPEAKER_00"), seg(8, 10, "SPEAKER_01")]),
+        # בקטע השני התוויות הפוכות: המקומי SPEAKER_01 הוא הגלובלי SPEAKER_00
+        part(7, 10, [seg(0, 1, "SPEAKER_01"), seg(1, 3, "SPEAKER_00"), seg(3, 6, "SPEAKER_00"),
+                     seg(6, 9, "SPEAKER_01")]),
+    ]
+    merged, maps = app.merge_split_outputs(segments)
+    assert maps[1] == {"SPEAKER_00": "SPEAKER_01", "SPEAKER_01": "SPEAKER_00"}
+    assert [s["speakers"] for s in merged] == [["SPEAKER_00"], ["SPEAKER_01"], ["SPEAKER_01"], ["SPEAKER_00"]]
+
+
+def test_unmatched_speaker_does_not_take_existing_label():
+    segments = [
+        part(0, 0, [seg(0, 5, "SPEAKER_00"), seg(5, 10, "SPEAKER_01")]),
+        # SPEAKER_01 המקומי חופף ל-SPEAKER_01 הגלובלי; SPEAKER_00 המקומי הוא דובר חדש
+        part(7, 10, [seg(0, 3, "SPEAKER_01"), seg(4, 8, "SPEAKER_00")]),
+    ]
+    _, maps = app.merge_split_outputs(segments)
+    assert maps[1] == {"SPEAKER_01": "SPEAKER_01", "SPEAKER_00": "SPEAKER_02"}
+
+
+def test_word_level_speakers_are_relabelled():
+    segments = [
+        part(0, 0, [seg(0, 10, "SPEAKER_00")]),
+        part(7, 10, [{"start": 0, "end": 3, "speaker": "SPEAKER_03"},
+                     {"start": 4, "end": 6, "speaker": "SPEAKER_03",
+                      "words": [{"start": 4, "end": 5, "speaker": "SPEAKER_03"}]}]),
+    ]
+    merged, maps = app.merge_split_outputs(segments)
+    assert maps[1] == {"SPEAKER_03": "SPEAKER_00"}
+    assert merged[-1]["speaker"] == "SPEAKER_00"
+    assert merged[-1]["words"][0]["speaker"] == "SPEAKER_00"
+
+
+def test_segments_without_timing_do_not_crash():
+    segments = [
+        part(0, 0, [seg(0, 8, "SPEAKER_00"), {"text": "no timing", "speakers": ["SPEAKER_01"]}]),
+        part(7, 10, [{"text": "no end", "start": 0, "speakers": ["SPEAKER_00"]}, seg(4, 6, "SPEAKER_00")]),
+    ]
+    merged, _ = app.merge_split_outputs(segments)
+    assert merged[-1]["start"] == 11
+
+
+# ── _submit_segment ────────────────────────────
+
+@pytest.mark.parametrize("error", [ConnectionError("refused"), ValueError("not json")])
+def test_submit_segment_exception_marks_segment(monkeypatch, error):
+    async def fail(token, run_body):
+        raise error
+
+    monkeypatch.setattr(app, "submit_runpod_job", fail)
+    s = {"index": 2, "url": "http://x/files/a.flac", "job_id": "old", "status": "FAILED", "attempts": 1}
+    asyncio.run(app._submit_segment("tok", {"url": "u"}, s))
+    assert s["status"] == "SUBMIT_FAILED"
+    assert s["job_id"] is None
+    assert s["attempts"] == 2